@@ -13,13 +13,20 @@
 ##############################################################################
 name, version = 'zc.s3staticsync', '0'
 
-install_requires = ['setuptools', 'boto', 'keyring', 'zc.lockfile']
-extras_require = dict(test=['mock', 'zope.testing'])
+install_requires = ['setuptools', 'boto', 'keyring', 'scandir',
+                    'zc.lockfile']
+extras_require = dict(
+    gevent=['gevent'],
+    test=['gevent', 'mock', 'zope.testing'],
+    )
 
 entry_points = """
 [console_scripts]
 s3staticsync = zc.s3staticsync:main
 s3staticrestore = zc.s3staticsync.restore:main
+s3staticindex = zc.s3staticsync.index:main
+s3staticbenchmark = zc.s3staticsync.benchmark:main
+s3staticplan = zc.s3staticsync.plan:main
 """
 
 from setuptools import setup
@@ -3,48 +3,637 @@
 
 import boto.s3.connection
 import boto.s3.key
+import boto.s3.prefix
+import base64
+import binascii
+import copy
+import cStringIO
+import fnmatch
 import hashlib
+import itertools
 import logging
 import optparse
 import os
-import marshal
+import mimetypes
 import Queue
 import sys
 import threading
 import time
+from zc.s3staticsync import index as indexfile
+from zc.s3staticsync import plan as planfile
+from zc.s3staticsync.engine import create_engine
+from zc.s3staticsync.connection import ConnectionPool
+from zc.s3staticsync.hashcache import HashCache, md5, signature
+from zc.s3staticsync.hashcache import boto_md5, content_md5
+from zc.s3staticsync.invalidation import Planner, Recorder
+from zc.s3staticsync.metrics import Metrics
+from zc.s3staticsync.retry import Limiter, Retries
+from zc.s3staticsync.scheduler import Budget, Scheduler, Spool
+from zc.s3staticsync.timestamps import s3_time
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
 parser = optparse.OptionParser(usage=__doc__)
 parser.add_option('-w', '--worker-threads', type='int', default=9)
+parser.add_option('-E', '--engine', choices=['threads', 'gevent'],
+                  default='threads',
+                  help="How to run S3 operations: in worker threads"
+                  " (default) or in gevent greenlets (requires gevent).")
+parser.add_option('--in-flight', type='int', default=1000,
+                  help="The maximum number of S3 operations in flight"
+                  " with the gevent engine.")
+parser.add_option('--retries', type='int', default=4,
+                  help="How many times to retry failed S3 operations.")
+parser.add_option('--retry-delay', type='float', default=1,
+                  help="Seconds to wait before the first retry. The delay"
+                  " doubles (with jitter) for each further retry.")
+parser.add_option('--retry-max-delay', type='float', default=60,
+                  help="The maximum number of seconds between retries.")
 parser.add_option('-f', '--clock-fudge-factor', type='int', default=1200)
 parser.add_option('-e', '--file-system-encoding', default='latin-1')
 parser.add_option('-D', '--no-delete', action='store_true')
 parser.add_option('-i', '--index')
 parser.add_option('-I', '--ignore-index', action='store_true',
                   help="List the S3 bucket rather than using the index file")
+parser.add_option('-L', '--s3-listers', type='int', default=1,
+                  help="Number of threads used to list the S3 bucket."
+                  " The key space is partitioned using common prefixes.")
+parser.add_option('-J', '--merge-join', action='store_true',
+                  help="Compute differences by merge-joining sorted"
+                  " file-system and S3 listings, using constant memory."
+                  " (With an index, the new index is still built in"
+                  " memory: just its changes, if the old index is"
+                  " compact.)")
+parser.add_option('-C', '--compact-index', action='store_true',
+                  help="Write the index in the compact format. (Compact"
+                  " indexes are always rewritten in the compact format.)")
+parser.add_option('-m', '--multipart-threshold', type='int', default=64,
+                  help="Upload files larger than this many megabytes"
+                  " in parts, using S3 multipart uploads.")
+parser.add_option('--multipart-part-size', type='int', default=16,
+                  help="The size, in megabytes, of multipart-upload parts.")
+parser.add_option('--multipart-threads', type='int', default=4,
+                  help="Number of threads uploading parts of large files.")
+parser.add_option('-W', '--watch', action='store_true',
+                  help="Run continuously, watching the source directory"
+                  " for changes with inotify and syncing changed paths."
+                  " Requires an index.")
+parser.add_option('--debounce', type='float', default=2,
+                  help="When watching, wait until there have been no"
+                  " changes for this many seconds before syncing.")
+parser.add_option('--reconcile-interval', type='int', default=3600,
+                  help="When watching, do a full sync this often"
+                  " (in seconds).")
+parser.add_option('--delete-threads', type='int', default=2,
+                  help="Number of threads deleting S3 objects, in batches"
+                  " of up to 1000, using multi-object deletes.")
+parser.add_option('--hash-cache',
+                  help="Compare the content of files whose modification"
+                  " times changed, and only upload them if their content"
+                  " changed.  File digests are cached in the given file.")
+parser.add_option('--hash-threads', type='int', default=4,
+                  help="Number of threads hashing files, with --hash-cache"
+                  " or the gevent engine.")
+parser.add_option('--server-side-copy', action='store_true',
+                  help="With --hash-cache, copy files whose content S3"
+                  " already has under other keys (such as renamed or"
+                  " duplicated files) within S3, rather than uploading"
+                  " them.  Deletes wait until uploads are done, so"
+                  " deleted keys can be copied from.")
+parser.add_option('--hot-extensions',
+                  default='.html,.htm,.css,.js,.json,.xml,.svg,.txt',
+                  help="Comma-separated extensions of files uploaded ahead"
+                  " of others.")
+parser.add_option('--hot-path', action='append', default=[],
+                  help="Upload files matching the given glob pattern"
+                  " (relative to the source directory) ahead of others."
+                  "  Can be repeated.")
+parser.add_option('--bulk-size', type='int', default=8,
+                  help="Size, in megabytes, of files uploaded behind"
+                  " others.")
+parser.add_option('--upload-budget', type='int',
+                  help="Maximum number of megabytes to upload in a run."
+                  "  Files that don't fit are left for later runs.")
+parser.add_option('--queue-size', type='int', default=999,
+                  help="Maximum number of pending uploads held in memory."
+                  "  More are spooled to temporary files, so scanning"
+                  " isn't held up by uploads.")
+parser.add_option('--spool-directory',
+                  help="Directory for the temporary files pending uploads"
+                  " are spooled to.  Defaults to the system's temporary"
+                  " directory.")
+parser.add_option('--plan',
+                  help="Write the changes we'd make to the given file,"
+                  " rather than making them.  See --apply.")
+parser.add_option('--apply',
+                  help="Make the changes in the given plan file, rather"
+                  " than scanning.  Changes made by earlier applies of"
+                  " the plan are skipped.")
+parser.add_option('--max-bytes', type='int',
+                  help="With --apply, upload at most this many bytes."
+                  "  The rest of the plan is left for a later apply.")
+parser.add_option('--max-ops', type='int',
+                  help="With --apply, make at most this many changes."
+                  "  The rest of the plan is left for a later apply.")
+parser.add_option('--paths', '--path', action='append', dest='paths',
+                  help="Sync just the given file or directory (relative to"
+                  " the source directory) and the keys under it, trusting"
+                  " the index for everything else.  Can be repeated."
+                  "  A path of '.' syncs the whole tree.  Without an"
+                  " index, just the keys under the paths are listed.")
+parser.add_option('--prune-directories', action='store_true',
+                  help="Save directories' modification times and entry"
+                  " counts with the index, and use the indexed times of"
+                  " files in directories that haven't changed, rather"
+                  " than stat them.  Files changed in place aren't"
+                  " noticed until the next full scan.  With -g, the"
+                  " generated pages of unchanged directories are kept"
+                  " until then, too.")
+parser.add_option('--full-scan-every', type='int', default=10,
+                  help="With --prune-directories, stat every file every"
+                  " this many syncs.")
+parser.add_option('--metrics-json',
+                  help="Write run metrics to the given file, as JSON.")
+parser.add_option('--metrics-prometheus',
+                  help="Write run metrics to the given file, in the"
+                  " Prometheus text format.")
+parser.add_option('--shards', type='int', default=1,
+                  help="Split the tree, by top-level names, across this"
+                  " many processes.")
 parser.add_option('-l', '--lock-file')
 parser.add_option('-g', '--generate-index-html', action="store_true")
+parser.add_option('-S', '--scan-threads', type='int', default=4,
+                  help="Number of threads used to scan the file system")
 parser.add_option(
     '-c', '--cloudfront',
     help="Invalidate the given cloudfront distribution on updates and deletes.")
+parser.add_option('--invalidation-wildcard', type='int', default=10,
+                  help="Invalidate a directory with a wildcard path if at"
+                  " least this many of its entries changed (0 to disable).")
+parser.add_option('--invalidation-interval', type='int', default=60,
+                  help="Maximum number of seconds updated paths wait before"
+                  " being submitted for invalidation.")
 
 logger = logging.getLogger(__name__)
 
+MB = 1 << 20
+MAX_PARTS = 10000 # S3 limit on the number of parts in a multipart upload
+MAX_DELETES = 1000 # S3 limit on the number of keys in a multi-object delete
+MAX_COPY_SIZE = 5 << 30 # S3 limit on the size of an object copied at once
+# Bytes read per send when uploading, rather than boto's default 8K,
+# so large files take fewer trips through Python.
+UPLOAD_BUFFER_SIZE = 1 << 18
+GENERATE = object() # The "mtime" of index.html jobs
+INDEX_HTML = "index.html"
+
 def thread(func, *args):
     t = threading.Thread(target=func, args=args)
     t.setDaemon(True)
     t.start()
     return t
 
+class DirEntry:
+    """Minimal stand-in for a scandir DirEntry, used without scandir
+    """
+
+    def __init__(self, dirpath, name):
+        self.name = name
+        self.path = os.path.join(dirpath, name)
+
+    def is_dir(self):
+        return os.path.isdir(self.path)
+
+    def stat(self):
+        return os.stat(self.path)
+
+def listdir(path):
+    """Return the entries of a directory, sorted by name
+
+    Where scandir is available, we use it, because it gets file types
+    from the directory read itself and caches stat results, saving
+    system calls.
+    """
+    if scandir is None:
+        entries = [DirEntry(path, name) for name in os.listdir(path)]
+    else:
+        entries = list(scandir(path))
+    entries.sort(key=lambda entry: entry.name)
+    return entries
+
+class Listing(list):
+    """Rows used to generate a directory's index.html
+
+    Rows are (name, is_dir, mtime, size) tuples, sorted by name.
+    The fingerprint is stored in the index in place of the index.html
+    modification time, so we can tell whether a directory's listing
+    changed without generating it.
+    """
+
+    @property
+    def fingerprint(self):
+        return hashlib.md5(repr(list(self))).hexdigest()
+
+def directory_listing(entries):
+    """Compute the listing of a directory from its (sorted) entries
+
+    The stat data is usually already cached by the scan.
+    """
+    listing = Listing()
+    for entry in entries:
+        if entry.name.startswith('.'):
+            continue # don't index dot files
+        try:
+            stat = entry.stat()
+        except OSError:
+            continue # Removed since we read the directory
+        listing.append(
+            (entry.name, entry.is_dir(), stat.st_mtime, stat.st_size))
+    return listing
+
+def render_index_html(title, listing, encoding):
+    data = "Index of "+title
+    data = [
+        "<!-- generated -->",
+        "<html><head><title>%s</title></head><body>" % data,
+        "<h1>%s</h1><table>" % data,
+        "<tr><th>Name</th><th>Last modified</th><th>Size</th>"
+        "</tr>",
+        ]
+    for name, is_dir, mtime, size in listing:
+        if is_dir:
+            name = name + '/'
+            size = '-'
+        name = name.decode(encoding)
+        data.append(
+            '<tr><td><a href="%s">%s</a></td>\n'
+            '    <td>%s</td><td>%s</td></tr>'
+            % (name, name, time.ctime(mtime), size))
+    data.append("</table></body></html>\n")
+    return '\n'.join(data)
+
+def index_html_body(title, listing, encoding):
+    """Render an index.html page for uploading
+
+    Return a file to upload from, the page's size, and its md5 (as
+    boto wants it).  The page is encoded and hashed once, and the
+    file reads the encoded page without copying it.
+    """
+    data = render_index_html(title, listing, encoding).encode('utf-8')
+    return cStringIO.StringIO(data), len(data), boto_md5(hashlib.md5(data))
+
+def shard_entries(entries, shard, encoding):
+    """Select a shard's top-level entries
+    """
+    return [entry for entry in entries
+            if shard.selects(entry.name.decode(encoding))]
+
+class Scanner:
+    """Scan the file system, matching files against what S3 has
+
+    Directories are fanned out to a pool of scanning threads.  Each
+    directory is read once, and its entries tell us which entries are
+    directories and whether there's an index.html, so we don't need
+    separate isdir and exists calls.
+
+    s3 maps keys to the modification times S3 has (or fingerprints,
+    for generated index.html pages).  Keys of files we find are popped
+    from it, and files that are newer are put, as upload jobs.  Files
+    S3 doesn't have are added to fs, as are index.html pages to be
+    generated, if S3 wasn't listed from an index.  If given, the index
+    gets the times of the files we find, or, when merging with a
+    compact index, of the ones that changed.
+
+    With directory_times (and previous_times, from the last sync), we
+    record directories' modification times and entry counts, and
+    reuse the indexed times of the files in directories that haven't
+    changed, rather than stat them.
+    """
+
+    def __init__(self, s3, fs, put, encoding, threads=1, metrics=None,
+                 index=None, merge_index=False, generate_index_html=False,
+                 had_index=False, invalidate=None, etags=None, shard=None,
+                 directory_times=None, previous_times=None, started=0):
+        self.s3 = s3
+        self.fs = fs
+        self.put = put
+        self.encoding = encoding
+        self.threads = max(threads, 1)
+        self.metrics = metrics
+        self.index = index
+        self.merge_index = merge_index
+        self.generate_index_html = generate_index_html
+        self.had_index = had_index
+        self.invalidate = invalidate
+        self.etags = etags
+        self.shard = shard
+        self.directory_times = directory_times
+        self.previous_times = previous_times or {}
+        self.started = started
+        self.directories = Queue.Queue()
+
+    def scan(self, path, base=''):
+        """Scan a tree, whose keys start with base
+        """
+        scanners = self.start()
+        try:
+            self.directories.put((path, base))
+            self.directories.join()
+        finally:
+            self.stop(scanners)
+
+    def scan_paths(self, src_path, paths):
+        """Scan just the given paths, and the directories containing
+        them, for their index.html pages
+        """
+        scanners = self.start()
+        try:
+            parents = set()
+            for path in paths:
+                fspath = os.path.join(src_path, path)
+                if os.path.isdir(fspath):
+                    self.directories.put((fspath, path))
+                elif os.path.exists(fspath):
+                    try:
+                        stat = os.stat(fspath)
+                    except OSError:
+                        logger.exception("bad file %r" % path)
+                    else:
+                        self.scan_file(
+                            path, int(stat.st_mtime), stat.st_size)
+                parents.add(os.path.dirname(path))
+
+            if self.generate_index_html:
+                for parent in sorted(parents):
+                    if not parent:
+                        continue # no generated page at the top
+                    try:
+                        self.check_index_html(
+                            listdir(os.path.join(src_path, parent)), parent)
+                    except OSError:
+                        pass # removed
+
+            self.directories.join()
+        finally:
+            self.stop(scanners)
+
+    def start(self):
+        return [thread(self.scanner) for i in range(self.threads)]
+
+    def stop(self, scanners):
+        for _ in scanners:
+            self.directories.put((None, None))
+        for t in scanners:
+            t.join()
+
+    def scanner(self):
+        directories = self.directories
+        while 1:
+            path, base = directories.get()
+            try:
+                if path is None:
+                    return
+                self.scan_directory(path, base)
+            except Exception:
+                logger.exception('scanning %r' % base)
+            finally:
+                directories.task_done()
+
+    def scan_directory(self, path, base):
+        entries = listdir(path)
+        unchanged = (self.directory_times is not None and
+                     self.directory_unchanged(path, base, len(entries)))
+        if self.shard is not None and not base:
+            entries = shard_entries(entries, self.shard, self.encoding)
+        self.check_index_html(entries, base, unchanged)
+
+        # Count in bulk, to keep the per-file loop tight.
+        join = os.path.join
+        put_directory = self.directories.put
+        scan_file = self.scan_file
+        subdirectories = pruned = 0
+        for entry in entries:
+            rname = join(base, entry.name)
+            if entry.is_dir():
+                put_directory((entry.path, rname))
+                subdirectories += 1
+            else:
+                mtime = size = None
+                if unchanged:
+                    mtime = self.s3.get(rname.decode(self.encoding))
+                    if isinstance(mtime, basestring) or mtime <= 1:
+                        mtime = None # generated, new or forgotten
+                    else:
+                        pruned += 1
+                if mtime is None:
+                    try:
+                        stat = entry.stat()
+                    except OSError:
+                        logger.exception("bad file %r" % rname)
+                        continue
+                    mtime, size = int(stat.st_mtime), stat.st_size
+
+                scan_file(rname, mtime, size)
+
+        metrics = self.metrics
+        if metrics is not None:
+            metrics.count('directories_scanned')
+            metrics.count('files_scanned', len(entries) - subdirectories)
+            if unchanged:
+                metrics.count('directories_pruned')
+                metrics.count('files_pruned', pruned)
+
+    def directory_unchanged(self, path, base, count):
+        # Remember the directory's time and entry count, and return
+        # whether they're what they were at the last sync.
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            return False
+        if mtime < self.started - 1:
+            # It wasn't changed during the scan (or in the same clock
+            # tick as it started), so we saw all of its changes.
+            self.directory_times[base] = mtime, count
+        return self.previous_times.get(base) == (mtime, count)
+
+    def check_index_html(self, entries, base, unchanged=False):
+        if (self.generate_index_html and base and
+            not [entry for entry in entries if entry.name == INDEX_HTML]):
+            key = base.decode(self.encoding)+'/'+INDEX_HTML
+            if self.had_index:
+                # The index has the fingerprint of the listing we
+                # generated from last time, so we can skip unchanged
+                # directories, and reuse our stat data for the rest.
+                s3mtime = self.s3.pop(key, 0)
+                if unchanged and isinstance(s3mtime, basestring):
+                    # A pruned directory.  Keep its page, rather than
+                    # stat its entries, until the next full scan.
+                    if not self.merge_index:
+                        self.index[key] = s3mtime
+                    return
+                listing = directory_listing(entries)
+                if s3mtime != listing.fingerprint:
+                    self.put((GENERATE, (key, s3mtime, listing), None))
+                elif not self.merge_index:
+                    self.index[key] = s3mtime
+            else:
+                # We don't short circuit by checking s3 here.
+                # We'll do that at the end.
+                self.fs[key] = -1
+
+    def scan_file(self, rname, mtime, size):
+        key = rname.decode(self.encoding)
+        s3 = self.s3
+        index = self.index
+        if key in s3:
+            # We can go ahead and do the check
+            s3mtime = s3.pop(key)
+            if index is not None and not (
+                self.merge_index and mtime == s3mtime):
+                index[key] = mtime
+            if (isinstance(s3mtime, basestring) # generated
+                or mtime > s3mtime):
+                if self.invalidate is not None:
+                    self.invalidate.add(key)
+                self.put((mtime, key, size))
+            elif self.etags:
+                self.etags.pop(key, None)
+        else:
+            if index is not None:
+                index[key] = mtime
+            self.fs[key] = mtime
+
+# Listing big buckets is slow, because S3 returns at most 1000 keys
+# per request.  To list in parallel, we partition the key space using
+# delimiter listings, which return common prefixes.
+
+PARTITION_DEPTH = 3
+
+def partition(bucket, prefix, count, select=None):
+    """Split the key space under a prefix for listing in parallel
+
+    Returns a list, in key order, of keys found while partitioning
+    and of prefixes (strings) that still need to be listed. We
+    expand prefixes until there are at least count of them, or until
+    we've gone PARTITION_DEPTH levels deep.  If select is given, only
+    keys and prefixes whose first path segment (after the prefix) it
+    returns true for are included.
+    """
+    parts = [prefix]
+    for level in range(PARTITION_DEPTH):
+        if len([p for p in parts if isinstance(p, basestring)]) >= count:
+            break
+        expanded = []
+        for part in parts:
+            if isinstance(part, basestring):
+                for item in bucket.list(part, '/'):
+                    if isinstance(item, boto.s3.prefix.Prefix):
+                        item = item.name
+                    if select is not None and not select(
+                        (item if isinstance(item, basestring) else item.name)
+                        [len(prefix):].split(u'/', 1)[0]):
+                        continue
+                    expanded.append(item)
+            else:
+                expanded.append(part)
+        expanded.sort(key=lambda p: p if isinstance(p, basestring) else p.name)
+        if expanded == parts:
+            break
+        parts = expanded
+    return parts
+
+def list_bucket(bucket, prefix, listers=1, ordered=False, select=None):
+    """List the keys under a prefix, using multiple listing threads
+
+    If ordered is true, keys are generated in key order, otherwise,
+    they're generated as they're listed.  If select is given, only
+    keys whose first path segment (after the prefix) it returns true
+    for are listed.
+    """
+    if listers <= 1 and select is None:
+        for key in bucket.list(prefix):
+            yield key
+        return
+
+    end = object()
+    todo = Queue.Queue()
+    results = Queue.Queue(maxsize=9999)
+    parts = []
+    if select is None:
+        partitions = partition(bucket, prefix, listers)
+    else:
+        # Partition at least one level, so we can select top-level
+        # names without listing (or expanding) what we don't want.
+        partitions = partition(bucket, prefix, max(listers, 2), select)
+    for part in partitions:
+        if isinstance(part, basestring):
+            if ordered:
+                # Each partition gets its own (bounded) queue, which we
+                # read in order.
+                results = Queue.Queue(maxsize=9999)
+            todo.put((part, results))
+            parts.append(results)
+        else:
+            parts.append(part)
+
+    def lister():
+        while 1:
+            try:
+                part, results = todo.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                for key in bucket.list(part):
+                    results.put(key)
+                results.put(end)
+            except Exception as v:
+                results.put(v)
+
+    for i in range(min(listers, todo.qsize())):
+        thread(lister)
+
+    def get(results):
+        key = results.get()
+        if isinstance(key, Exception):
+            raise key
+        return key
+
+    if ordered:
+        for part in parts:
+            if isinstance(part, Queue.Queue):
+                for key in iter(lambda: get(part), end):
+                    yield key
+            else:
+                yield part
+    else:
+        # Keys found while partitioning, then keys as they're listed.
+        remaining = 0
+        for part in parts:
+            if isinstance(part, Queue.Queue):
+                remaining += 1
+            else:
+                yield part
+        while remaining:
+            key = get(results)
+            if key is end:
+                remaining -= 1
+            else:
+                yield key
+
 # Sigh, time.  When iterating, boto returns S3 object modification
 # times like this: u'2013-09-24T18:08:20.000Z'. We need to convert it to
 # something we can compare to an of.stat(f).st_mtime and something we
 # can store effeciently, because we'll end up having a lot of them in
 # memory.
 
-# Computing gmt mtimes from timetuples is kind of exciting. :( We'll
-# get gmt-sixtuples and convery them to time values by ignoring DST.
-# Basically, we don't care whether time times are accurate, but only
-# that, if they're wrong, they're wrong by the same abount.
+# Times used to be computed from gmt-sixtuples, by ignoring DST.
+# These are kept for compatibility. We now use seconds since the
+# epoch (see zc.s3staticsync.timestamps).
 
 def parse_time(s):
     date, time = s.split('.')[0].split('T')
@@ -54,35 +643,152 @@ zeros = 0, 0, 0
 def time_time_from_sixtuple(tup):
     return int(time.mktime(tup[:6]+zeros))
 
-def main(args=None):
+def join_items(a, b):
+    """Merge-join 2 iterables of (key, value) items sorted by key
 
-    from os.path import exists, join, dirname, isdir
+    Generate (key, avalue, bvalue) for every key in either iterable,
+    with None for values that are missing. Only one item from each
+    iterable is held at a time.
+    """
+    end = object()
+    a = iter(a)
+    b = iter(b)
+    akey, avalue = next(a, (end, None))
+    bkey, bvalue = next(b, (end, None))
+    while akey is not end or bkey is not end:
+        if bkey is end or (akey is not end and akey < bkey):
+            yield akey, avalue, None
+            akey, avalue = next(a, (end, None))
+        elif akey is end or bkey < akey:
+            yield bkey, None, bvalue
+            bkey, bvalue = next(b, (end, None))
+        else:
+            yield akey, avalue, bvalue
+            akey, avalue = next(a, (end, None))
+            bkey, bvalue = next(b, (end, None))
 
+def main(args=None):
     if args == None:
         args = sys.argv[1:]
         logging.basicConfig()
 
     options, args = parser.parse_args(args)
 
+    if options.engine == 'gevent':
+        from zc.s3staticsync.engine import patch
+        patch()
+
+    if options.plan or options.apply:
+        if options.plan and options.apply:
+            parser.error("--plan and --apply can't be used together")
+        if options.watch or options.shards > 1:
+            parser.error("--plan and --apply can't be used with --watch"
+                         " or --shards")
+
+    if options.server_side_copy and not options.hash_cache:
+        parser.error("--server-side-copy requires --hash-cache")
+
+    paths = None
+    if options.paths:
+        if options.watch or options.shards > 1 or options.apply:
+            parser.error("--paths can't be used with --watch, --shards"
+                         " or --apply")
+        paths = [os.path.normpath(path) for path in options.paths]
+        for path in paths:
+            if (os.path.isabs(path) or path == os.pardir or
+                path.startswith(os.pardir + os.sep)):
+                parser.error("--paths must be relative to, and within,"
+                             " the source directory: %r" % path)
+        if os.curdir in paths:
+            paths = None # The whole tree
+
+    if options.watch:
+        if not options.index:
+            parser.error("--watch requires an index (-i)")
+        if options.shards > 1:
+            parser.error("--watch can't be used with --shards")
+        from zc.s3staticsync.watch import Daemon
+        Daemon(options, args).run()
+    elif options.shards > 1:
+        from zc.s3staticsync.shard import sync_shards
+        sync_shards(options, args)
+    else:
+        sync(options, args, paths)
+
+def sync(options, args, paths=None, shard=None):
+    """Synchronize a directory with S3, once
+
+    If paths (relative file-system paths) are given, only those
+    paths, and the index.html pages of their directories, are
+    synchronized.  With an index, everything else in the index is
+    assumed to be unchanged.  Without one, just the keys under the
+    paths are listed.
+
+    If a shard is given, only the top-level names it selects are
+    synchronized (see zc.s3staticsync.shard).
+    """
+    metrics = Metrics('s3staticsync')
+    # _sync registers functions that stop the threads it starts and
+    # close what it opens.  They're called, most recent first, even
+    # if the sync failed, so a failed sync under --watch doesn't leave
+    # threads running, or files (or the lock) open, for the next one.
+    cleanup = []
+    try:
+        _sync(options, args, paths, shard, metrics, cleanup.append)
+    finally:
+        while cleanup:
+            try:
+                cleanup.pop()()
+            except Exception:
+                logger.exception('cleaning up after a sync')
+        metrics.stop()
+
+def _sync(options, args, paths, shard, metrics, closing):
+    from os.path import exists, join, dirname, isdir
+
     if options.lock_file:
         import zc.lockfile
-        lock = zc.lockfile.LockFile(options.lock_file)
-    else:
-        lock = None
+        closing(zc.lockfile.LockFile(options.lock_file).close)
 
     fudge = options.clock_fudge_factor
     encoding = options.file_system_encoding
     had_index = False
     s3 = {}
     if options.index:
+        # Keep the changes made by an interrupted sync.
+        indexfile.recover(options.index)
         if not options.ignore_index and exists(options.index):
-            with open(options.index) as f:
-                s3 = marshal.load(f)
+            with metrics.phase('load_index'):
+                s3 = indexfile.load(options.index)
+            if isinstance(s3, indexfile.Index):
+                closing(s3.close)
             had_index = True
         index = {}
     else:
         index = None
 
+    # If the old index is compact, we only record changes in the new
+    # index and merge them with the unchanged entries when we're done,
+    # so we don't build a second full dict.
+    merge_index = isinstance(s3, indexfile.Index)
+    compact_index = options.compact_index or merge_index
+
+    if options.apply:
+        # We don't scan, but apply the plan's changes to the index.
+        if had_index:
+            index = dict(s3.iteritems())
+            if merge_index:
+                s3.close()
+        elif index is not None:
+            logger.warning("Not creating an index from a plan")
+            index = None
+        s3 = {}
+        merge_index = False
+        applying = planfile.Plan(options.apply)
+        closing(applying.close)
+    else:
+        applying = None
+
     src_path, bucket_name = args
 
     if '/' in bucket_name:
@@ -92,268 +798,944 @@ def main(args=None):
     len_bucket_prefix = len(bucket_prefix)
 
     fs = {}
-    queue = Queue.Queue(maxsize=999)
-    put = queue.put
 
-    cloudfront = options.cloudfront
-    invalidations = []
+    if options.plan:
+        # Record the changes we'd make, rather than making them.
+        plan = planfile.PlanWriter(options.plan)
+        # If we fail, the plan is closed without being marked
+        # complete, so it can't be applied.
+        closing(plan.file.close)
+        cloudfront = None
+    else:
+        plan = None
+        cloudfront = options.cloudfront
+    invalidate = set() # paths to invalidate once they're updated
+    # Plans record updates, so they can be invalidated when applied.
+    updates = cloudfront or plan is not None
+
+    if index is not None and plan is None:
+        # Completed changes are journaled, so they aren't lost if
+        # we're interrupted before we write the index.
+        journal = indexfile.Journal(options.index + '.journal')
+        closing(journal.close)
+    else:
+        journal = None
+
+    if options.hash_cache:
+        hash_cache = HashCache(options.hash_cache)
+    else:
+        hash_cache = None
+
+    # With server-side copies, files whose content S3 already has are
+    # copied from keys with the same digest.
+    copying = (options.server_side_copy and hash_cache is not None and
+               plan is None and not options.apply)
+    if copying:
+        hash_cache.index_copies()
+    # md5 ETags from the S3 listing, if we list it.  They're dropped
+    # as soon as we know a key won't be uploaded, and when it is.
+    etags = {}
 
     generate_index_html = options.generate_index_html
-    GENERATE = object()
-    INDEX_HTML = "index.html"
 
-    def worker(base_path):
-        mtime = path = 0
+    # Small web files are uploaded ahead of large files, so pages
+    # aren't held up behind archives.
+    hot_extensions = set(
+        ext.strip().lower() for ext in options.hot_extensions.split(',')
+        if ext.strip())
+    hot_paths = options.hot_path
+    bulk_size = options.bulk_size * MB
+
+    # Upload jobs are (mtime, path, size) tuples, with the sizes we
+    # got when scanning, or None if we didn't stat the file then.
+    # Index.html jobs are (GENERATE, args, None).
+
+    def file_size(path):
+        try:
+            return os.stat(join(src_path, path).encode(encoding)).st_size
+        except OSError:
+            return None # Let the worker sort it out.
+
+    def lane(job):
+        if job is None:
+            return 'normal'
+        mtime, path, size = job[:3]
+        if mtime is GENERATE:
+            return 'generated'
+        for pattern in hot_paths:
+            if fnmatch.fnmatch(path, pattern):
+                return 'hot'
+        if size is None:
+            size = file_size(path)
+            if size is None:
+                return 'normal'
+        if size >= bulk_size:
+            return 'bulk'
+        if os.path.splitext(path)[1].lower() in hot_extensions:
+            return 'hot'
+        return 'normal'
+
+    # Jobs beyond --queue-size are spooled to disk, marshaled.
+
+    def encode(job):
+        if job is not None and job[0] is GENERATE:
+            args = job[1]
+            if len(args) > 2:
+                args = args[:2] + (list(args[2]),) # the listing
+            job = (None, args) + job[2:]
+        return job
+
+    def decode(job):
+        if job is not None and job[0] is None:
+            args = job[1]
+            if len(args) > 2:
+                args = args[:2] + (Listing(args[2]),)
+            job = (GENERATE, args) + job[2:]
+        return job
+
+    queue = Scheduler(
+        lane, memory=max(options.queue_size, 1),
+        spool=lambda: Spool(options.spool_directory, encode, decode))
+    closing(queue.close)
+    put = queue.put
+
+    if plan is not None:
+        def put(job):
+            mtime, path, size = job
+            if mtime is GENERATE:
+                plan.generate(*path[:2])
+            else:
+                if size is None:
+                    size = file_size(path) or 0
+                plan.upload(path, mtime, size, path in invalidate)
+                invalidate.discard(path)
+
+    if options.upload_budget is not None:
+        budget = Budget(options.upload_budget * MB)
+    else:
+        budget = None
+
+    if paths is not None and index is not None and not had_index:
+        paths = None # Do a full sync, to build the index.
+
+    if paths is not None:
+        # Only keys under the given paths (and the index.html pages of
+        # their directories) are in scope. Carry the rest of the index
+        # over, as if we'd seen them unchanged.
+        scope = set(path.decode(encoding) for path in paths)
+        if generate_index_html:
+            scope.update(dirname(path) + u'/' + INDEX_HTML
+                         for path in list(scope) if dirname(path))
+
+        if merge_index:
+            # Popped entries are carried over when we write the index.
+            s3.scope(scope)
+        elif had_index:
+            index.update(s3)
+            s3 = dict((key, index.pop(key))
+                      for key in indexfile.under(index, scope))
+        # Without an index, we list just the keys in scope (see list_s3).
+
+    merge_join_mode = options.merge_join and paths is None
+
+    # With --prune-directories, we save directories' modification
+    # times and entry counts, and reuse the indexed times of the files
+    # in directories that haven't changed since the last sync, rather
+    # than stat them.
+    if (options.prune_directories and index is not None and
+        applying is None and not merge_join_mode):
+        pruning = {}
+        if had_index:
+            pruning = indexfile.load_directories(options.index)
+        previous_times = pruning.get('directories', {})
+        if pruning.get('pruned_scans', 0) + 1 >= options.full_scan_every:
+            previous_times = {} # Time for a full scan
+        directory_times = {}
+        scan_started = time.time()
+    else:
+        directory_times = previous_times = scan_started = None
+
+    engine = create_engine(options)
+    sleep = engine.sleep
+
+    # S3 operations are limited by an adaptive limit that drops when
+    # S3 throttles us.  Failed jobs are deferred and requeued, rather
+    # than retried in place.
+    limiter = Limiter(engine.Condition(), engine.concurrency)
+    retries = Retries(queue, limiter, options.retries,
+                      options.retry_delay, options.retry_max_delay, 3)
+    closing(retries.close)
+
+    def defer(job, message):
+        # Called from an exception handler. Return whether the job
+        # was deferred, to be retried later.
+        if retries.defer(job, sys.exc_info()[1]):
+            logger.exception(message + ', retrying')
+            connections.reset()
+            return True
+        return False
+
+    # Large files are uploaded in parts.  Parts are uploaded by a pool
+    # of part threads shared by all large files, while the worker that
+    # started the upload waits for its parts.  This way, a few large
+    # files can't tie up all of the workers' (or more than the part
+    # threads') bandwidth, and a failure only requires a part to be
+    # resent.
+
+    multipart_threshold = options.multipart_threshold * MB
+    parts = Queue.Queue()
+
+    def part_worker():
         while 1:
+            job = parts.get()
+            if job is None:
+                return
+            upload, fspath, part_num, offset, size, results = job
             try:
-                mtime, queued_path = queue.get()
+                md5s = content_md5(fspath, offset, size)
+                # Send the part using this thread's connection
+                upload = copy.copy(upload)
+                upload.bucket = connections.bucket()
+                with open(fspath, 'rb') as fp:
+                    for attempt in itertools.count():
+                        try:
+                            fp.seek(offset)
+                            with metrics.timed('upload_part'):
+                                upload.upload_part_from_file(
+                                    fp, part_num, md5=md5s, size=size)
+                            break
+                        except Exception as v:
+                            delay = retries.backoff(v, attempt)
+                            if delay is None:
+                                raise
+                            logger.exception(
+                                'uploading part %s of %r, retrying'
+                                % (part_num, fspath))
+                            upload.bucket = connections.reset()
+                            time.sleep(delay)
+            except Exception as v:
+                results.put(v)
+            else:
+                results.put(None)
 
-                path = queued_path
-                if path is None:
+    def upload_multipart(key, fspath, size):
+        part_size = max(options.multipart_part_size * MB,
+                        -(-size // MAX_PARTS))
+        content_type = mimetypes.guess_type(fspath)[0]
+        upload = connections.bucket().initiate_multipart_upload(
+            key.key,
+            headers=content_type and {'Content-Type': content_type} or None,
+            )
+        results = Queue.Queue()
+        offsets = range(0, size, part_size)
+        for part_num, offset in enumerate(offsets, 1):
+            parts.put((upload, fspath, part_num, offset,
+                       min(part_size, size - offset), results))
+        errors = [error for error in [engine.get(results)
+                                      for _ in offsets]
+                  if error is not None]
+        metrics.count('parts', len(offsets))
+        if errors:
+            cancel_multipart(upload)
+            raise errors[0]
+        try:
+            with metrics.timed('complete_multipart'):
+                upload.complete_upload()
+        except Exception:
+            exc_info = sys.exc_info()
+            cancel_multipart(upload)
+            raise exc_info[0], exc_info[1], exc_info[2]
+        metrics.count('multipart_uploads')
+
+    def cancel_multipart(upload):
+        # Abort a failed upload, so S3 doesn't keep (and bill for) its
+        # parts.  If we can't, we log it, rather than hide the error
+        # that made us give up.
+        try:
+            upload.cancel_upload()
+        except Exception:
+            logger.exception('aborting multipart upload of %r'
+                             % upload.key_name)
+
+    def copy_key(key, path, fspath, digest):
+        # Copy a file's content from another key with the same digest,
+        # within S3.  Return whether we did.
+        source = hash_cache.copy_source(digest, path)
+        if source is None:
+            return False
+        content_type = (mimetypes.guess_type(fspath)[0] or
+                        boto.s3.key.Key.DefaultContentType)
+        try:
+            with limiter:
+                with metrics.timed('copy'):
+                    copied = connections.bucket().copy_key(
+                        key.key, bucket_name, bucket_prefix + source,
+                        metadata={'Content-Type': content_type})
+        except Exception:
+            logger.exception('copying %r to %r, uploading instead'
+                             % (source, path))
+            connections.reset()
+            return False
+        if copied.etag.strip('"') != digest:
+            # The source changed since we synced it.
+            logger.warning('%r changed, uploading %r instead'
+                           % (source, path))
+            metrics.count('copy_mismatches')
+            return False
+        return True
+
+    # Files are hashed by a pool of hash threads, so hashing doesn't
+    # block the engine (e.g. gevent's hub).  Under gevent, files
+    # uploaded without the hash cache are hashed by them, too.
+
+    hashes = Queue.Queue()
+    hashing = hash_cache is not None or options.engine == 'gevent'
+
+    def hash_worker():
+        while 1:
+            job = hashes.get()
+            if job is None:
+                return
+            path, results = job
+            try:
+                results.put(md5(path))
+            except Exception as v:
+                results.put(v)
+
+    def content_digest(path):
+        results = Queue.Queue()
+        hashes.put((path, results))
+        digest = engine.get(results)
+        if isinstance(digest, Exception):
+            raise digest
+        metrics.count('files_hashed')
+        return digest
+
+    # Deletes are batched and sent with multi-object delete requests
+    # by their own threads, so they don't hold up uploads.
+
+    deletes = Queue.Queue()
+    if plan is not None:
+        delete = plan.delete
+    elif copying:
+        # Keys being deleted may be copied from, so they're deleted
+        # after uploads (and copies) are done.
+        held_deletes = []
+        delete = held_deletes.append
+    else:
+        delete = deletes.put
+
+    def delete_worker():
+        while 1:
+            path = deletes.get()
+            if path is None:
+                deletes.task_done()
+                return
+            # Take whatever else is waiting, up to a full batch.
+            batch = [path]
+            while len(batch) < MAX_DELETES:
+                try:
+                    path = deletes.get_nowait()
+                except Queue.Empty:
+                    break
+                if path is None: # Save it for another worker
+                    deletes.task_done()
+                    deletes.put(None)
+                    break
+                batch.append(path)
+
+            try:
+                delete_batch(batch)
+            finally:
+                for path in batch:
+                    deletes.task_done()
+
+    def delete_batch(batch):
+        names = dict((bucket_prefix + path, path) for path in batch)
+        failed = []
+        try:
+            for attempt in itertools.count():
+                try:
+                    with metrics.timed('delete_keys'):
+                        result = connections.bucket().delete_keys(
+                            sorted(names), quiet=True)
+                    break
+                except Exception as v:
+                    delay = retries.backoff(v, attempt)
+                    if delay is None:
+                        raise
+                    logger.exception('deleting %s keys, retrying'
+                                     % len(batch))
+                    connections.reset()
+                    time.sleep(delay)
+            for error in result.errors:
+                logger.error("deleting %r failed: %s %s"
+                             % (error.key, error.code, error.message))
+                failed.append(names[error.key])
+            metrics.count('deletes', len(batch) - len(failed))
+        except Exception:
+            logger.exception('deleting %s keys' % len(batch))
+            failed = batch
+
+        for path in set(batch).difference(failed):
+            if hash_cache is not None:
+                hash_cache.discard(path)
+            if cloudfront:
+                planner.add(path)
+            journaled(path, None)
+            applied(path)
+
+        if index is not None:
+            # Failed to delete. Put the keys back so we try again
+            # later
+            for path in failed:
+                index[path] = 1
+
+    same_second_lock = engine.Lock()
+
+    def journaled(path, value):
+        # S3 was changed. A value of None means the path was deleted.
+        if journal is not None:
+            journal.record(path, value)
+
+    def applied(path):
+        # A change from the plan we're applying was made.
+        if applying is not None:
+            applying.completed(path)
+
+    def forget(path):
+        # A file wasn't uploaded. Remove it from the index so we try
+        # again later (if the path is still around).
+        if index is not None:
+            if path in invalidate:
+                # An update, which we'll need to invalidate when it
+                # succeeds.
+                index[path] = 1
+            else:
+                index.pop(path)
+
+    def process(job):
+        mtime = path = 0
+        deferred = False
+        try:
+            mtime, queued_path = job[:2]
+
+            path = queued_path
+            key = boto.s3.key.Key(connections.bucket())
+
+            if mtime is GENERATE:
+                # The listing is passed if the scan computed it.
+                (path, s3mtime), listing = path[:2], path[2:]
+                fspath = join(src_path, path.encode(encoding))
+                if exists(fspath):
+                    # Someone created a file since we decided to
+                    # generate one.
+                    applied(path)
                     return
 
-                key = boto.s3.key.Key(bucket)
+                if listing:
+                    [listing] = listing
+                else:
+                    listing = directory_listing(listdir(dirname(fspath)))
 
-                if mtime is None: # delete
+                digest = listing.fingerprint
+                if digest != s3mtime:
+                    # Note that s3mtime is either a previous
+                    # fingerprint or it's 0 (cus path wasn't in s3) or
+                    # it's an s3 upload time.  The test above
+                    # works in all of these cases.
+                    body, size, md5s = index_html_body(
+                        path[:-len(INDEX_HTML)-1], listing, encoding)
+                    key.key = bucket_prefix + path
+                    key.set_metadata('generated', 'true')
                     try:
-                        try:
-                            key.key = bucket_prefix + path
-                            key.delete()
-                        except Exception:
-                            logger.exception('deleting %r, retrying' % key.key)
-                            time.sleep(9)
-                            key.key = bucket_prefix + path
-                            key.delete()
+                        with limiter:
+                            with metrics.timed('put_generated'):
+                                key.set_contents_from_file(
+                                    body,
+                                    headers={'Content-Type': 'text/html'},
+                                    md5=md5s, size=size,
+                                    )
                     except Exception:
-                        if index is not None:
-                            # Failed to delete. Put the key back so we
-                            # try again later
-                            index[queued_path] = 1
+                        if defer(job, 'uploading generated %r' % path):
+                            deferred = True
+                            return
                         raise
+                    metrics.count('generates')
 
-                elif mtime is GENERATE:
-                    (path, s3mtime) = path
-                    fspath = join(base_path, path.encode(encoding))
-                    if exists(fspath):
-                        # Someone created a file since we decided to
-                        # generate one.
-                        continue
+                    if s3mtime:
+                        # update (if it was add, mtime would be 0)
+                        if cloudfront:
+                            planner.add(path)
 
-                    fspath = dirname(fspath)
-                    data = "Index of "+path[:-len(INDEX_HTML)-1]
-                    data = [
-                        "<!-- generated -->",
-                        "<html><head><title>%s</title></head><body>" % data,
-                        "<h1>%s</h1><table>" % data,
-                        "<tr><th>Name</th><th>Last modified</th><th>Size</th>"
-                        "</tr>",
-                        ]
-                    for name in sorted(os.listdir(fspath)):
-                        if name.startswith('.'):
-                            continue # don't index dot files
-                        name_path = join(fspath, name)
-                        if isdir(name_path):
-                            name = name + '/'
-                            size = '-'
-                        else:
-                            size = os.stat(name_path).st_size
-                        mtime = time.ctime(os.stat(name_path).st_mtime)
-                        name = name.decode(encoding)
-                        data.append(
-                            '<tr><td><a href="%s">%s</a></td>\n'
-                            '    <td>%s</td><td>%s</td></tr>'
-                            % (name, name, mtime, size))
-                    data.append("</table></body></html>\n")
-                    data = '\n'.join(data)
-
-                    digest = hashlib.md5(data.encode(encoding)).hexdigest()
-                    if digest != s3mtime:
-                        # Note that s3mtime is either a previous
-                        # digest or it's 0 (cus path wasn't in s3) or
-                        # it's an s3 upload time.  The test above
-                        # works in all of these cases.
-                        key.key = bucket_prefix + path
-                        key.set_metadata('generated', 'true')
-                        try:
-                            key.set_contents_from_string(
-                                data,
-                                headers={'Content-Type': 'text/html'},
-                                )
-                        except Exception:
-                            logger.exception('uploading generated %r, retrying'
-                                             % path)
-                            time.sleep(9)
-                            key.set_contents_from_string(
-                                data,
-                                headers={'Content-Type': 'text/html'},
-                                )
+                if index is not None:
+                    index[path] = digest
+                journaled(path, digest)
+                applied(path)
 
-                        if s3mtime:
-                            # update (if it was add, mtime would be 0)
-                            if cloudfront:
-                                invalidations.append(path)
+            else: # upload
+                charged = 0 # bytes taken from the budget
+                try:
+                    if had_index:
+                        # We only store mtimes to the nearest second.
+                        # We don't have a fudge factor, so there's a
+                        # chance that someone might update the file in
+                        # the same second, so we check if a second has
+                        # passed and sleep if it hasn't.  (We hold a
+                        # lock so workers don't all sleep.)
+                        with same_second_lock:
+                            if not int(time.time()) > mtime:
+                                sleep(1)
 
-                    if index is not None:
-                        index[path] = digest
+                    key.key = bucket_prefix + path
+                    path = join(src_path, path)
+                    stat = os.stat(path.encode(encoding))
+                    size = stat.st_size
+                    md5s = None
+                    etag = etags.pop(queued_path, None)
+                    if hash_cache is not None:
+                        sig = signature(stat)
+                        digest = hash_cache.digest(queued_path, sig)
+                        if digest is None and copying:
+                            # A moved file keeps its signature.
+                            digest = hash_cache.signature_digest(
+                                sig, queued_path)
+                        if digest is None:
+                            digest = content_digest(path.encode(encoding))
+                        if digest == (etag or hash_cache.synced(queued_path)):
+                            # Only the time changed.
+                            hash_cache.set(queued_path, sig, digest)
+                            invalidate.discard(queued_path)
+                            metrics.count('unchanged')
+                            journaled(queued_path, mtime)
+                            applied(queued_path)
+                            return
+                        # Save boto from computing it again.
+                        md5s = digest, base64.b64encode(
+                            binascii.unhexlify(digest))
 
-                else: # upload
-                    try:
-                        if had_index:
-                            # We only store mtimes to the nearest second.
-                            # We don't have a fudge factor, so there's a
-                            # chance that someone might update the file in
-                            # the same second, so we check if a second has
-                            # passed and sleep if it hasn't.
-                            now = time_time_from_sixtuple(
-                                time.gmtime(time.time()))
-                            if not now > mtime:
-                                time.sleep(1)
-
-                        key.key = bucket_prefix + path
-                        path = join(base_path, path)
+                        if (copying and size <= MAX_COPY_SIZE and
+                            copy_key(key, queued_path, path, digest)):
+                            metrics.count('copies')
+                            metrics.count('bytes_copied', size)
+                            hash_cache.set(queued_path, sig, digest)
+                            if queued_path in invalidate:
+                                invalidate.discard(queued_path)
+                                planner.add(queued_path)
+                            journaled(queued_path, mtime)
+                            applied(queued_path)
+                            return
+
+                    if budget is not None:
+                        if not budget.take(size):
+                            # Leave it for a later run.
+                            forget(queued_path)
+                            metrics.count('over_budget')
+                            return
+                        charged = size
+
+                    if size > multipart_threshold:
+                        # Parts are retried individually.
+                        with limiter:
+                            upload_multipart(key, path.encode(encoding), size)
+                    else:
+                        if md5s is None and hashing:
+                            # Not in a greenlet, which would block the
+                            # hub for as long as the file takes to hash.
+                            digest = content_digest(path.encode(encoding))
+                            md5s = digest, base64.b64encode(
+                                binascii.unhexlify(digest))
+                        elif md5s is None:
+                            # Computed from a map of the file, rather
+                            # than by boto reading it an extra time.
+                            md5s = content_md5(path.encode(encoding))
+                        key.BufferSize = UPLOAD_BUFFER_SIZE
                         try:
-                            key.set_contents_from_filename(
-                                path.encode(encoding))
+                            with limiter:
+                                with metrics.timed('put'):
+                                    key.set_contents_from_filename(
+                                        path.encode(encoding), md5=md5s)
                         except Exception:
-                            logger.exception('uploading %r %r, retrying'
-                                             % (mtime, path))
-                            time.sleep(9)
-                            key.set_contents_from_filename(
-                                path.encode(encoding))
+                            if charged:
+                                # Give it back before the job is
+                                # requeued, as the retry takes it again.
+                                budget.give(charged)
+                                charged = 0
+                            if defer(job, 'uploading %r %r' % (mtime, path)):
+                                deferred = True
+                                if etag is not None:
+                                    etags[queued_path] = etag
+                                return
+                            raise
+                    metrics.count('puts')
+                    metrics.count('bytes_uploaded', size)
+                    if hash_cache is not None:
+                        hash_cache.set(queued_path, sig, digest)
+                    if queued_path in invalidate:
+                        # Done with it, so we don't hold every update.
+                        invalidate.discard(queued_path)
+                        planner.add(queued_path)
+                    journaled(queued_path, mtime)
+                    applied(queued_path)
 
-                    except Exception:
-                        if index is not None:
-                            # Upload failed. Remove from index so we
-                            # try again later (if the path is still
-                            # around).
-                            index.pop(queued_path)
-                        raise
+                except Exception:
+                    # Upload failed.
+                    forget(queued_path)
+                    if charged:
+                        budget.give(charged)
+                    raise
 
-            except Exception:
-                logger.exception('processing %r %r' % (mtime, path))
-            finally:
+        except Exception:
+            logger.exception('processing %r %r' % (mtime, path))
+        finally:
+            if not deferred:
                 queue.task_done()
 
-    workers = [thread(worker, src_path)
-               for i in range(options.worker_threads)]
+    s3conn = boto.s3.connection.S3Connection()
+    bucket = s3conn.get_bucket(bucket_name)
+    # Workers use their own connections. Set them up before starting
+    # workers, as jobs may be queued as soon as we start scanning.
+    connections = ConnectionPool(bucket_name, engine.local())
+
+    if cloudfront and shard is not None:
+        # The coordinator submits invalidations for all of the shards.
+        planner = Recorder(shard.invalidations)
+    elif cloudfront:
+        # Invalidations are submitted as updates and deletes complete.
+        planner = Planner(
+            boto.connect_cloudfront(), cloudfront, bucket_prefix,
+            retries, metrics, options.invalidation_wildcard,
+            options.invalidation_interval)
+    if cloudfront:
+        closing(planner.close)
+
+    def stopping(workers, queue):
+        # Stop threads that exit when they get None from their queue.
+        def stop():
+            for _ in workers:
+                queue.put(None)
+            for w in workers:
+                w.join()
+        closing(stop)
+
+    engine.start(queue, metrics.worker(process, engine.worker_name))
+    closing(lambda: engine.stop(queue))
+    metrics.sample(queue)
+    stopping([thread(part_worker)
+              for i in range(options.multipart_threads)], parts)
+    stopping([thread(delete_worker)
+              for i in range(max(options.delete_threads, 1))], deletes)
+    if hashing:
+        stopping([thread(hash_worker)
+                  for i in range(max(options.hash_threads, 1))], hashes)
 
     # As we build up the 2 dicts, we try to identify cases we can
     # eliminate right away, or cases we can begin handling, so we can
     # avoid accumulating them, and also so we can start processing
     # sooner.
 
+    scanner = Scanner(
+        s3, fs, put, encoding, options.scan_threads, metrics,
+        index=index, merge_index=merge_index,
+        generate_index_html=generate_index_html, had_index=had_index,
+        invalidate=invalidate if updates else None, etags=etags,
+        shard=shard, directory_times=directory_times,
+        previous_times=previous_times, started=scan_started)
+
     def listfs(path, base):
-        for name in sorted(os.listdir(path)):
-            pname = join(path, name)
-            rname = join(base, name)
-            if isdir(pname):
-                listfs(pname, rname)
-                if generate_index_html and not exists(join(pname, INDEX_HTML)):
-                    key = rname.decode(encoding)+'/'+INDEX_HTML
-                    # We don't short circuit by checking s3 here.
-                    # We'll do that at the end.
-                    fs[key] = -1
+        with metrics.phase('scan'):
+            scanner.scan(path, base)
+
+    def listpaths(paths):
+        with metrics.phase('scan'):
+            scanner.scan_paths(src_path, paths)
+
+    # When merge-joining, we generate both sides sorted in S3 key
+    # order and compare them as we go, without building dicts.
+
+    def walkfs(path, base):
+        # Keys are compared as whole paths, so directories sort as if
+        # their names ended with '/'.
+        entries = []
+        dir_entries = listdir(path)
+        if shard is not None and not base:
+            dir_entries = shard_entries(dir_entries, shard, encoding)
+        for entry in dir_entries:
+            is_dir = entry.is_dir()
+            name = entry.name.decode(encoding)
+            entries.append((name + u'/' if is_dir else name, entry, is_dir))
+
+        if (generate_index_html and base and
+            not [entry for entry in entries if entry[0] == INDEX_HTML]):
+            entries.append((INDEX_HTML, None, False))
+        entries.sort(key=lambda entry: entry[0])
+
+        for name, entry, is_dir in entries:
+            if entry is None:
+                yield (base.decode(encoding)+'/'+INDEX_HTML,
+                       directory_listing(dir_entries))
+                continue
+
+            rname = join(base, entry.name)
+            if is_dir:
+                for item in walkfs(entry.path, rname):
+                    yield item
             else:
                 try:
-                    mtime = time_time_from_sixtuple(
-                        time.gmtime(os.stat(pname).st_mtime))
+                    stat = entry.stat()
                 except OSError:
                     logger.exception("bad file %r" % rname)
                     continue
+                yield rname.decode(encoding), (int(stat.st_mtime),
+                                               stat.st_size)
 
-                key = rname.decode(encoding)
-                if index is not None:
-                    index[key] = mtime
-                if key in s3:
-                    # We can go ahead and do the check
-                    s3mtime = s3.pop(key)
-                    if (isinstance(s3mtime, basestring) # generated
-                        or mtime > s3mtime):
-                        put((mtime, key))
-                        if cloudfront:
-                            invalidations.append(key)
-                else:
-                    fs[key] = mtime
+    def list_scope():
+        # List the keys at or below the paths in scope, rather than
+        # the whole bucket.  Paths below other paths are covered by
+        # the others' listings.
+        for path in sorted(scope):
+            if [other for other in scope if path.startswith(other + u'/')]:
+                continue
+            name = bucket_prefix + path
+            for key in bucket.list(name, '/'):
+                if (not isinstance(key, boto.s3.prefix.Prefix) and
+                    key.key == name):
+                    yield key
+            for key in list_bucket(bucket, name + u'/', options.s3_listers):
+                yield key
 
-    fs_thread = thread(listfs, src_path, '')
+    def list_s3(ordered=False):
+        if paths is not None:
+            keys = list_scope()
+        else:
+            keys = list_bucket(
+                bucket, bucket_prefix, options.s3_listers, ordered,
+                shard.selects if shard is not None else None)
+        for key in metrics.counted('keys_listed', keys):
 
-    s3conn = boto.s3.connection.S3Connection()
-    bucket = s3conn.get_bucket(bucket_name)
+            s3mtime = s3_time(key.last_modified)
 
-    if not had_index:
-        @thread
-        def s3_thread():
-            for key in bucket.list(bucket_prefix):
+            # subtract a fudge factor to account for crappy clocks and bias
+            # caused by delat between start of upload and
+            # computation of last_modified.
+            s3mtime -= fudge
 
-                s3mtime = time_time_from_sixtuple(parse_time(key.last_modified))
+            path = key.key[len_bucket_prefix:]
+            if hash_cache is not None and '-' not in key.etag:
+                # Not multipart, so the ETag is an md5
+                etags[path] = key.etag.strip('"')
 
-                # subtract a fudge factor to account for crappy clocks and bias
-                # caused by delat between start of upload and
-                # computation of last_modified.
-                s3mtime -= fudge
+            yield path, s3mtime
 
+    def merge_join():
+        if not had_index:
+            s3_items = list_s3(ordered=True)
+        elif merge_index:
+            s3_items = s3.iteritems()
+        else:
+            s3_items = indexfile.sorted_items(s3)
 
-                path = key.key[len_bucket_prefix:]
+        for path, value, s3mtime in join_items(walkfs(src_path, ''), s3_items):
+            # We only keep the ETags of files we upload, so they
+            # don't accumulate as we list.
+            etag = etags.pop(path, None)
+            if value is None:
+                if not options.no_delete:
+                    delete(path)
+                continue
 
-                if path in fs:
-                    mtime = fs.pop(path)
-                    if mtime > s3mtime:
-                        put((mtime, path))
-                        if cloudfront:
-                            invalidations.append(path)
-                    elif mtime == -1:
-                        # generate marker. Put it back.
-                        fs[path] = -1
+            if merge_index and s3mtime is not None:
+                s3.pop(path) # mark as seen
+
+            if isinstance(value, Listing):
+                if s3mtime != value.fingerprint:
+                    put((GENERATE, (path, s3mtime or 0, value), None))
+                elif index is not None and not merge_index:
+                    index[path] = s3mtime
+                continue
+
+            mtime, size = value
+            if index is not None and not (merge_index and mtime == s3mtime):
+                index[path] = mtime
+
+            if s3mtime is None:
+                put((mtime, path, size))
+            elif isinstance(s3mtime, basestring) or mtime > s3mtime:
+                if updates:
+                    invalidate.add(path)
+                if etag is not None:
+                    etags[path] = etag
+                put((mtime, path, size))
+
+    def apply_plan():
+        # Queue the plan's changes, until we run out of budget.
+        ops = nbytes = 0
+        for record in applying:
+            kind, path = record[:2]
+            size = record[3] if kind == planfile.UPLOAD else 0
+            if ((options.max_ops is not None and ops >= options.max_ops) or
+                (options.max_bytes is not None and
+                 nbytes + size > options.max_bytes)):
+                metrics.count('plan_deferred')
+                continue
+            ops += 1
+            nbytes += size
+
+            if kind == planfile.UPLOAD:
+                mtime, update = record[2], record[4]
+                if index is not None:
+                    index[path] = mtime
+                if update and cloudfront:
+                    invalidate.add(path)
+                put((mtime, path, size))
+            elif kind == planfile.GENERATE:
+                put((GENERATE, (path, record[2]), None))
+            else:
+                if index is not None:
+                    index.pop(path, None)
+                delete(path)
+
+    if paths is not None:
+        fs_thread = thread(listpaths, paths)
+    elif not merge_join_mode and applying is None:
+        fs_thread = thread(listfs, src_path, '')
+
+    if applying is not None:
+        with metrics.phase('apply'):
+            apply_plan()
+    elif merge_join_mode:
+        with metrics.phase('merge_join'):
+            merge_join()
+    else:
+        if not had_index:
+            @thread
+            def s3_thread():
+                with metrics.phase('list_s3'):
+                    for path, s3mtime in list_s3():
+                        if path in fs:
+                            mtime = fs.pop(path)
+                            if mtime > s3mtime:
+                                if updates:
+                                    invalidate.add(path)
+                                put((mtime, path, None))
+                                continue
+                            etags.pop(path, None)
+                            if mtime == -1:
+                                # generate marker. Put it back, and remember
+                                # the s3 time so an existing generated page
+                                # is treated as an update.
+                                fs[path] = -1
+                                s3[path] = s3mtime
+                        else:
+                            s3[path] = s3mtime
+
+            s3_thread.join()
+
+        fs_thread.join()
+
+        with metrics.phase('diff'):
+            for (path, mtime) in fs.iteritems():
+                s3mtime = s3.pop(path, 0)
+                if mtime == -1 or mtime <= s3mtime:
+                    etags.pop(path, None)
+                if mtime == -1:
+                    # We generate unconditionally, because the content
+                    # is dynamic.  We pass along the old s3mtime, which
+                    # might be an old digest to see if we actually have
+                    # to update s3.
+                    put((GENERATE, (path, s3mtime), None))
                 else:
-                    s3[path] = s3mtime
+                    if mtime > s3mtime:
+                        if s3mtime:
+                            # update (if it was add, mtime would be 0)
+                            if updates:
+                                invalidate.add(path)
 
-        s3_thread.join()
+                        put((mtime, path, None))
 
-    fs_thread.join()
+            for path in s3:
+                etags.pop(path, None)
+                if not options.no_delete:
+                    delete(path)
 
-    for (path, mtime) in fs.iteritems():
-        s3mtime = s3.pop(path, 0)
-        if mtime == -1:
-            # We generate unconditionally, because the content
-            # is dynamic.  We pass along the old s3mtime, which might
-            # be an old digest to see if we actually have to update s3.
-            put((GENERATE, (path, s3mtime)))
+    with metrics.phase('drain'):
+        queue.join()
+        if copying:
+            for path in held_deletes:
+                deletes.put(path)
+        deletes.join()
+
+    if journal is not None:
+        journal.flush()
+
+    def write_index():
+        if compact_index:
+            items = indexfile.sorted_items(index)
+            if merge_index:
+                # Entries we saw (popped) and didn't change
+                items = indexfile.merge(
+                    s3.iteritems(popped=True, encoded=True), items)
+            with indexfile.replacing(options.index) as tmp:
+                indexfile.write(tmp, items)
+            if merge_index:
+                s3.close()
         else:
-            if mtime > s3mtime:
-                put((mtime, path))
+            indexfile.save(options.index, index)
+        if journal is not None:
+            journal.close(remove=True)
 
-                if s3mtime:
-                    # update (if it was add, mtime would be 0)
-                    if cloudfront:
-                        invalidations.append(path)
+    def save_directory_times():
+        if paths is None:
+            times = directory_times
+            if previous_times:
+                pruned_scans = pruning.get('pruned_scans', 0) + 1
+            else:
+                pruned_scans = 0
+        else:
+            # We only scanned some directories.
+            times = pruning.get('directories', {})
+            times.update(directory_times)
+            pruned_scans = pruning.get('pruned_scans', 0)
+        indexfile.save_directories(options.index, dict(
+            pruned_scans=pruned_scans, directories=times))
 
-    if not options.no_delete:
-        for path in s3:
-            put((None, path))
-            if cloudfront:
-                invalidations.append(path)
+    if plan is not None:
+        plan.close()
+        if merge_index:
+            s3.close()
+        logger.info("Planned %s" % plan.counts)
+        metrics.count('planned_uploads', plan.counts[planfile.UPLOAD])
+        metrics.count('planned_bytes', plan.counts['bytes'])
+        metrics.count('planned_generates', plan.counts[planfile.GENERATE])
+        metrics.count('planned_deletes', plan.counts[planfile.DELETE])
+    elif index is not None:
+        with metrics.phase('write_index'):
+            write_index()
+            if directory_times is not None:
+                save_directory_times()
 
-    queue.join()
+    if applying is not None:
+        applying.close()
 
-    if index is not None:
-        with open(options.index, 'w') as f:
-            marshal.dump(index, f)
+    if hash_cache is not None:
+        hash_cache.save()
 
     if cloudfront:
-        cfconn = boto.connect_cloudfront()
-        time.sleep(9) # give a little extra type for the s3 updates to propigate
-        for start in range(0, len(invalidations), 1000):
-            cfconn.create_invalidation_request(
-                cloudfront,
-                [bucket_prefix+p for p in invalidations[start:start+1000]])
-
-    if lock is not None:
-        lock.close()
-
-    for _ in workers:
-        put((None, None))
-    for w in workers:
-        w.join()
+        with metrics.phase('cloudfront'):
+            planner.close()
+
+    logger.info("S3 connections: %(connections)s, reused: %(reuses)s,"
+                " reset: %(resets)s, expired: %(expired)s"
+                % connections.stats())
+    if retries.retried or limiter.throttles:
+        logger.info("Retried %s S3 operations, throttled %s times"
+                    % (retries.retried, limiter.throttles))
+
+    if queue.spooled:
+        metrics.count('jobs_spooled', queue.spooled)
+    metrics.count('retries', retries.retried)
+    metrics.count('throttles', limiter.throttles)
+    metrics.write(options.metrics_json, options.metrics_prometheus)
 
 if __name__ == '__main__':
     main()
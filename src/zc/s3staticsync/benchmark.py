@@ -0,0 +1,719 @@
+"""usage: %prog [options] [scenario ...]
+
+Benchmarks
+
+Generate a synthetic tree and sync it to (and restore it from) a local
+S3 stand-in, with simulated latency and throttling, reporting wall
+time, peak RSS, system calls, S3 requests and phase timings for each
+scenario:
+
+cold
+    Sync to an empty bucket
+
+noop
+    Sync again, listing the bucket
+
+noop-index
+    Sync again, using the index
+
+delta
+    Sync after changing some files (--delta), using the index
+
+restore
+    Restore the bucket to an empty directory
+
+scan
+    Scan the tree with sync's scanner, with and without collecting
+    metrics, to measure their overhead (without S3)
+
+listfs
+    Scan the tree and match its files against a listing of the
+    bucket, as if the tree had been synced, with sync's scanner,
+    using a pool of threads (--scan-threads), and the way it used
+    to, recursively, with listdir, isdir, exists and stat calls and
+    gmt-sixtuple time conversions, to measure the speedup (without
+    S3).  Use a large tree (e.g. -n 1000000) to see how the scans
+    scale.
+
+times
+    Convert S3 and file times for as many files as the tree has, as
+    sync does, and the way it used to, to measure the speedup
+    (without S3)
+
+index
+    Load an index, look up entries in it and merge changes into it,
+    as sync does, in both the marshal and compact formats, each in
+    its own process, to compare their times and memory use (without
+    S3).  Indexes have as many entries as the tree has files, or
+    --index-entries (e.g. 1000000 or 5000000).
+
+io
+    Read and hash the tree's files, and render and hash index.html
+    pages for its directories, as upload workers do, and the way boto
+    did before we passed it md5s, to measure the speedup (without S3)
+
+The S3 scenarios run in the order above, after the cold sync, even if
+it isn't requested.  Each sync and restore runs
+in its own process.  Pass sync options (e.g. -C, -E gevent, or -S 8)
+with -o, and restore options with -R.  Use --results and --label to
+store results, so runs with different options or versions of the
+software can be compared.
+"""
+
+import boto.utils
+import json
+import logging
+import marshal
+import optparse
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import StringIO
+import time
+from zc.s3staticsync import Scanner, UPLOAD_BUFFER_SIZE, directory_listing
+from zc.s3staticsync import index as indexfile
+from zc.s3staticsync import index_html_body, listdir, render_index_html
+from zc.s3staticsync import parse_time, time_time_from_sixtuple
+from zc.s3staticsync.hashcache import content_md5
+from zc.s3staticsync.metrics import Metrics
+from zc.s3staticsync.s3server import Server, boto_config
+from zc.s3staticsync.timestamps import s3_time
+
+SCENARIOS = ('cold', 'noop', 'noop-index', 'delta', 'restore', 'scan',
+             'listfs', 'times', 'index', 'io')
+# scenarios that don't use S3
+LOCAL = 'scan', 'listfs', 'times', 'index', 'io'
+INDEX_LOOKUPS = 100000 # most entries looked up, for the index scenario
+ENCODING = 'latin-1' # sync's default file-system encoding
+
+parser = optparse.OptionParser(usage=__doc__)
+parser.add_option('-n', '--files', type='int', default=10000,
+                  help="Number of files in the synthetic tree.")
+parser.add_option('--depth', type='int', default=2,
+                  help="Depth of the directory tree.")
+parser.add_option('--fanout', type='int', default=10,
+                  help="Number of subdirectories per directory.")
+parser.add_option('--sizes', default='1024:90,65536:9,1048576:1',
+                  help="A mix of file sizes, as comma-separated"
+                  " size:weight pairs.")
+parser.add_option('--max-age', type='float', default=30,
+                  help="Files are given random modification times, up to"
+                  " this many days old (and at least an hour old).")
+parser.add_option('--delta', type='float', default=1,
+                  help="Percentage of files changed for the delta scenario.")
+parser.add_option('--seed', type='int', default=0,
+                  help="Seed for generating trees and throttling.")
+parser.add_option('--latency', type='float', default=.01,
+                  help="Seconds added to each S3 request.")
+parser.add_option('--throttle', type='float', default=0,
+                  help="Fraction of S3 requests that are throttled.")
+parser.add_option('-o', '--option', action='append', default=[],
+                  dest='sync_options',
+                  help="An option to pass to the sync script."
+                  " Can be repeated.")
+parser.add_option('-R', '--restore-option', action='append', default=[],
+                  dest='restore_options',
+                  help="An option to pass to the restore script."
+                  " Can be repeated.")
+parser.add_option('--scan-threads', type='int', default=4,
+                  help="Number of threads scanning the tree, for the"
+                  " listfs scenario.")
+parser.add_option('--index-entries', type='int',
+                  help="Number of entries in the indexes, for the index"
+                  " scenario.  Defaults to the number of files.")
+parser.add_option('-r', '--repeat', type='int', default=3,
+                  help="Number of times to scan, for the scan and listfs"
+                  " scenarios,"
+                  " to convert times, for the times scenario, and to"
+                  " read files, for the io scenario."
+                  " The best time is reported.")
+parser.add_option('--strace', action='store_true',
+                  help="Count all system calls, using strace.  By default,"
+                  " only read and write calls are counted (on Linux).")
+parser.add_option('-d', '--directory',
+                  help="Where to create the tree (a temporary directory"
+                  " by default).")
+parser.add_option('--results',
+                  help="A JSON file to append results to.")
+parser.add_option('--label', default='',
+                  help="A label for stored results, such as a version.")
+parser.add_option('--compare',
+                  help="Compare with the last stored results with this"
+                  " label.")
+
+def parse_sizes(sizes):
+    pairs = [pair.split(':') for pair in sizes.split(',')]
+    return [(int(size), float(weight)) for size, weight in pairs]
+
+def make_tree(path, files, depth=2, fanout=10, sizes=((1024, 1),),
+              max_age=30, seed=0):
+    """Create a synthetic tree, returning the relative file paths
+
+    Files are spread over the leaf directories of a tree with the
+    given depth and fan-out.  Each file starts with its path, so
+    contents differ, and is padded (sparsely) to a size chosen from
+    weighted (size, weight) pairs.
+    """
+    generator = random.Random(seed)
+    total = sum(weight for _, weight in sizes)
+    now = time.time()
+    paths = []
+    for i in range(files):
+        rname = tree_path(i, depth, fanout)
+        fspath = os.path.join(path, rname)
+        dirpath = os.path.dirname(fspath)
+        if not os.path.exists(dirpath):
+            os.makedirs(dirpath)
+
+        choice = generator.uniform(0, total)
+        for size, weight in sizes:
+            choice -= weight
+            if choice <= 0:
+                break
+        with open(fspath, 'wb') as f:
+            f.write((rname + '\n')[:size])
+            f.truncate(size)
+        mtime = now - generator.uniform(3600, max(max_age * 86400, 3600))
+        os.utime(fspath, (mtime, mtime))
+        paths.append(rname)
+    return paths
+
+def tree_path(i, depth, fanout):
+    # The relative path of the ith file of a synthetic tree
+    leaf = i % (fanout ** depth)
+    parts = []
+    for level in range(depth):
+        parts.append('d%s' % (leaf % fanout))
+        leaf //= fanout
+    return os.path.join(*(parts + ['f%s' % i]))
+
+def s3_listing(path, legacy=False):
+    """Return the times S3 has for a tree's files, after syncing them
+
+    Times are as sync gets them from a listing (or index), or, if
+    legacy is true, as it used to.
+    """
+    listing = {}
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in filenames:
+            fspath = os.path.join(dirpath, name)
+            mtime = os.stat(fspath).st_mtime
+            if legacy:
+                mtime = time_time_from_sixtuple(time.gmtime(mtime))
+            listing[os.path.relpath(fspath, path).decode(ENCODING)] = int(
+                mtime)
+    return listing
+
+def scan(path, threads=1, metrics=None, s3=()):
+    """Scan a tree with sync's scanner, returning the number of files
+
+    Files are matched against s3, a listing of what S3 has, and
+    recorded in an index, and index.html pages are checked for, as
+    sync does.
+    """
+    index = {}
+    Scanner(dict(s3), {}, lambda job: None, ENCODING, threads, metrics,
+            index=index, generate_index_html=True).scan(path)
+    return len(index)
+
+def legacy_scan(path, s3=()):
+    """Scan a tree the way sync used to, returning the number of files
+
+    Directories were read recursively, one at a time, with listdir,
+    each entry was checked with isdir and stat-ed, each subdirectory
+    was checked for an index.html, and file times were converted to
+    gmt-sixtuples and back, before matching them against s3.
+    """
+    s3 = dict(s3)
+    fs = {}
+    index = {}
+    jobs = []
+    join = os.path.join
+
+    def listfs(path, base):
+        for name in sorted(os.listdir(path)):
+            pname = join(path, name)
+            rname = join(base, name)
+            if os.path.isdir(pname):
+                listfs(pname, rname)
+                if not os.path.exists(join(pname, 'index.html')):
+                    fs[rname.decode(ENCODING)+'/index.html'] = -1
+            else:
+                try:
+                    mtime = time_time_from_sixtuple(
+                        time.gmtime(os.stat(pname).st_mtime))
+                except OSError:
+                    continue
+
+                key = rname.decode(ENCODING)
+                index[key] = mtime
+                if key in s3:
+                    s3mtime = s3.pop(key)
+                    if (isinstance(s3mtime, basestring)
+                        or mtime > s3mtime):
+                        jobs.append((mtime, key))
+                else:
+                    fs[key] = mtime
+
+    listfs(path, '')
+    return len(index)
+
+def best(func, repeat):
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+    return min(times)
+
+def scan_overhead(path, repeat):
+    scan(path) # warm the OS caches
+    plain = best(lambda : scan(path), repeat)
+    measured = best(lambda : scan(path, metrics=Metrics('benchmark')),
+                    repeat)
+    return dict(
+        wall=measured, without_metrics=plain,
+        overhead=(measured - plain) / plain if plain else 0.0)
+
+def scan_speedup(path, repeat, threads):
+    """Time scanning a synced tree, as sync does and used to
+    """
+    s3 = s3_listing(path)
+    legacy_s3 = s3_listing(path, legacy=True)
+    scan(path, threads, s3=s3) # warm the OS caches
+    before = best(lambda : legacy_scan(path, legacy_s3), repeat)
+    after = best(lambda : scan(path, threads, s3=s3), repeat)
+    return dict(wall=after, legacy=before,
+                speedup=before / after if after else 0.0)
+
+def time_conversions(repeat, count, seed=0):
+    """Time converting count S3 and file times, as sync does and used to
+    """
+    generator = random.Random(seed)
+    now = time.time()
+    mtimes = [now - generator.uniform(0, 30 * 86400) for i in range(count)]
+    stamps = [time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime(t))
+              for t in mtimes]
+
+    def legacy():
+        for s in stamps:
+            time_time_from_sixtuple(parse_time(s))
+        for t in mtimes:
+            time_time_from_sixtuple(time.gmtime(t))
+
+    def current():
+        for s in stamps:
+            s3_time(s)
+        for t in mtimes:
+            int(t)
+
+    before = best(legacy, repeat)
+    after = best(current, repeat)
+    return dict(wall=after, legacy=before,
+                speedup=before / after if after else 0.0)
+
+def make_indexes(directory, entries, depth=2, fanout=10, seed=0):
+    """Write marshal and compact indexes of a synthetic tree
+
+    Return the paths of the index files and of a file of marshaled
+    keys to look up, and changes to merge (1% of the entries).
+    """
+    generator = random.Random(seed)
+    now = int(time.time())
+    keys = sorted(tree_path(i, depth, fanout).decode('ascii')
+                  for i in range(entries))
+    items = [(key, now - generator.randint(3600, 30 * 86400))
+             for key in keys]
+    del keys
+
+    compact = os.path.join(directory, 'compact-index')
+    indexfile.write(compact, items)
+    lookups = generator.sample(items, min(entries, INDEX_LOOKUPS))
+    changes = sorted((key, mtime + 1)
+                     for key, mtime in lookups[:max(entries // 100, 1)])
+    items = dict(items)
+    legacy = os.path.join(directory, 'marshal-index')
+    indexfile.save(legacy, items)
+    del items
+
+    keys = os.path.join(directory, 'index-keys')
+    with open(keys, 'wb') as f:
+        marshal.dump(dict(lookups=[key for key, _ in lookups],
+                          changes=changes), f)
+    return dict(compact=compact, marshal=legacy), keys
+
+def index_child():
+    """Load, search and merge an index in a child process, reporting stats
+
+    The arguments are a result file name, an index file name and the
+    name of a file of keys to look up and changes to merge.
+    """
+    result_path, path, keys_path = sys.argv[1:4]
+    with open(keys_path, 'rb') as f:
+        keys = marshal.load(f)
+
+    start = time.time()
+    index = indexfile.load(path)
+    load = time.time() - start
+
+    start = time.time()
+    for key in keys['lookups']:
+        index.get(key)
+    lookup = time.time() - start
+
+    # Merge changes and write a new index, as a sync does.
+    start = time.time()
+    if isinstance(index, indexfile.Index):
+        indexfile.write(path + '.new', indexfile.merge(
+            index.iteritems(encoded=True), keys['changes']))
+        index.close()
+    else:
+        index.update(keys['changes'])
+        indexfile.save(path + '.new', index)
+    merge = time.time() - start
+
+    with open(result_path, 'w') as f:
+        json.dump(dict(load=load, lookup=lookup, merge=merge,
+                       lookups=len(keys['lookups']),
+                       size=os.path.getsize(path), maxrss=peak_rss()), f)
+
+def index_formats(work, entries, depth, fanout, seed):
+    """Compare the marshal and compact index formats
+    """
+    paths, keys = make_indexes(work, entries, depth, fanout, seed)
+    result_path = os.path.join(work, 'result.json')
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    results = dict(entries=entries)
+    for name in sorted(paths):
+        subprocess.check_call([
+            sys.executable, '-c',
+            'import zc.s3staticsync.benchmark;'
+            ' zc.s3staticsync.benchmark.index_child()',
+            result_path, paths[name], keys], env=env)
+        with open(result_path) as f:
+            result = json.load(f)
+        result['wall'] = result['load'] + result['lookup'] + result['merge']
+        results[name] = result
+    results.update(wall=results['compact']['wall'],
+                   maxrss=results['compact']['maxrss'])
+    return results
+
+def send(fp, buffer_size):
+    # Read a body the way boto does when sending it
+    while fp.read(buffer_size):
+        pass
+
+def upload_io(path, repeat):
+    """Time preparing upload bodies, as workers do and used to
+    """
+    files = []
+    pages = []
+    for dirpath, dirnames, filenames in os.walk(path):
+        files.extend(os.path.join(dirpath, name) for name in filenames)
+        if dirpath != path:
+            pages.append((dirpath[len(path):],
+                          directory_listing(listdir(dirpath))))
+
+    def legacy():
+        # boto computed md5s by reading bodies in 8K chunks, and
+        # then read them again to send them.
+        for name in files:
+            with open(name, 'rb') as fp:
+                boto.utils.compute_md5(fp)
+                fp.seek(0)
+                send(fp, 8192)
+        for title, listing in pages:
+            data = render_index_html(title, listing, 'latin-1')
+            fp = StringIO.StringIO(data.encode('utf-8'))
+            boto.utils.compute_md5(fp)
+            fp.seek(0)
+            send(fp, 8192)
+
+    def current():
+        for name in files:
+            content_md5(name)
+            with open(name, 'rb') as fp:
+                send(fp, UPLOAD_BUFFER_SIZE)
+        for title, listing in pages:
+            fp, size, md5s = index_html_body(title, listing, 'latin-1')
+            send(fp, UPLOAD_BUFFER_SIZE)
+
+    current() # warm the OS caches
+    before = best(legacy, repeat)
+    after = best(current, repeat)
+    return dict(wall=after, legacy=before,
+                speedup=before / after if after else 0.0)
+
+def io_syscalls():
+    """Return the number of read and write system calls we've made
+
+    These come from /proc, so are only available on Linux.
+    """
+    try:
+        with open('/proc/self/io') as f:
+            io = dict(line.split(': ') for line in f)
+    except IOError:
+        return None
+    return int(io['syscr']) + int(io['syscw'])
+
+def strace_calls(summary):
+    """Return the total number of calls from strace -c output
+    """
+    lines = summary.splitlines()
+    header = [line for line in lines if 'usecs/call' in line][0]
+    start = header.index('usecs/call') + len('usecs/call')
+    end = header.index('calls', start) + len('calls')
+    total = [line for line in lines if line.endswith(' total')][0]
+    return int(total[start:end])
+
+def peak_rss():
+    """Return our peak resident set size, in kilobytes
+
+    We use VmHWM from /proc where we can, because, unlike ru_maxrss,
+    it doesn't include memory used before exec (by our parent).
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def child():
+    """Run a sync or restore in a child process, reporting stats
+
+    The arguments are a result file name, the script ('sync' or
+    'restore') and the script's arguments.
+    """
+    result_path, script = sys.argv[1:3]
+    logging.basicConfig()
+    if script == 'sync':
+        from zc.s3staticsync import main
+    else:
+        from zc.s3staticsync.restore import main
+    syscalls = io_syscalls()
+    main(sys.argv[3:])
+    if syscalls is not None:
+        syscalls = io_syscalls() - syscalls
+    with open(result_path, 'w') as f:
+        json.dump(dict(syscalls=syscalls, maxrss=peak_rss()), f)
+
+def run(script, args, server, work, strace=False):
+    """Run a script in a subprocess, returning its stats
+    """
+    result_path = os.path.join(work, 'result.json')
+    metrics_path = os.path.join(work, 'metrics.json')
+    strace_path = os.path.join(work, 'strace.txt')
+    env = dict(os.environ,
+               BOTO_CONFIG=os.path.join(work, 'boto.cfg'),
+               PYTHONPATH=os.pathsep.join(sys.path))
+    server.reset()
+    start = time.time()
+    command = [
+        sys.executable, '-c',
+        'import zc.s3staticsync.benchmark; zc.s3staticsync.benchmark.child()',
+        result_path, script, '--metrics-json', metrics_path] + args
+    if strace:
+        command = ['strace', '-f', '-c', '-o', strace_path] + command
+    process = subprocess.Popen(command, env=env)
+    # We wait ourselves, to get the process' resource usage.
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = status
+    wall = time.time() - start
+    if status:
+        raise SystemError("%s failed" % script)
+
+    with open(result_path) as f:
+        result = json.load(f)
+    with open(metrics_path) as f:
+        metrics = json.load(f)
+    if strace:
+        with open(strace_path) as f:
+            result['syscalls'] = strace_calls(f.read())
+    result.update(
+        wall=wall,
+        cpu=usage.ru_utime + usage.ru_stime,
+        requests=server.reset(),
+        phases=metrics['phases'],
+        counters=metrics['counters'],
+        )
+    return result
+
+def run_scenarios(options, scenarios, work, tree):
+    """Run the S3 scenarios, returning {scenario: stats}
+    """
+    server = Server(latency=options.latency, throttle=options.throttle,
+                    seed=options.seed)
+    server.start()
+    with open(os.path.join(work, 'boto.cfg'), 'w') as f:
+        f.write(boto_config(server.port))
+
+    bucket = 'benchmark/tree/'
+    index = os.path.join(work, 'index')
+    results = {}
+    try:
+        for scenario in SCENARIOS:
+            # The cold sync is always done, as later scenarios need it.
+            if scenario in LOCAL or (
+                scenario not in scenarios and scenario != 'cold'):
+                continue
+            if scenario == 'restore':
+                restored = os.path.join(work, 'restored')
+                os.mkdir(restored)
+                args = [restored, bucket, '-i', index]
+                result = run('restore', args + options.restore_options,
+                             server, work, options.strace)
+            else:
+                if scenario == 'delta':
+                    make_delta(tree, options.delta, options.seed)
+                args = [tree, bucket]
+                if scenario != 'noop':
+                    args += ['-i', index]
+                result = run('sync', args + options.sync_options,
+                             server, work, options.strace)
+            if scenario in scenarios:
+                results[scenario] = result
+    finally:
+        server.stop()
+    return results
+
+def make_delta(tree, percent, seed):
+    # Touch a percentage of the files
+    paths = []
+    for dirpath, _, names in os.walk(tree):
+        paths.extend(os.path.join(dirpath, name) for name in names)
+    paths.sort()
+    generator = random.Random(seed)
+    for path in generator.sample(paths, int(len(paths) * percent / 100)):
+        with open(path, 'ab') as f:
+            f.write('changed\n')
+
+def report(results, previous=None):
+    print "%-12s %9s %9s %9s %10s %9s" % (
+        'scenario', 'wall (s)', 'cpu (s)', 'rss (MB)', 'syscalls', 'requests')
+    for scenario in SCENARIOS:
+        result = results.get(scenario)
+        if result is None:
+            continue
+        if scenario == 'scan':
+            print "%-12s %9.3f %9s %9s %10s %9s   metrics overhead %.1f%%" % (
+                scenario, result['wall'], '', '', '', '',
+                100 * result['overhead'])
+            continue
+        if scenario == 'index':
+            print "%-12s %9.3f %9s %9.1f %10s %9s   marshal %.3f, %.1f MB" % (
+                scenario, result['wall'], '', result['maxrss'] / 1024.0,
+                '', '', result['marshal']['wall'],
+                result['marshal']['maxrss'] / 1024.0)
+            continue
+        if scenario in ('listfs', 'times', 'io'):
+            print "%-12s %9.3f %9s %9s %10s %9s   %.1fx faster than %.3f" % (
+                scenario, result['wall'], '', '', '', '',
+                result['speedup'], result['legacy'])
+            continue
+        line = "%-12s %9.3f %9.3f %9.1f %10s %9s" % (
+            scenario, result['wall'], result['cpu'],
+            result['maxrss'] / 1024.0,
+            result['syscalls'] if result['syscalls'] is not None else '-',
+            sum(result['requests'].values()))
+        if previous and scenario in previous:
+            line += "   %+.1f%%" % (
+                100 * (result['wall'] - previous[scenario]['wall'])
+                / previous[scenario]['wall'])
+        print line
+    for scenario in SCENARIOS:
+        result = results.get(scenario)
+        if scenario == 'index' and result is not None:
+            print
+            print "index (%s entries, %s lookups)" % (
+                result['entries'], result['compact']['lookups'])
+            for name in 'compact', 'marshal':
+                print ("  %-8s  load %.3f, lookup %.3f, merge %.3f,"
+                       " rss %.1f MB, file %.1f MB" % (
+                           name + ':', result[name]['load'],
+                           result[name]['lookup'], result[name]['merge'],
+                           result[name]['maxrss'] / 1024.0,
+                           result[name]['size'] / float(1 << 20)))
+        if result is None or scenario in LOCAL:
+            continue
+        print
+        print scenario
+        print "  requests: " + ', '.join(
+            '%s %s' % item for item in sorted(result['requests'].items()))
+        print "  phases:   " + ', '.join(
+            '%s %.3f' % item for item in sorted(result['phases'].items()))
+
+def load_results(path):
+    if path and os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+    return []
+
+def main(args=None):
+    options, scenarios = parser.parse_args(args)
+    scenarios = scenarios or SCENARIOS
+    for scenario in scenarios:
+        if scenario not in SCENARIOS:
+            parser.error("Unknown scenario %r" % scenario)
+
+    work = tempfile.mkdtemp(dir=options.directory)
+    try:
+        tree = os.path.join(work, 'tree')
+        make_tree(tree, options.files, options.depth, options.fanout,
+                  parse_sizes(options.sizes), options.max_age, options.seed)
+        results = {}
+        if [scenario for scenario in scenarios if scenario not in LOCAL]:
+            results = run_scenarios(options, scenarios, work, tree)
+        if 'scan' in scenarios:
+            results['scan'] = scan_overhead(tree, options.repeat)
+        if 'listfs' in scenarios:
+            results['listfs'] = scan_speedup(
+                tree, options.repeat, options.scan_threads)
+        if 'times' in scenarios:
+            results['times'] = time_conversions(
+                options.repeat, options.files, options.seed)
+        if 'index' in scenarios:
+            results['index'] = index_formats(
+                work, options.index_entries or options.files,
+                options.depth, options.fanout, options.seed)
+        if 'io' in scenarios:
+            results['io'] = upload_io(tree, options.repeat)
+    finally:
+        shutil.rmtree(work)
+
+    stored = load_results(options.results)
+    previous = None
+    if options.compare is not None:
+        for stored_run in reversed(stored):
+            if stored_run['label'] == options.compare:
+                previous = stored_run['scenarios']
+                break
+        else:
+            print "No stored results labeled %r" % options.compare
+
+    report(results, previous)
+
+    if options.results:
+        stored.append(dict(
+            label=options.label,
+            time=time.time(),
+            python=sys.version.split()[0],
+            options=dict(
+                (name, getattr(options, name)) for name in (
+                    'files', 'depth', 'fanout', 'sizes', 'max_age', 'delta',
+                    'seed', 'latency', 'throttle', 'sync_options',
+                    'restore_options', 'index_entries')),
+            scenarios=results,
+            ))
+        with open(options.results + '.tmp', 'w') as f:
+            json.dump(stored, f, indent=1, sort_keys=True)
+        os.rename(options.results + '.tmp', options.results)
+
+if __name__ == '__main__':
+    main()
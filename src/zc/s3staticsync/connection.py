@@ -0,0 +1,68 @@
+"""Per-worker S3 connections
+
+boto connections keep HTTP connections alive between requests, but
+sharing one connection among many workers causes contention and
+connection churn.  A pool gives each worker its own connection (and
+bucket), which it reuses until there's an error, or until it has been
+idle too long, in which case the connection is replaced.
+
+Workers are threads, or, with the gevent engine, greenlets, so the
+pool is given worker-local storage by the engine.
+"""
+
+import boto.s3.connection
+import threading
+import time
+
+class ConnectionPool:
+
+    # S3 closes idle HTTP connections after a while, so there's no
+    # point in reusing a connection that's been idle longer than this.
+    max_idle = 50
+
+    def __init__(self, bucket_name, local=None):
+        self.bucket_name = bucket_name
+        self.local = threading.local() if local is None else local
+        self.lock = threading.Lock()
+        self.connections = self.reuses = self.resets = self.expired = 0
+
+    def bucket(self):
+        """Return the current worker's bucket, connecting if necessary
+        """
+        local = self.local
+        bucket = getattr(local, 'bucket', None)
+        now = time.time()
+        if bucket is not None and now - local.used > self.max_idle:
+            with self.lock:
+                self.expired += 1
+            bucket = None
+
+        if bucket is None:
+            connection = boto.s3.connection.S3Connection()
+            # The bucket has already been checked by the caller, so
+            # don't spend a request validating it again.
+            bucket = connection.get_bucket(self.bucket_name, validate=False)
+            local.bucket = bucket
+            with self.lock:
+                self.connections += 1
+        else:
+            with self.lock:
+                self.reuses += 1
+
+        local.used = now
+        return bucket
+
+    def reset(self):
+        """Discard the current worker's connection, after an error
+
+        Return a bucket with a new connection.
+        """
+        if getattr(self.local, 'bucket', None) is not None:
+            self.local.bucket = None
+            with self.lock:
+                self.resets += 1
+        return self.bucket()
+
+    def stats(self):
+        return dict(connections=self.connections, reuses=self.reuses,
+                    resets=self.resets, expired=self.expired)
@@ -0,0 +1,208 @@
+"""Transfer engines
+
+An engine processes jobs from a queue.  Jobs are processed by a
+function that does a single S3 operation (with retries) and calls
+``queue.task_done()`` when it's done.
+
+The threads engine processes jobs with a fixed number of worker
+threads.  The gevent engine processes jobs in greenlets, keeping many
+more operations in flight than would be practical with threads.  It
+requires gevent, which is optional.
+
+Engines also provide the primitives the processing function needs to
+cooperate with the engine: ``sleep``, ``Lock``, ``Condition``,
+``get``, which gets an item from a ``Queue.Queue``, ``local``, which
+creates storage local to a worker, and ``worker_name``, which names
+the current worker.
+
+The gevent engine needs the socket and ssl modules to be
+monkey-patched, which scripts do, with ``patch``, when the gevent
+engine is chosen.  Patching is process-wide, so it isn't done when
+engines are created.
+"""
+
+from thread import get_ident
+import sys
+import threading
+import time
+
+def thread(func, *args):
+    t = threading.Thread(target=func, args=args)
+    t.setDaemon(True)
+    t.start()
+    return t
+
+def patch():
+    """Make S3 requests cooperative, for the gevent engine
+    """
+    import gevent.monkey
+
+    # boto uses httplib, which looks up socket and ssl functions
+    # when it connects, so patching them is enough.
+    gevent.monkey.patch_socket()
+    gevent.monkey.patch_ssl()
+
+class Threads:
+
+    def __init__(self, workers):
+        self.workers = self.concurrency = workers
+
+    def start(self, queue, process):
+        def worker():
+            while 1:
+                job = queue.get()
+                if job is None:
+                    queue.task_done()
+                    return
+                process(job)
+
+        self.threads = [thread(worker) for i in range(self.workers)]
+
+    def stop(self, queue):
+        for _ in self.threads:
+            queue.put(None)
+        for t in self.threads:
+            t.join()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+    def Lock(self):
+        return threading.Lock()
+
+    def Condition(self):
+        return threading.Condition()
+
+    def get(self, queue):
+        return queue.get()
+
+    def local(self):
+        return threading.local()
+
+    def worker_name(self):
+        return threading.current_thread().name
+
+class GreenCondition:
+    """Condition variable for greenlets
+
+    The lock is a thread lock, so threads (such as part threads
+    reporting throttling) can update the state it protects, but only
+    greenlets in the engine's hub wait and notify.
+    """
+
+    def __init__(self, Event):
+        self.lock = threading.Lock()
+        self.Event = Event
+        self.waiters = []
+
+    def __enter__(self):
+        self.lock.acquire()
+
+    def __exit__(self, *args):
+        self.lock.release()
+
+    def wait(self):
+        event = self.Event()
+        self.waiters.append(event)
+        self.lock.release()
+        try:
+            event.wait()
+        finally:
+            self.lock.acquire()
+
+    def notify_all(self):
+        waiters, self.waiters = self.waiters, []
+        for event in waiters:
+            event.set()
+
+class Gevent(Threads):
+
+    # Threads used to wait on Queue.Queues (shared with regular
+    # threads) without blocking the hub
+    waiters = 100
+
+    def __init__(self, concurrency):
+        import gevent
+        import gevent.event
+        import gevent.local
+        import gevent.lock
+        import gevent.queue
+        import gevent.threadpool
+
+        self.gevent = gevent
+        self.concurrency = concurrency
+        self.waiting = set()
+
+    def start(self, queue, process):
+        gevent = self.gevent
+        started = threading.Event()
+
+        def run():
+            # Jobs are handed to worker greenlets as they become free,
+            # so the rest wait in the queue, in their lanes.
+            self.pool = gevent.threadpool.ThreadPool(self.waiters)
+            jobs = gevent.queue.Channel()
+            started.set()
+
+            def worker():
+                while 1:
+                    job = jobs.get()
+                    if job is None:
+                        return
+                    process(job)
+
+            workers = [gevent.spawn(worker)
+                       for i in range(self.concurrency)]
+            while 1:
+                job = self.get(queue)
+                if job is None:
+                    break
+                jobs.put(job)
+            for _ in workers:
+                jobs.put(None)
+            gevent.joinall(workers)
+            self.pool.kill()
+            queue.task_done()
+
+        self.threads = [thread(run)]
+        started.wait()
+
+    def stop(self, queue):
+        Threads.stop(self, queue)
+
+        # Killing the pool stops its threads, but they aren't
+        # joinable, so wait for them to be gone.
+        while self.waiting.intersection(sys._current_frames()):
+            time.sleep(.01)
+        self.waiting.clear()
+
+    def sleep(self, seconds):
+        self.gevent.sleep(seconds)
+
+    def Lock(self):
+        return self.gevent.lock.Semaphore()
+
+    def Condition(self):
+        return GreenCondition(self.gevent.event.Event)
+
+    def get(self, queue):
+        # Queue.Queue is shared with regular threads, so we wait for
+        # it in a pool thread, which wakes us when it's done.
+        return self.pool.apply(self._get, (queue, ))
+
+    def _get(self, queue):
+        self.waiting.add(get_ident())
+        return queue.get()
+
+    def local(self):
+        return self.gevent.local.local()
+
+    def worker_name(self):
+        return self.gevent.getcurrent().name
+
+def create_engine(options):
+    """Create an engine from command-line options
+    """
+    if options.engine == 'gevent':
+        return Gevent(options.in_flight)
+    return Threads(options.worker_threads)
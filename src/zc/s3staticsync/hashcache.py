@@ -0,0 +1,174 @@
+"""Content digests
+
+Computing md5s of every file would be impractical, but FTP clients
+often re-upload identical files, which only changes their modification
+times.  With a hash cache (--hash-cache), files whose times changed
+are hashed, and are only uploaded if their content changed.
+
+The cache maps paths to the stat signature (inode, size and
+modification time) of the file we last synced, along with its digest,
+so a file is only hashed again when its signature changes.  Because
+entries are only recorded when S3 has the content, the cached digest
+is also the digest of the S3 object.
+
+The cache can also find keys already synced with a file's content
+(--server-side-copy), so renamed and duplicated files can be copied
+in S3, rather than uploaded.  A file that's moved keeps its inode,
+size and modification time, so it's found by its signature, without
+hashing it.  Inodes are reused, though, so a signature is only trusted
+if the file's name is also unchanged (as when directories are renamed).
+"""
+
+import base64
+import hashlib
+import marshal
+import mmap
+import os
+import posixpath
+import threading
+from zc.s3staticsync.index import replacing
+
+# Smaller files (or parts) are read, as mapping them costs more
+# system calls than it saves copying.
+MAP_THRESHOLD = 1 << 16
+
+def digest(path, offset=0, size=None):
+    """Return a hashlib md5 object for (part of) a file's contents
+
+    Large files are mapped, rather than read, to avoid copying data,
+    and hashlib releases the GIL while hashing large buffers, so
+    files can be hashed in parallel by threads.
+    """
+    with open(path, 'rb') as f:
+        file_size = os.fstat(f.fileno()).st_size
+        if size is None:
+            size = file_size - offset
+        if size < MAP_THRESHOLD:
+            f.seek(offset)
+            return hashlib.md5(f.read(size))
+        data = mmap.mmap(f.fileno(), file_size, access=mmap.ACCESS_READ)
+        try:
+            return hashlib.md5(buffer(data, offset, size))
+        finally:
+            data.close()
+
+def md5(path):
+    """Return the hex md5 digest of a file's contents
+    """
+    return digest(path).hexdigest()
+
+def content_md5(path, offset=0, size=None):
+    """Return the md5 of (part of) a file, as boto wants it
+
+    That's a (hex digest, base64 digest) tuple.  Passing it to boto
+    saves boto reading the data an extra time, through Python
+    buffers, to compute it.
+    """
+    return boto_md5(digest(path, offset, size))
+
+def boto_md5(md5):
+    """Convert a hashlib md5 object to a boto md5 tuple
+    """
+    return md5.hexdigest(), base64.b64encode(md5.digest())
+
+def signature(stat):
+    return stat.st_ino, stat.st_size, stat.st_mtime
+
+class HashCache:
+
+    def __init__(self, path):
+        self.path = path
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                self.entries = marshal.load(f)
+        else:
+            self.entries = {}
+        self.lock = threading.Lock()
+
+    # Reverse indexes, maintained after index_copies is called:
+    by_digest = None # {digest: set([key])}
+    by_signature = None # {signature: (digest, name)}
+
+    def index_copies(self):
+        """Index keys by digest, and digests by signature, to find copies
+        """
+        with self.lock:
+            self.by_digest = {}
+            self.by_signature = {}
+            for key, entry in self.entries.iteritems():
+                self._add(key, entry)
+
+    def _add(self, key, entry):
+        self.by_digest.setdefault(entry[3], set()).add(key)
+        self.by_signature[entry[:3]] = entry[3], posixpath.basename(key)
+
+    def _remove(self, key, entry):
+        keys = self.by_digest.get(entry[3])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.by_digest[entry[3]]
+        if self.by_signature.get(entry[:3]) == (
+            entry[3], posixpath.basename(key)):
+            del self.by_signature[entry[:3]]
+
+    def signature_digest(self, signature, key):
+        """Return the digest of a synced file with a signature and name
+
+        The file must have the same name as the key, as a signature
+        alone may belong to a new file that reused an inode.
+        """
+        with self.lock:
+            found = self.by_signature.get(signature)
+        if found is not None and found[1] == posixpath.basename(key):
+            return found[0]
+
+    def copy_source(self, digest, exclude):
+        """Return a key (other than exclude) synced with a digest
+        """
+        with self.lock:
+            for key in self.by_digest.get(digest, ()):
+                if key != exclude:
+                    return key
+
+    def digest(self, key, signature):
+        """Return the cached digest for a key, if its signature matches
+        """
+        entry = self.entries.get(key)
+        if entry is not None and entry[:3] == signature:
+            return entry[3]
+
+    def synced(self, key):
+        """Return the digest of the content we last synced for a key
+        """
+        entry = self.entries.get(key)
+        if entry is not None:
+            return entry[3]
+
+    def set(self, key, signature, digest):
+        entry = signature + (digest,)
+        if self.by_digest is None:
+            self.entries[key] = entry
+            return
+        with self.lock:
+            old = self.entries.get(key)
+            if old is not None:
+                self._remove(key, old)
+            self.entries[key] = entry
+            self._add(key, entry)
+
+    def discard(self, key):
+        if self.by_digest is None:
+            self.entries.pop(key, None)
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self._remove(key, old)
+
+    def save(self):
+        # Replace the file atomically, so an interrupted save doesn't
+        # lose the cache.
+        with replacing(self.path) as tmp:
+            with open(tmp, 'wb') as f:
+                marshal.dump(self.entries, f)
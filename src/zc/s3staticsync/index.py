@@ -0,0 +1,639 @@
+""" usage: %prog [options] marshal-index compact-index
+
+Convert a marshal-format index file to the compact index format.
+
+Compact indexes store paths sorted (in UTF-8, and thus S3 key, order)
+in prefix-compressed blocks, with a parallel packed array of values.
+Values are either integer modification times, or md5 digests (of
+generated index.html files), which are stored as 16 raw bytes.
+
+The file is memory mapped, so it's never loaded into memory as a
+whole. We only keep the first path of each block in memory, to find
+blocks quickly.
+
+Layout::
+
+  header
+  blocks      prefix-compressed paths, BLOCK_SIZE per block
+  offsets     packed array of block offsets
+  values      packed array of 8-byte signed values
+  digests     16-byte digests
+
+A value >= 0 is a modification time. A negative value, v, refers to
+the digest at position -v-1.
+
+Marshal indexes are a marshalled dictionary, followed by the
+marshalled format version.
+
+Index files are replaced atomically.  Changes made during a sync are
+journaled (in the index path + '.journal'), and, if a sync is
+interrupted, the next one applies the journal to the index before
+loading it.
+
+Before version 2, modification times were offset by the local time
+zone (see zc.s3staticsync.timestamps).  Older indexes, in either
+format, are converted as they're read, and rewritten in the current
+version.
+"""
+
+import binascii
+import bisect
+import contextlib
+import heapq
+import logging
+import marshal
+import mmap
+import optparse
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import threading
+import time
+from zc.s3staticsync.timestamps import from_legacy
+
+logger = logging.getLogger(__name__)
+
+MAGIC = 'S3SI'
+VERSION = 2
+BLOCK_SIZE = 64
+
+header = struct.Struct('<4sIQIQQQQQ')
+entry_header = struct.Struct('<HH')
+value_struct = struct.Struct('<q')
+offset_struct = struct.Struct('<Q')
+
+def is_compact(path):
+    """Return whether the file at the given path is a compact index
+    """
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+def load(path):
+    """Load an index file, in either format
+    """
+    if is_compact(path):
+        return Index(path)
+    with open(path, 'rb') as f:
+        data = marshal.load(f)
+        try:
+            version = marshal.load(f)
+        except EOFError:
+            version = 1
+    if version < 2:
+        data = dict((key, migrate(value)) for key, value in data.iteritems())
+    return data
+
+def dump(data, f):
+    """Write a marshal index to a file
+    """
+    marshal.dump(data, f)
+    marshal.dump(VERSION, f)
+
+def migrate(value):
+    """Convert a value from an index before version 2
+    """
+    if isinstance(value, (int, long)) and value > 1:
+        # A modification time, rather than a digest or a marker for a
+        # failed update.
+        return from_legacy(value)
+    return value
+
+def write(path, items):
+    """Write a compact index from an iterable of (path, value) items
+
+    Items must be sorted by their UTF-8 encoded paths and paths must
+    be unique.
+    """
+    writer = Writer(path)
+    writer.extend(items)
+    writer.close()
+
+class Writer:
+    """Write a compact index an item at a time
+
+    Items must be added in order of their UTF-8 encoded paths and
+    paths must be unique.  This lets us write several indexes from a
+    single pass over sorted items.
+    """
+
+    def __init__(self, path):
+        # Values and block offsets are spooled to temporary files, so
+        # we don't hold them in memory.
+        self.values = tempfile.TemporaryFile()
+        self.offsets = tempfile.TemporaryFile()
+        self.count = self.noffsets = 0
+        self.digests = []
+        self.file = open(path, 'wb')
+        self.file.write(header.pack(MAGIC, VERSION, 0, 0, 0, 0, 0, 0, 0))
+        self.pos = header.size
+        self.last = None
+        # Entries and values of the current block, written a block at
+        # a time.
+        self.entries = []
+        self.block_values = []
+
+    def add(self, key, value):
+        self.extend(((key, value),))
+
+    def extend(self, items):
+        """Add (path, value) items from an iterable
+        """
+        entries = self.entries
+        values = self.block_values
+        digests = self.digests
+        pack = entry_header.pack
+        last = self.last
+        count = self.count
+        for key, value in items:
+            if isinstance(key, unicode):
+                key = key.encode('utf-8')
+            if last is not None and key <= last:
+                raise ValueError("Unsorted or duplicate path", key)
+            if count % BLOCK_SIZE:
+                # Find the length of the prefix shared with the last
+                # path by bisection, so slices are compared in C,
+                # rather than characters in Python.
+                shared, high = 0, min(len(last), len(key))
+                while shared < high:
+                    mid = (shared + high + 1) // 2
+                    if last[:mid] == key[:mid]:
+                        shared = mid
+                    else:
+                        high = mid - 1
+                entries.append(pack(shared, len(key) - shared) + key[shared:])
+            else:
+                self._flush()
+                self.offsets.write(offset_struct.pack(self.pos))
+                self.noffsets += 1
+                entries.append(pack(0, len(key)) + key)
+
+            if isinstance(value, basestring):
+                digests.append(binascii.unhexlify(value))
+                value = -len(digests)
+            values.append(value)
+            last = key
+            count += 1
+        self.last = last
+        self.count = count
+
+    def _flush(self):
+        # Write the current block's entries and values.
+        if self.entries:
+            data = ''.join(self.entries)
+            self.file.write(data)
+            self.pos += len(data)
+            self.values.write(struct.pack(
+                '<%sq' % len(self.block_values), *self.block_values))
+            del self.entries[:]
+            del self.block_values[:]
+
+    def close(self):
+        self._flush()
+        f = self.file
+        offsets_offset = self.pos
+        self.offsets.seek(0)
+        shutil.copyfileobj(self.offsets, f)
+        values_offset = offsets_offset + offset_struct.size * self.noffsets
+        self.values.seek(0)
+        shutil.copyfileobj(self.values, f)
+        digests_offset = values_offset + value_struct.size * self.count
+        f.write(''.join(self.digests))
+
+        f.seek(0)
+        f.write(header.pack(
+            MAGIC, VERSION, self.count, BLOCK_SIZE, len(self.digests),
+            header.size, offsets_offset, values_offset, digests_offset))
+        f.close()
+        self.values.close()
+        self.offsets.close()
+
+@contextlib.contextmanager
+def replacing(path):
+    """Replace a file atomically
+
+    Yields a temporary path to write to.  When the block exits
+    without an error, the temporary file is synced and renamed to the
+    path, so a crash leaves either the old file or the new one.
+    """
+    tmp = path + '.tmp'
+    yield tmp
+    with open(tmp, 'rb') as f:
+        os.fsync(f.fileno())
+    os.rename(tmp, path)
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(fd) # Make the rename durable.
+    finally:
+        os.close(fd)
+
+def save(path, data):
+    """Save a marshal index atomically
+    """
+    with replacing(path) as tmp:
+        with open(tmp, 'wb') as f:
+            dump(data, f)
+
+def load_directories(path):
+    """Load the directory times saved with an index
+
+    These are used to skip stat calls for files in unchanged
+    directories (--prune-directories).  An empty dictionary is
+    returned if there aren't any.
+    """
+    try:
+        with open(path + '.directories', 'rb') as f:
+            return marshal.load(f)
+    except (IOError, EOFError, ValueError, TypeError):
+        return {}
+
+def save_directories(path, data):
+    """Save the directory times for an index atomically
+    """
+    with replacing(path + '.directories') as tmp:
+        with open(tmp, 'wb') as f:
+            marshal.dump(data, f)
+
+class Journal:
+    """Journal of changes to an index
+
+    Records are marshaled (path, value) tuples, appended to the file.
+    A value of None means the path was deleted.  The file is flushed
+    (and synced) at most every flush_interval seconds.
+    """
+
+    flush_interval = 1
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'ab')
+        self.lock = threading.Lock()
+        self.flushed = time.time()
+
+    def record(self, path, value):
+        with self.lock:
+            marshal.dump((path, value), self.file)
+            if time.time() - self.flushed >= self.flush_interval:
+                self._flush()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.flushed = time.time()
+
+    def close(self, remove=False):
+        self.file.close()
+        if remove:
+            os.remove(self.path)
+
+def journaled(path):
+    """Return the changes recorded in a journal, as a dictionary
+    """
+    changes = {}
+    with open(path, 'rb') as f:
+        while 1:
+            try:
+                key, value = marshal.load(f)
+            except (EOFError, ValueError, TypeError):
+                break # end, or a partially-written record
+            changes[key] = value
+    return changes
+
+def recover(path):
+    """Apply the journal left by an interrupted sync to its index
+
+    Without an index, the journal is discarded, as the sync that
+    wrote it will have listed the bucket.  Return the number of
+    changes applied.
+    """
+    journal = path + '.journal'
+    if not os.path.exists(journal):
+        return 0
+    applied = 0
+    if os.path.exists(path):
+        changes = journaled(journal)
+        applied = len(changes)
+        index = load(path)
+        if isinstance(index, Index):
+            with replacing(path) as tmp:
+                write(tmp, merge(index.iteritems(encoded=True),
+                                 sorted_items(changes)))
+            index.close()
+        else:
+            for key, value in changes.iteritems():
+                if value is None:
+                    index.pop(key, None)
+                else:
+                    index[key] = value
+            save(path, index)
+        logger.warning("Recovered %s changes to %s from an interrupted sync"
+                       % (applied, path))
+    os.remove(journal)
+    return applied
+
+def merge(*sources):
+    """Merge sorted iterables of (path, value) items
+
+    If a path appears in more than one source, the value from the last
+    source wins. A value of None removes the path.
+    """
+    if len(sources) == 2:
+        return _merge2(*sources)
+
+    heap = []
+    for i, source in enumerate(sources):
+        items = iter(source)
+        for key, value in items:
+            heap.append((_encoded(key), i, key, value, items))
+            break
+    heapq.heapify(heap)
+    return _merge(heap)
+
+def _merge(heap):
+    # Heap entries are (encoded key, source number, key, value, items).
+    # Sources with the same key are popped in order, so the last wins.
+    while heap:
+        first = heap[0][0]
+        while heap and heap[0][0] == first:
+            _, i, key, value, items = heap[0]
+            for next_key, next_value in items:
+                heapq.heapreplace(heap, (
+                    _encoded(next_key), i, next_key, next_value, items))
+                break
+            else:
+                heapq.heappop(heap)
+        if value is not None:
+            yield key, value
+
+def _merge2(a, b):
+    # Merge 2 sources, which is what we usually do (changes into an
+    # index), comparing keys as we go, without a heap.  Once b is
+    # exhausted, a's items are passed through.
+    b = iter(b)
+    bkey = bvalue = bekey = None
+    for bkey, bvalue in b:
+        bekey = _encoded(bkey)
+        break
+    for key, value in a:
+        if bekey is not None:
+            ekey = _encoded(key)
+            while bekey is not None and bekey <= ekey:
+                if bekey == ekey:
+                    key, value = bkey, bvalue # b wins
+                elif bvalue is not None:
+                    yield bkey, bvalue
+                bekey = None
+                for bkey, bvalue in b:
+                    bekey = _encoded(bkey)
+                    break
+        if value is not None:
+            yield key, value
+    if bekey is not None:
+        if bvalue is not None:
+            yield bkey, bvalue
+        for bkey, bvalue in b:
+            if bvalue is not None:
+                yield bkey, bvalue
+
+def _encoded(key):
+    if isinstance(key, unicode):
+        return key.encode('utf-8')
+    return key
+
+def sorted_items(mapping):
+    """Return the items of a mapping sorted by UTF-8 encoded path
+    """
+    return sorted(mapping.iteritems(), key=lambda item: _encoded(item[0]))
+
+def under(keys, paths):
+    """Return the set of keys at or below the given paths
+
+    Keys are selected in a single pass, by looking them, and their
+    directories, up in the paths, so they needn't be sorted.
+    """
+    paths = set(paths)
+    found = set()
+    for key in keys:
+        path = key
+        while path not in paths:
+            path = path.rpartition(u'/')[0]
+            if not path:
+                break
+        else:
+            found.add(key)
+    return found
+
+class Index:
+    """Read-only, memory-mapped compact index
+
+    To support computing differences, the index supports ``pop``,
+    which doesn't change the file, but marks entries as popped.
+    Popped entries are excluded by ``__contains__`` and ``__iter__``.
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            data = f.read(header.size)
+            (magic, version, self.count, self.block_size, ndigests,
+             self.blocks_offset, self.offsets_offset, self.values_offset,
+             self.digests_offset) = header.unpack(data)
+            if magic != MAGIC or not 1 <= version <= VERSION:
+                raise ValueError("Not a compact index", path)
+            self.legacy = version < 2
+            if self.count:
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self.map = ''
+
+        self.popped = bytearray(self.count)
+        self.local = threading.local()
+
+        # Keep the first key of each block, to find blocks with bisect.
+        self.firsts = firsts = []
+        unpack = entry_header.unpack_from
+        for block in range(self.nblocks):
+            pos = self.block_offset(block)
+            _, size = unpack(self.map, pos)
+            pos += entry_header.size
+            firsts.append(self.map[pos:pos+size])
+
+    @property
+    def nblocks(self):
+        return (self.count + self.block_size - 1) // self.block_size
+
+    def block_offset(self, block):
+        return offset_struct.unpack_from(
+            self.map, self.offsets_offset + offset_struct.size * block)[0]
+
+    def block(self, block):
+        # Decode a block of keys.  Lookups tend to be clustered, as
+        # we scan directories in order, so we cache the last decoded
+        # block per thread.
+        cached = getattr(self.local, 'cached', None)
+        if cached is not None and cached[0] == block:
+            return cached[1]
+
+        keys = []
+        pos = self.block_offset(block)
+        unpack = entry_header.unpack_from
+        last = ''
+        for i in range(min(self.block_size,
+                           self.count - block * self.block_size)):
+            shared, size = unpack(self.map, pos)
+            pos += entry_header.size
+            last = last[:shared] + self.map[pos:pos+size]
+            pos += size
+            keys.append(last)
+
+        self.local.cached = block, keys
+        return keys
+
+    def position(self, key):
+        """Return the position of a key in the index, or -1
+        """
+        key = _encoded(key)
+        block = bisect.bisect_right(self.firsts, key) - 1
+        if block < 0:
+            return -1
+        keys = self.block(block)
+        i = bisect.bisect_left(keys, key)
+        if i < len(keys) and keys[i] == key:
+            return block * self.block_size + i
+        return -1
+
+    def following(self, key):
+        """Generate (position, key) pairs from the first key >= key
+        """
+        key = _encoded(key)
+        block = max(bisect.bisect_right(self.firsts, key) - 1, 0)
+        for block in range(block, self.nblocks):
+            keys = self.block(block)
+            base = block * self.block_size
+            for i in range(bisect.bisect_left(keys, key), len(keys)):
+                yield base + i, keys[i]
+
+    def scope(self, paths):
+        """Pop all entries but those at or below the given paths
+
+        Entries below the paths are found by bisection, so the others
+        are popped without visiting them.
+        """
+        keep = {}
+        for path in paths:
+            path = _encoded(path)
+            pos = self.position(path)
+            if pos >= 0:
+                keep[pos] = self.popped[pos]
+            prefix = path + '/'
+            for pos, key in self.following(prefix):
+                if not key.startswith(prefix):
+                    break
+                keep[pos] = self.popped[pos]
+        self.popped = bytearray('\x01') * self.count
+        for pos, popped in keep.iteritems():
+            self.popped[pos] = popped
+
+    def value(self, pos):
+        value = value_struct.unpack_from(
+            self.map, self.values_offset + value_struct.size * pos)[0]
+        if value < 0:
+            start = self.digests_offset + 16 * (-value - 1)
+            value = binascii.hexlify(self.map[start:start+16])
+        elif self.legacy:
+            value = migrate(value)
+        return value
+
+    def __len__(self):
+        return self.count - sum(self.popped)
+
+    def __contains__(self, key):
+        pos = self.position(key)
+        return pos >= 0 and not self.popped[pos]
+
+    def get(self, key, default=None):
+        pos = self.position(key)
+        if pos < 0 or self.popped[pos]:
+            return default
+        return self.value(pos)
+
+    def __getitem__(self, key):
+        pos = self.position(key)
+        if pos < 0 or self.popped[pos]:
+            raise KeyError(key)
+        return self.value(pos)
+
+    missing = object()
+    def pop(self, key, default=missing):
+        pos = self.position(key)
+        if pos < 0 or self.popped[pos]:
+            if default is self.missing:
+                raise KeyError(key)
+            return default
+        self.popped[pos] = 1
+        return self.value(pos)
+
+    def iteritems(self, popped=False, encoded=False):
+        """Iterate over (path, value) items, in sorted order
+
+        By default, we iterate over entries that haven't been
+        popped. If popped is true, we iterate over entries that
+        have been.  If encoded is true, paths are UTF-8 encoded, as
+        they're stored, which saves decoding paths that are just
+        going to be written to another index.
+        """
+        popped = bool(popped)
+        for block in range(self.nblocks):
+            base = block * self.block_size
+            keys = self.block(block)
+            # Unpack the block's values at once, and only look up
+            # digests (and migrate legacy times) one at a time.
+            values = struct.unpack_from(
+                '<%sq' % len(keys), self.map,
+                self.values_offset + value_struct.size * base)
+            flags = self.popped[base:base+len(keys)]
+            unpopped = flags.count('\0')
+            if unpopped == (0 if popped else len(keys)):
+                selected = enumerate(keys) # the whole block
+            elif unpopped == (len(keys) if popped else 0):
+                continue # none of it
+            else:
+                selected = [(i, key) for i, key in enumerate(keys)
+                            if bool(flags[i]) == popped]
+            for i, key in selected:
+                value = values[i]
+                if value < 0 or self.legacy:
+                    value = self.value(base+i)
+                yield (key if encoded else key.decode('utf-8')), value
+
+    def __iter__(self):
+        for key, _ in self.iteritems():
+            yield key
+
+    def close(self):
+        if self.count:
+            self.map.close()
+
+def convert(source, dest):
+    """Convert a marshal index file to a compact index file
+    """
+    write(dest, sorted_items(load(source)))
+
+parser = optparse.OptionParser(usage=__doc__)
+
+def main(args=None):
+    if args == None:
+        args = sys.argv[1:]
+
+    options, args = parser.parse_args(args)
+    if len(args) != 2:
+        parser.error("Expected a source and destination index")
+
+    convert(*args)
+
+if __name__ == '__main__':
+    main()
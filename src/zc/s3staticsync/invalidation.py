@@ -0,0 +1,231 @@
+"""CloudFront invalidations
+
+Paths are invalidated after they've been updated or deleted in S3, in
+batches that are submitted while a sync runs, rather than all at the
+end.  Before a batch is submitted:
+
+- duplicate paths are removed,
+
+- paths in directories with many changes are collapsed into a single
+  wildcard path (``dir/*``), as CloudFront charges for a wildcard
+  path like any other path, and
+
+- we wait until CloudFront's limits on paths in in-progress
+  invalidations allow the batch.
+"""
+
+import itertools
+import logging
+import Queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 1000 # paths per request
+MAX_PATHS = 3000 # paths in in-progress invalidations
+MAX_WILDCARDS = 15 # wildcard paths in in-progress invalidations
+
+def collapse(paths, threshold, max_wildcards=MAX_WILDCARDS):
+    """Collapse paths into wildcards for directories with many changes
+
+    A directory is collapsed if at least threshold of its entries
+    (files or subdirectories) changed.  If there are more candidates
+    than max_wildcards, those covering the most paths are used.  The
+    top-level directory is never collapsed, as that would invalidate
+    everything.
+    Returns a sorted list of paths and wildcards.
+    """
+    paths = set(paths)
+    if not threshold or not max_wildcards:
+        return sorted(paths)
+
+    entries = {} # {directory: changed entries}
+    covered = {} # {directory: number of changed paths under it}
+    for path in paths:
+        name = path
+        while name:
+            directory = name.rpartition('/')[0]
+            entries.setdefault(directory, set()).add(name)
+            covered[directory] = covered.get(directory, 0) + 1
+            name = directory
+
+    candidates = sorted(
+        (-covered[directory], directory)
+        for directory, names in entries.iteritems()
+        if directory and len(names) >= threshold)
+    collapsed = set()
+    for _, directory in candidates:
+        if len(collapsed) >= max_wildcards:
+            break
+        if not under(directory, collapsed):
+            collapsed.add(directory)
+
+    result = [path for path in paths if not under(path, collapsed)]
+    result.extend(directory + '/*' for directory in collapsed)
+    result.sort()
+    return result
+
+def under(path, directories):
+    """Is a path in (or below) one of the given directories?
+    """
+    if not directories:
+        return False
+    while path:
+        path = path.rpartition('/')[0]
+        if path in directories:
+            return True
+    return False
+
+class Planner:
+    """Plan and submit invalidations for a distribution
+
+    Call add() with paths as they're updated or deleted, and close()
+    when done.  Paths are submitted, in a separate thread, when
+    BATCH_SIZE of them are pending, when the oldest pending path has
+    waited interval seconds, and on close.  We wait delay seconds
+    after a batch is ready before submitting it, to give S3 updates
+    time to propagate.
+    """
+
+    def __init__(self, connection, distribution, prefix, retries, metrics,
+                 threshold=10, interval=60, delay=9, poll=30):
+        self.connection = connection
+        self.distribution = distribution
+        self.prefix = prefix
+        self.retries = retries
+        self.metrics = metrics
+        self.threshold = threshold
+        self.interval = interval
+        self.delay = delay
+        self.poll = poll
+        self.lock = threading.Lock()
+        self.pending = set()
+        self.oldest = None
+        self.batches = Queue.Queue()
+        self.in_progress = [] # [(request id, paths, wildcards)]
+        self.thread = threading.Thread(target=self.run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def add(self, path):
+        with self.lock:
+            if not self.pending:
+                self.oldest = time.time()
+                # Wake the thread, to flush the path when it's stale.
+                self.batches.put(())
+            self.pending.add(path)
+            if len(self.pending) >= BATCH_SIZE:
+                self._flush(time.time())
+
+    def _flush(self, now):
+        # Call with the lock held
+        if self.pending:
+            self.batches.put((now, self.pending))
+            self.pending = set()
+
+    def close(self):
+        """Submit any pending paths and wait for all to be submitted
+        """
+        with self.lock:
+            self._flush(time.time())
+        self.batches.put(None)
+        self.thread.join()
+
+    def expire(self):
+        """Flush pending paths if the oldest has waited interval seconds
+
+        Return how long until it will have, or None if nothing's pending.
+        """
+        with self.lock:
+            if not self.pending:
+                return None
+            now = time.time()
+            wait = self.oldest + self.interval - now
+            if wait > 0:
+                return wait
+            self._flush(now)
+
+    def run(self):
+        while 1:
+            try:
+                batch = self.batches.get(timeout=self.expire())
+            except Queue.Empty:
+                continue
+            if batch is None:
+                return
+            if not batch:
+                continue # woken by add
+            ready, paths = batch
+            wait = ready + self.delay - time.time()
+            if wait > 0:
+                time.sleep(wait)
+            try:
+                self.submit(collapse(paths, self.threshold))
+            except Exception:
+                logger.exception('invalidating %s paths' % len(paths))
+                self.metrics.count('invalidation_errors')
+
+    def submit(self, paths):
+        wildcards = len([path for path in paths if path.endswith('*')])
+        self.wait(len(paths), wildcards)
+        for attempt in itertools.count():
+            try:
+                with self.metrics.timed('invalidate'):
+                    request = self.connection.create_invalidation_request(
+                        self.distribution,
+                        [self.prefix + path for path in paths])
+                break
+            except Exception as v:
+                delay = self.retries.backoff(v, attempt)
+                if delay is None:
+                    raise
+                logger.exception('invalidating %s paths, retrying'
+                                 % len(paths))
+                time.sleep(delay)
+
+        self.in_progress.append((request.id, len(paths), wildcards))
+        self.metrics.count('invalidation_requests')
+        self.metrics.count('invalidations', len(paths))
+        self.metrics.count('invalidation_wildcards', wildcards)
+
+    def fits(self, paths, wildcards):
+        return (sum(r[1] for r in self.in_progress) + paths <= MAX_PATHS and
+                sum(r[2] for r in self.in_progress) + wildcards
+                <= MAX_WILDCARDS)
+
+    def wait(self, paths, wildcards):
+        """Wait until in-progress invalidations leave room for a request
+        """
+        while self.in_progress and not self.fits(paths, wildcards):
+            self.in_progress = [
+                request for request in self.in_progress
+                if self.connection.invalidation_request_status(
+                    self.distribution, request[0]).status != 'Completed']
+            if self.in_progress and not self.fits(paths, wildcards):
+                time.sleep(self.poll)
+
+class Recorder:
+    """Record paths to invalidate in a file, rather than submitting them
+
+    Shards of a sharded sync record their paths, and the coordinator
+    submits them.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.paths = set()
+
+    def add(self, path):
+        self.paths.add(path)
+
+    def close(self):
+        with open(self.path, 'w') as f:
+            for path in sorted(self.paths):
+                f.write(path.encode('utf-8') + '\n')
+
+def recorded(path):
+    """Return the paths recorded in a file by a Recorder
+    """
+    with open(path) as f:
+        return [line[:-1].decode('utf-8') for line in f]
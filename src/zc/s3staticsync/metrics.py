@@ -0,0 +1,277 @@
+"""Run metrics
+
+Metrics collect phase timings, counters, queue depths, worker busy
+times and S3 operation latencies during a run, and write them as a
+JSON summary and/or a Prometheus textfile (for the node exporter's
+textfile collector) at the end.
+
+Collection is cheap: counters are updated in bulk (e.g. once per
+directory scanned, rather than once per file), and timings use a
+couple of clock reads per S3 operation, which are tiny compared to
+the operations themselves.
+"""
+
+import contextlib
+import json
+import threading
+import time
+from zc.s3staticsync.index import replacing
+
+# Latency histogram bucket upper bounds, in seconds
+BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+
+class Histogram:
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        i = 0
+        for bound in BUCKETS:
+            if value <= bound:
+                break
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        """Return (bound, cumulative count) pairs, ending with '+Inf'
+        """
+        result = []
+        total = 0
+        for bound, count in zip(BUCKETS + ('+Inf',), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+class Metrics:
+
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.phases = {}
+        self.phase_order = []
+        self.counters = {}
+        self.latencies = {}
+        self.busy = {}
+        self.depths = []
+        self.lane_depths = {} # {lane: [depth]}
+        self.stopped = threading.Event()
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def counted(self, name, items):
+        """Count the items of an iterable as they're consumed
+        """
+        n = 0
+        try:
+            for item in items:
+                n += 1
+                yield item
+        finally:
+            self.count(name, n)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Time a phase of a run
+
+        Phases may overlap (e.g. the file-system scan and S3 listing
+        run at the same time). If a phase is entered more than once,
+        times accumulate.
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+            with self.lock:
+                if name not in self.phases:
+                    self.phase_order.append(name)
+                    self.phases[name] = 0.0
+                self.phases[name] += elapsed
+
+    @contextlib.contextmanager
+    def timed(self, operation):
+        """Record the latency of an S3 operation
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+            with self.lock:
+                histogram = self.latencies.get(operation)
+                if histogram is None:
+                    histogram = self.latencies[operation] = Histogram()
+                histogram.observe(elapsed)
+
+    def worker(self, process, name=None):
+        """Wrap a job-processing function to record worker busy time
+
+        name returns the current worker's name.  By default, it's the
+        current thread's name.
+        """
+        if name is None:
+            name = lambda : threading.current_thread().name
+        def timed_process(job):
+            start = time.time()
+            try:
+                return process(job)
+            finally:
+                elapsed = time.time() - start
+                worker = name()
+                with self.lock:
+                    self.busy[worker] = self.busy.get(worker, 0.0) + elapsed
+        return timed_process
+
+    def add(self, summary):
+        """Add the counters and latencies from another run's summary
+        """
+        with self.lock:
+            for name, n in summary['counters'].items():
+                self.counters[name] = self.counters.get(name, 0) + n
+            for operation, latency in summary['latency'].items():
+                histogram = self.latencies.get(operation)
+                if histogram is None:
+                    histogram = self.latencies[operation] = Histogram()
+                previous = 0
+                for i, (_, count) in enumerate(latency['buckets']):
+                    histogram.counts[i] += count - previous
+                    previous = count
+                histogram.count += latency['count']
+                histogram.sum += latency['sum']
+
+    sample_interval = 1
+
+    def sample(self, queue):
+        """Sample a queue's depth periodically, until we're stopped
+
+        If the queue has lanes, their depths are sampled too.
+        """
+        lanes = getattr(queue, 'depths', None)
+
+        def sampler():
+            while not self.stopped.is_set():
+                self.depths.append(queue.qsize())
+                if lanes is not None:
+                    for lane, depth in lanes().iteritems():
+                        self.lane_depths.setdefault(lane, []).append(depth)
+                # Event.wait, unlike time.sleep, returns when stopped.
+                self.stopped.wait(self.sample_interval)
+
+        self.sampler = threading.Thread(target=sampler, name='sampler')
+        self.sampler.setDaemon(True)
+        self.sampler.start()
+
+    sampler = None
+
+    def stop(self):
+        """Stop sampling, if we're sampling
+        """
+        self.stopped.set()
+        if self.sampler is not None:
+            self.sampler.join()
+
+    def summary(self):
+        self.stop()
+        elapsed = time.time() - self.started
+        depths = self.depths or [0]
+        queue = dict(samples=len(self.depths), max=max(depths),
+                     mean=float(sum(depths)) / len(depths))
+        if self.lane_depths:
+            queue['lanes'] = dict(
+                (lane, dict(max=max(depths),
+                            mean=float(sum(depths)) / len(depths)))
+                for lane, depths in self.lane_depths.items())
+        return dict(
+            elapsed=elapsed,
+            phases=dict(self.phases),
+            counters=dict(self.counters),
+            queue=queue,
+            workers=dict((name, dict(busy=busy, idle=max(elapsed - busy, 0)))
+                         for name, busy in self.busy.items()),
+            latency=dict(
+                (operation, dict(
+                    count=histogram.count, sum=histogram.sum,
+                    buckets=[[bound, count]
+                             for bound, count in histogram.cumulative()]))
+                for operation, histogram in self.latencies.items()),
+            )
+
+    def prometheus(self, summary):
+        name = self.name
+        lines = []
+
+        def metric(metric, kind, help, samples):
+            lines.append('# HELP %s_%s %s' % (name, metric, help))
+            lines.append('# TYPE %s_%s %s' % (name, metric, kind))
+            for labels, value in samples:
+                if labels:
+                    labels = '{%s}' % ','.join(
+                        '%s="%s"' % label for label in labels)
+                lines.append('%s_%s%s %s' % (name, metric, labels, value))
+
+        metric('elapsed_seconds', 'gauge', 'Duration of the run.',
+               [('', summary['elapsed'])])
+        metric('phase_seconds', 'gauge', 'Duration of each phase.',
+               [((('phase', phase),), summary['phases'][phase])
+                for phase in self.phase_order])
+        for counter in sorted(summary['counters']):
+            metric(counter + '_total', 'counter', counter.replace('_', ' '),
+                   [('', summary['counters'][counter])])
+        metric('queue_depth_max', 'gauge', 'Maximum work-queue depth.',
+               [('', summary['queue']['max'])])
+        metric('queue_depth_mean', 'gauge', 'Mean work-queue depth.',
+               [('', summary['queue']['mean'])])
+        lanes = summary['queue'].get('lanes', {})
+        if lanes:
+            metric('lane_depth_max', 'gauge',
+                   'Maximum work-queue depth by lane.',
+                   [((('lane', lane),), lanes[lane]['max'])
+                    for lane in sorted(lanes)])
+            metric('lane_depth_mean', 'gauge',
+                   'Mean work-queue depth by lane.',
+                   [((('lane', lane),), lanes[lane]['mean'])
+                    for lane in sorted(lanes)])
+        metric('worker_busy_seconds', 'gauge', 'Time workers were busy.',
+               [((('worker', worker),), summary['workers'][worker]['busy'])
+                for worker in sorted(summary['workers'])])
+
+        lines.append('# HELP %s_request_seconds S3 request latencies.' % name)
+        lines.append('# TYPE %s_request_seconds histogram' % name)
+        for operation in sorted(summary['latency']):
+            latency = summary['latency'][operation]
+            for bound, count in latency['buckets']:
+                lines.append('%s_request_seconds_bucket{op="%s",le="%s"} %s'
+                             % (name, operation, bound, count))
+            lines.append('%s_request_seconds_sum{op="%s"} %s'
+                         % (name, operation, latency['sum']))
+            lines.append('%s_request_seconds_count{op="%s"} %s'
+                         % (name, operation, latency['count']))
+
+        return '\n'.join(lines) + '\n'
+
+    def write(self, json_path=None, prometheus_path=None):
+        """Write the metrics, in either or both formats
+
+        Files are written atomically, as they may be read by other
+        processes at any time.
+        """
+        summary = self.summary()
+        if json_path:
+            write_atomically(json_path, json.dumps(summary, indent=1,
+                                                   sort_keys=True) + '\n')
+        if prometheus_path:
+            write_atomically(prometheus_path, self.prometheus(summary))
+        return summary
+
+def write_atomically(path, data):
+    with replacing(path) as tmp:
+        with open(tmp, 'w') as f:
+            f.write(data)
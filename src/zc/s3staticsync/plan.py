@@ -0,0 +1,192 @@
+""" usage: %prog [options] plan
+
+Summarize a change plan.
+
+A sync can write the changes it would make to a plan (--plan),
+rather than making them, and a later sync (possibly on another host)
+can apply the plan (--apply).  Planning needs only the file system
+and an index (or a bucket listing), so it's cheap.
+
+Plans are streams of marshaled tuples, written in the order they were
+planned:
+
+('upload', path, mtime, size, update)
+    Upload a file.  update is true if it replaces an S3 object, which
+    we'll need to invalidate.
+
+('generate', path, previous)
+    Generate an index.html page.  previous is the fingerprint of the
+    page in S3, if any.
+
+('delete', path)
+    Delete an S3 object.
+
+('planned',)
+    The plan is complete.
+
+As a plan is applied, ('done', path) records are appended, so that,
+if it's applied again, completed actions are skipped.  This lets an
+interrupted or budget-limited (--max-bytes, --max-ops) application
+be resumed.
+"""
+
+import marshal
+import optparse
+import sys
+import threading
+
+UPLOAD, GENERATE, DELETE, PLANNED, DONE = (
+    'upload', 'generate', 'delete', 'planned', 'done')
+ACTIONS = UPLOAD, GENERATE, DELETE
+
+class Counts(dict):
+    """Counts of actions, and of bytes to upload
+    """
+
+    def __init__(self):
+        dict.__init__(self, upload=0, generate=0, delete=0, bytes=0)
+
+    def add(self, record):
+        self[record[0]] += 1
+        if record[0] == UPLOAD:
+            self['bytes'] += record[3]
+
+    def __str__(self):
+        return ("%(upload)s uploads (%(bytes)s bytes),"
+                " %(generate)s generated pages, %(delete)s deletes" % self)
+
+class PlanWriter:
+    """Write a plan
+
+    Actions may be added from multiple threads.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'wb')
+        self.lock = threading.Lock()
+        self.counts = Counts()
+
+    def record(self, *record):
+        with self.lock:
+            marshal.dump(record, self.file)
+            if record[0] in ACTIONS:
+                self.counts.add(record)
+
+    def upload(self, path, mtime, size, update):
+        self.record(UPLOAD, path, mtime, size, bool(update))
+
+    def generate(self, path, previous):
+        self.record(GENERATE, path, previous)
+
+    def delete(self, path):
+        self.record(DELETE, path)
+
+    def close(self):
+        self.record(PLANNED)
+        self.file.close()
+
+def records(path):
+    """Iterate over the records in a plan file
+
+    A partially-written record at the end (from an interrupted apply)
+    is ignored.
+    """
+    with open(path, 'rb') as f:
+        while 1:
+            try:
+                yield marshal.load(f)
+            except (EOFError, ValueError, TypeError):
+                break
+
+class Plan:
+    """A plan being applied
+
+    Iterating over a plan yields the actions that haven't been done.
+    Call completed() when an action is done.
+    """
+
+    # Completed actions are flushed in batches. If we're killed, at
+    # most this many are done again.
+    flush_interval = 100
+
+    def __init__(self, path):
+        self.path = path
+        self.done = set()
+        planned = False
+        end = 0
+        with open(path, 'rb') as f:
+            while 1:
+                try:
+                    record = marshal.load(f)
+                except (EOFError, ValueError, TypeError):
+                    break # end, or a partially-written record
+                end = f.tell()
+                if record[0] == DONE:
+                    self.done.add(record[1])
+                elif record[0] == PLANNED:
+                    planned = True
+        if not planned:
+            raise ValueError("Incomplete plan", path)
+
+        self.lock = threading.Lock()
+        self.unflushed = 0
+        # Append after the last complete record.
+        self.file = open(path, 'r+b')
+        self.file.seek(end)
+        self.file.truncate()
+
+    def __iter__(self):
+        return remaining(self.path, self.done)
+
+    def completed(self, path):
+        with self.lock:
+            marshal.dump((DONE, path), self.file)
+            self.unflushed += 1
+            if self.unflushed >= self.flush_interval:
+                self.file.flush()
+                self.unflushed = 0
+
+    def close(self):
+        self.file.close()
+
+def completed(path):
+    """Return the paths of the completed actions in a plan
+    """
+    return set(record[1] for record in records(path) if record[0] == DONE)
+
+def remaining(path, done):
+    """Iterate over the actions in a plan that aren't done
+    """
+    for record in records(path):
+        if record[0] == PLANNED:
+            # Stop before done records, which may be being written.
+            break
+        if record[1] not in done:
+            yield record
+
+parser = optparse.OptionParser(usage=__doc__)
+parser.add_option('-v', '--verbose', action='store_true',
+                  help="List the actions that haven't been done.")
+
+def main(args=None):
+    if args == None:
+        args = sys.argv[1:]
+
+    options, args = parser.parse_args(args)
+    if len(args) != 1:
+        parser.error("Expected a plan")
+    [path] = args
+
+    planned = Counts()
+    for record in records(path):
+        if record[0] in ACTIONS:
+            planned.add(record)
+    left = Counts()
+    for record in remaining(path, completed(path)):
+        left.add(record)
+        if options.verbose:
+            print u' '.join(unicode(field) for field in record).encode(
+                'utf-8')
+    print "planned:", planned
+    print "remaining:", left
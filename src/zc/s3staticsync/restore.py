@@ -1,10 +1,26 @@
 """ usage: %prog [options] bucket destdir
 
 Restore data from S3. Ignoring the file index, which may be out of date.
+
+If a sync index is given (-i), it's used only as a manifest of
+generated index.html pages, which aren't restored.  Without one, we
+check each index.html object's metadata.
+
+Files are downloaded to temporary files, which are renamed into place
+when complete, so interrupted downloads never leave partial files.
+Large files are downloaded in parallel ranges.
+
+With a journal (-j), an interrupted restore can be resumed without
+listing the bucket again or downloading files that were already
+restored.  The journal records the bucket listing and then each
+completed download.  It's removed when a restore completes without
+errors.
 """
 
 import boto.s3.connection
 import boto.s3.key
+import hashlib
+import itertools
 import logging
 import optparse
 import os
@@ -13,10 +29,53 @@ import Queue
 import sys
 import threading
 import time
+from zc.s3staticsync import index as indexfile
+from zc.s3staticsync import list_bucket, MB
+from zc.s3staticsync.connection import ConnectionPool
+from zc.s3staticsync.engine import create_engine
+from zc.s3staticsync.metrics import Metrics
+from zc.s3staticsync.retry import Limiter, Retries
 
 parser = optparse.OptionParser(usage=__doc__)
 parser.add_option('-w', '--worker-threads', type='int', default=9)
 parser.add_option('-e', '--file-system-encoding', default='latin-1')
+parser.add_option('-E', '--engine', choices=['threads', 'gevent'],
+                  default='threads',
+                  help="How to run S3 operations: in worker threads"
+                  " (default) or in gevent greenlets (requires gevent).")
+parser.add_option('--in-flight', type='int', default=1000,
+                  help="The maximum number of S3 operations in flight"
+                  " with the gevent engine.")
+parser.add_option('--retries', type='int', default=4,
+                  help="How many times to retry failed S3 operations.")
+parser.add_option('--retry-delay', type='float', default=1,
+                  help="Seconds to wait before the first retry. The delay"
+                  " doubles (with jitter) for each further retry.")
+parser.add_option('--retry-max-delay', type='float', default=60,
+                  help="The maximum number of seconds between retries.")
+parser.add_option('-i', '--index',
+                  help="A sync index, used to identify generated"
+                  " index.html pages, so we don't have to check them.")
+parser.add_option('-j', '--journal',
+                  help="A checkpoint journal, used to resume an"
+                  " interrupted restore.")
+parser.add_option('-L', '--s3-listers', type='int', default=1,
+                  help="Number of threads used to list the S3 bucket.")
+parser.add_option('-m', '--multipart-threshold', type='int', default=64,
+                  help="Download files larger than this many megabytes"
+                  " in parallel ranges.")
+parser.add_option('--multipart-part-size', type='int', default=16,
+                  help="The size, in megabytes, of download ranges.")
+parser.add_option('--multipart-threads', type='int', default=4,
+                  help="Number of threads downloading ranges of large files.")
+parser.add_option('--checksum', action='store_true',
+                  help="Compare md5 checksums of files that are the same"
+                  " size as S3 objects with the objects' ETags.")
+parser.add_option('--metrics-json',
+                  help="Write run metrics to the given file, as JSON.")
+parser.add_option('--metrics-prometheus',
+                  help="Write run metrics to the given file, in the"
+                  " Prometheus text format.")
 
 logger = logging.getLogger(__name__)
 
@@ -28,6 +87,86 @@ def thread(func, *args):
 
 DOWNLOAD, DELETE = 'download', None
 INDEX_HTML = 'index.html'
+TEMP_SUFFIX = '.s3restore'
+
+class Journal:
+    """Checkpoint journal
+
+    Records are marshaled tuples, appended to the file:
+
+    ('key', path, size, etag)
+        An S3 object to be restored
+
+    ('listed',)
+        The listing is complete
+
+    ('done', path)
+        A file was restored
+
+    A journal without a complete listing is discarded.
+    """
+
+    # Completed downloads are flushed in batches. If we're killed, at
+    # most this many are downloaded again.
+    flush_interval = 100
+
+    def __init__(self, path):
+        self.path = path
+        self.listing = None
+        self.done = set()
+        self.lock = threading.Lock()
+        self.unflushed = 0
+
+        listing = {}
+        listed = False
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                while 1:
+                    try:
+                        record = marshal.load(f)
+                    except (EOFError, ValueError, TypeError):
+                        break # end, or a partially-written record
+                    if record[0] == 'key':
+                        listing[record[1]] = record[2:]
+                    elif record[0] == 'listed':
+                        listed = True
+                    elif record[0] == 'done':
+                        self.done.add(record[1])
+
+        if listed:
+            self.listing = listing
+            self.file = open(path, 'ab')
+        else:
+            self.done.clear()
+            self.file = open(path, 'wb')
+
+    def record(self, *record):
+        with self.lock:
+            marshal.dump(record, self.file)
+
+    def listed(self):
+        self.record('listed')
+        self.file.flush()
+
+    def completed(self, path):
+        with self.lock:
+            marshal.dump(('done', path), self.file)
+            self.unflushed += 1
+            if self.unflushed >= self.flush_interval:
+                self.file.flush()
+                self.unflushed = 0
+
+    def close(self, remove=False):
+        self.file.close()
+        if remove:
+            os.remove(self.path)
+
+def md5(path):
+    digest = hashlib.md5()
+    with open(path, 'rb') as f:
+        for data in iter(lambda: f.read(1 << 20), ''):
+            digest.update(data)
+    return digest.hexdigest()
 
 def main(args=None):
     if args == None:
@@ -36,6 +175,17 @@ def main(args=None):
 
     options, args = parser.parse_args(args)
 
+    if options.engine == 'gevent':
+        from zc.s3staticsync.engine import patch
+        patch()
+
+    metrics = Metrics('s3staticrestore')
+    try:
+        restore(options, args, metrics)
+    finally:
+        metrics.stop()
+
+def restore(options, args, metrics):
     encoding = options.file_system_encoding
     s3 = {}
 
@@ -53,55 +203,152 @@ def main(args=None):
     queue = Queue.Queue(maxsize=999)
     put = queue.put
 
-    def worker(base_path):
-        while 1:
-            try:
-                op, queued_path = queue.get()
+    manifest = indexfile.load(options.index) if options.index else None
+    journal = Journal(options.journal) if options.journal else None
+    failures = []
 
-                path = queued_path
-                if path is None:
-                    return
+    base_path = path
+    engine = create_engine(options)
+    limiter = Limiter(engine.Condition(), engine.concurrency)
+    retries = Retries(queue, limiter, options.retries,
+                      options.retry_delay, options.retry_max_delay)
 
-                fspath = os.path.join(base_path, path)
+    # Large files are downloaded in ranges by a pool of part threads,
+    # which write to the file at the range offsets.
 
-                if op is DELETE:
-                    try:
-                        os.remove(fspath)
-                    except Exception:
-                        raise
+    multipart_threshold = options.multipart_threshold * MB
+    parts = Queue.Queue()
 
-                else: # download
-                    try:
-                        key = boto.s3.key.Key(bucket)
-                        key.key = bucket_prefix + path
+    def part_worker():
+        while 1:
+            job = parts.get()
+            if job is None:
+                return
+            name, tmppath, start, end, results = job
+            try:
+                key = boto.s3.key.Key(connections.bucket())
+                key.key = name
+                with open(tmppath, 'r+b') as fp:
+                    for attempt in itertools.count():
                         try:
-                            parent = os.path.dirname(fspath)
-                            if not os.path.exists(parent):
-                                try:
-                                    os.makedirs(parent)
-                                except OSError:
-                                    if not os.path.exists(parent):
-                                        raise
-
-                            key.get_contents_to_filename(
-                                fspath.encode(encoding))
-                        except Exception:
+                            fp.seek(start)
+                            with metrics.timed('get_range'):
+                                key.get_contents_to_file(
+                                    fp, headers={'Range': 'bytes=%s-%s'
+                                                 % (start, end-1)})
+                            break
+                        except Exception as v:
+                            delay = retries.backoff(v, attempt)
+                            if delay is None:
+                                raise
                             logger.exception(
-                                'downloading %r, retrying' % fspath)
-                            time.sleep(9)
-                            key.get_contents_to_filename(
-                                fspath.encode(encoding))
-
-                    except Exception:
-                        raise
+                                'downloading bytes %s-%s of %r, retrying'
+                                % (start, end-1, name))
+                            key.bucket = connections.reset()
+                            time.sleep(delay)
+            except Exception as v:
+                results.put(v)
+            else:
+                results.put(None)
+
+    def download(key, fspath, size):
+        tmppath = fspath + TEMP_SUFFIX
+        try:
+            if size > multipart_threshold:
+                with open(tmppath, 'wb') as fp:
+                    fp.truncate(size)
+                results = Queue.Queue()
+                part_size = options.multipart_part_size * MB
+                offsets = range(0, size, part_size)
+                for start in offsets:
+                    parts.put((key.key, tmppath, start,
+                               min(start + part_size, size), results))
+                errors = [error for error in [engine.get(results)
+                                              for _ in offsets]
+                          if error is not None]
+                metrics.count('ranges', len(offsets))
+                if errors:
+                    raise errors[0]
+            else:
+                with open(tmppath, 'wb') as fp:
+                    with metrics.timed('get'):
+                        key.get_contents_to_file(fp)
+            os.rename(tmppath, fspath)
+        except Exception:
+            if os.path.exists(tmppath):
+                os.remove(tmppath)
+            raise
+
+    def process(job):
+        op = path = None
+        deferred = False
+        try:
+            op, queued_path = job[:2]
+
+            if op is DELETE:
+                path = queued_path
+                fspath = os.path.join(base_path, path)
+                os.remove(fspath)
+                metrics.count('deletes')
 
-            except Exception:
-                logger.exception('processing %r %r' % (op, path))
-            finally:
+            else: # download
+                path, size = queued_path
+                fspath = os.path.join(base_path, path)
+                key = boto.s3.key.Key(connections.bucket())
+                key.key = bucket_prefix + path
+                try:
+                    parent = os.path.dirname(fspath)
+                    if not os.path.exists(parent):
+                        try:
+                            os.makedirs(parent)
+                        except OSError:
+                            if not os.path.exists(parent):
+                                raise
+
+                    with limiter:
+                        download(key, fspath.encode(encoding), size)
+                except Exception:
+                    if retries.defer(job, sys.exc_info()[1]):
+                        logger.exception(
+                            'downloading %r, retrying' % fspath)
+                        connections.reset()
+                        deferred = True
+                        return
+                    raise
+
+                metrics.count('downloads')
+                metrics.count('bytes_downloaded', size)
+                if journal is not None:
+                    journal.completed(path)
+
+        except Exception:
+            failures.append(path)
+            logger.exception('processing %r %r' % (op, path))
+        finally:
+            if not deferred:
                 queue.task_done()
 
-    workers = [thread(worker, path)
-               for i in range(options.worker_threads)]
+    s3conn = boto.s3.connection.S3Connection()
+    bucket = s3conn.get_bucket(bucket_name)
+    # Workers use their own connections. Set them up before starting
+    # workers, as jobs may be queued as soon as we start scanning.
+    connections = ConnectionPool(bucket_name, engine.local())
+
+    engine.start(queue, metrics.worker(process, engine.worker_name))
+    metrics.sample(queue)
+    part_workers = [thread(part_worker)
+                    for i in range(options.multipart_threads)]
+
+    def needed(path, size, s3size, etag):
+        # Decide whether to download a file, given its local size
+        if journal is not None and path in journal.done:
+            return False
+        if size != s3size:
+            return True
+        if options.checksum and '-' not in etag: # not multipart
+            fspath = os.path.join(base_path, path).encode(encoding)
+            return md5(fspath) != etag.strip('"')
+        return False
 
     # As we build up the 2 dicts, we try to identify cases we can
     # eliminate right away, or cases we can begin handling, so we can
@@ -109,11 +356,16 @@ def main(args=None):
     # sooner.
 
     def listfs(path, base):
-        for name in sorted(os.listdir(path)):
+        names = sorted(os.listdir(path))
+        metrics.count('directories_scanned')
+        for name in names:
             pname = os.path.join(path, name)
             rname = os.path.join(base, name)
             if os.path.isdir(pname):
                 listfs(pname, rname)
+            elif name.endswith(TEMP_SUFFIX):
+                # Left over from an interrupted download
+                os.remove(pname)
             else:
                 try:
                     size = os.stat(pname).st_size
@@ -124,53 +376,91 @@ def main(args=None):
                 key = rname.decode(encoding)
                 if key in s3:
                     # We can go ahead and do the check
-                    s3size = s3.pop(key)
-                    if s3size != size:
-                        put((DOWNLOAD, key))
+                    s3size, etag = s3.pop(key)
+                    if needed(key, size, s3size, etag):
+                        put((DOWNLOAD, (key, s3size)))
                 else:
                     fs[key] = size
 
-    fs_thread = thread(listfs, path, '')
+    def scan(path):
+        with metrics.phase('scan'):
+            listfs(path, '')
 
-    s3conn = boto.s3.connection.S3Connection()
-    bucket = s3conn.get_bucket(bucket_name)
+    fs_thread = thread(scan, path)
 
-    @thread
-    def s3_thread():
-        for key in bucket.list(bucket_prefix):
-            s3size = key.size
+    def generated(path):
+        if manifest is not None:
+            # Generated pages have digests rather than times
+            return isinstance(manifest.get(path), basestring)
+        key = bucket.get_key(bucket_prefix + path)
+        return key.get_metadata('generated') == 'true'
+
+    def list_s3():
+        if journal is not None and journal.listing is not None:
+            # Resuming
+            for path, (s3size, etag) in journal.listing.iteritems():
+                yield path, s3size, etag
+            return
+
+        for key in metrics.counted('keys_listed', list_bucket(
+            bucket, bucket_prefix, options.s3_listers)):
             path = key.key[len_bucket_prefix:]
+            if (path.endswith(INDEX_HTML) and path.endswith("/"+INDEX_HTML)
+                and generated(path)):
+                continue
+            if journal is not None:
+                journal.record('key', path, key.size, key.etag)
+            yield path, key.size, key.etag
 
-            if path in fs:
-                size = fs.pop(path)
-                if size != s3size:
-                    put((DOWNLOAD, path))
-            else:
-                if path.endswith(INDEX_HTML) and path.endswith("/"+INDEX_HTML):
-                    key = bucket.get_key(path)
-                    if key.get_metadata('generated') == 'true':
-                        continue
-                s3[path] = s3size
+        if journal is not None:
+            journal.listed()
+
+    @thread
+    def s3_thread():
+        with metrics.phase('list_s3'):
+            for path, s3size, etag in list_s3():
+                if path in fs:
+                    size = fs.pop(path)
+                    if needed(path, size, s3size, etag):
+                        put((DOWNLOAD, (path, s3size)))
+                else:
+                    s3[path] = s3size, etag
 
     s3_thread.join()
 
     fs_thread.join()
 
-    for (path, s3size) in s3.iteritems():
-        size = fs.pop(path, -1)
-        if s3size != size:
-            put((DOWNLOAD, path))
+    with metrics.phase('diff'):
+        for (path, (s3size, etag)) in s3.iteritems():
+            size = fs.pop(path, -1)
+            if needed(path, size, s3size, etag):
+                put((DOWNLOAD, (path, s3size)))
 
-    for path in fs:
-        put((DELETE, path))
+        for path in fs:
+            put((DELETE, path))
 
-    queue.join()
+    with metrics.phase('drain'):
+        queue.join()
 
-    for _ in workers:
-        put((None, None))
-    for w in workers:
+    engine.stop(queue)
+    for _ in part_workers:
+        parts.put(None)
+    for w in part_workers:
         w.join()
 
+    if journal is not None:
+        # Keep the journal if there were errors, so a rerun only
+        # retries what failed.
+        journal.close(remove=not failures)
+
+    logger.info("S3 connections: %(connections)s, reused: %(reuses)s,"
+                " reset: %(resets)s, expired: %(expired)s"
+                % connections.stats())
+
+    metrics.count('failures', len(failures))
+    metrics.count('retries', retries.retried)
+    metrics.count('throttles', limiter.throttles)
+    metrics.write(options.metrics_json, options.metrics_prometheus)
+
 if __name__ == '__main__':
     main()
-
@@ -0,0 +1,202 @@
+"""Retrying failed S3 operations
+
+Failed operations are retried with exponential backoff and jitter.
+Errors are classified, so we don't retry errors that won't go away,
+like missing local files or access errors.  When S3 throttles us, we
+also lower a global limit on the number of operations in flight, and
+raise it again gradually as operations succeed.
+
+Rather than sleeping in workers, failed jobs are deferred: they're put
+back on the work queue when their delay has passed, so a failing item
+doesn't tie up a worker.
+"""
+
+import boto.exception
+import heapq
+import itertools
+import random
+import socket
+import threading
+import time
+
+# Our own generator, so jitter doesn't disturb other users of random
+jitter = random.Random()
+
+THROTTLED, TRANSIENT, FATAL = 'throttled', 'transient', 'fatal'
+
+throttle_codes = set((
+    'SlowDown', 'Throttling', 'ThrottlingException', 'RequestLimitExceeded',
+    'TooManyRequests',
+    ))
+
+transient_codes = set((
+    'RequestTimeout', 'RequestTimeTooSkewed', 'InternalError',
+    'ExpiredToken', 'OperationAborted',
+    ))
+
+def classify(exception):
+    """Classify an exception as THROTTLED, TRANSIENT, or FATAL
+    """
+    status = getattr(exception, 'status', None)
+    code = getattr(exception, 'error_code', None)
+    if status in (429, 503) or code in throttle_codes:
+        return THROTTLED
+    if isinstance(exception, boto.exception.BotoServerError):
+        if code in transient_codes or (status or 0) >= 500:
+            return TRANSIENT
+        return FATAL # Access denied, no such bucket, etc.
+    if (isinstance(exception, EnvironmentError)
+        and not isinstance(exception, socket.error)
+        and getattr(exception, 'filename', None)
+        ):
+        return FATAL # Problem with a local file
+    return TRANSIENT
+
+class Limiter:
+    """Adaptive limit on the number of operations in flight
+
+    The limit is halved when S3 throttles us (at most once a second)
+    and is increased by one after limit successful operations
+    (additive increase, multiplicative decrease).
+
+    Use it as a context manager around S3 operations.
+    """
+
+    def __init__(self, condition, maximum):
+        self.condition = condition
+        self.maximum = self.limit = max(maximum, 1)
+        self.active = self.successes = self.throttles = 0
+        self.decreased = 0
+
+    def __enter__(self):
+        with self.condition:
+            while self.active >= self.limit:
+                self.condition.wait()
+            self.active += 1
+
+    def __exit__(self, t, v, tb):
+        with self.condition:
+            self.active -= 1
+            if t is None and self.limit < self.maximum:
+                self.successes += 1
+                if self.successes >= self.limit:
+                    self.successes = 0
+                    self.limit += 1
+            self.condition.notify_all()
+
+    def throttled(self):
+        with self.condition:
+            self.throttles += 1
+            now = time.time()
+            if now - self.decreased >= 1:
+                self.decreased = now
+                self.limit = max(1, self.limit // 2)
+                self.successes = 0
+
+class Retries:
+    """Retry policy and scheduler for deferred jobs
+
+    Jobs are tuples of a fixed number of fields, to which requeued
+    jobs add their attempt numbers.
+    """
+
+    def __init__(self, queue, limiter, attempts=4, delay=1, max_delay=60,
+                 fields=2):
+        self.queue = queue
+        self.fields = fields
+        self.limiter = limiter
+        self.attempts = attempts
+        self.base_delay = delay
+        self.max_delay = max_delay
+        self.deferred = []
+        self.lock = threading.Lock()
+        self.sequence = itertools.count()
+        self.retried = 0
+
+    def delay(self, attempt):
+        """Compute a delay for an attempt (counting from 0)
+
+        We use exponential backoff with "equal" jitter: half of the
+        delay is fixed and half random, so retries are spread out, but
+        not too early.
+        """
+        delay = min(self.max_delay, self.base_delay * 2 ** attempt)
+        return delay / 2.0 + jitter.uniform(0, delay / 2.0)
+
+    def backoff(self, exception, attempt):
+        """Decide whether to retry after an exception
+
+        Return the number of seconds to wait before retrying, or None
+        if we shouldn't retry.
+        """
+        kind = classify(exception)
+        if kind == THROTTLED:
+            self.limiter.throttled()
+        if kind == FATAL or attempt >= self.attempts:
+            return None
+        with self.lock:
+            self.retried += 1
+        return self.delay(attempt)
+
+    def attempt(self, job):
+        """Return the attempt number of a (possibly requeued) job
+        """
+        fields = self.fields
+        return job[fields] if len(job) > fields else 0
+
+    def defer(self, job, exception):
+        """Defer a failed job, if it should be retried
+
+        The job is requeued, with an incremented attempt number, after
+        a delay. Returns whether the job was deferred. If it was, the
+        caller should not mark it done; we'll do that when we requeue
+        it, so queue.join() waits for retries.
+        """
+        attempt = self.attempt(job)
+        delay = self.backoff(exception, attempt)
+        if delay is None:
+            return False
+
+        with self.lock:
+            heapq.heappush(self.deferred, (
+                time.time() + delay, next(self.sequence), job, attempt + 1))
+            if len(self.deferred) == 1 and not self.running:
+                self.running = True
+                self.thread = threading.Thread(target=self.run)
+                self.thread.setDaemon(True)
+                self.thread.start()
+        return True
+
+    running = False
+    thread = None
+    interval = 1
+
+    def close(self):
+        """Drop deferred jobs and wait for the requeueing thread to stop
+
+        Call this when giving up on a run, after its workers are
+        stopped.
+        """
+        with self.lock:
+            del self.deferred[:]
+            thread = self.thread
+        if thread is not None:
+            thread.join()
+
+    def run(self):
+        # Requeue deferred jobs when they're due. We sleep in short
+        # steps, so jobs deferred while we sleep aren't delayed much.
+        while 1:
+            with self.lock:
+                if not self.deferred:
+                    self.running = False
+                    return
+                due, _, job, attempt = self.deferred[0]
+                wait = due - time.time()
+                if wait <= 0:
+                    heapq.heappop(self.deferred)
+            if wait > 0:
+                time.sleep(min(wait, self.interval))
+            else:
+                self.queue.put(job[:self.fields] + (attempt,))
+                self.queue.task_done() # for the failed attempt
@@ -0,0 +1,471 @@
+"""A local S3 stand-in, for benchmarks
+
+The server implements the parts of the S3 REST API we use: bucket
+listings (with prefixes, delimiters and markers), object puts, gets
+(including ranges), heads, copies and deletes, multi-object deletes
+and multipart uploads.  Objects are kept in memory, and authentication
+is ignored.
+
+boto reaches the server as an HTTP proxy, so no DNS or host
+configuration is needed; see ``boto_config``.
+
+Each request can be delayed (``latency``), and a fraction of them
+can be throttled (``throttle``), to simulate a remote S3.  Requests
+are counted by operation.
+"""
+
+import BaseHTTPServer
+import bisect
+import email.utils
+import hashlib
+import itertools
+import random
+import re
+import socket
+import SocketServer
+import sys
+import threading
+import time
+import urllib
+import urlparse
+import xml.etree.ElementTree
+from xml.sax.saxutils import escape
+
+NS = 'http://s3.amazonaws.com/doc/2006-03-01/'
+MAX_KEYS = 1000
+
+class Object:
+
+    def __init__(self, data, metadata, content_type):
+        self.data = data
+        self.metadata = metadata
+        self.content_type = content_type
+        self.etag = '"%s"' % hashlib.md5(data).hexdigest()
+        self.modified = time.time()
+
+def iso8601(t):
+    return time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime(t))
+
+class Bucket:
+
+    def __init__(self):
+        self.objects = {}
+        self.sorted = None # sorted keys, computed when listing
+        # So a listing can't cache keys while they're being changed
+        self.lock = threading.Lock()
+
+    def keys(self):
+        with self.lock:
+            if self.sorted is None:
+                self.sorted = sorted(self.objects)
+            return self.sorted
+
+    def put(self, key, ob):
+        with self.lock:
+            if key not in self.objects:
+                self.sorted = None
+            self.objects[key] = ob
+
+    def delete(self, key):
+        with self.lock:
+            if self.objects.pop(key, None) is not None:
+                self.sorted = None
+
+    def list(self, prefix, marker, delimiter, max_keys):
+        """Return a page of (keys, prefixes, truncated)
+        """
+        keys = self.keys()
+        if marker:
+            i = bisect.bisect_right(keys, marker)
+        else:
+            i = bisect.bisect_left(keys, prefix)
+        contents = []
+        prefixes = []
+        while i < len(keys):
+            key = keys[i]
+            if not key.startswith(prefix):
+                break
+            if len(contents) + len(prefixes) >= max_keys:
+                return contents, prefixes, True
+            rest = key[len(prefix):]
+            if delimiter and delimiter in rest:
+                common = prefix + rest.split(delimiter, 1)[0] + delimiter
+                prefixes.append(common)
+                # Skip the rest of the keys under the common prefix
+                i = bisect.bisect_left(keys, common + '\xff')
+            else:
+                contents.append(key)
+                i += 1
+        return contents, prefixes, False
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """S3 stand-in
+
+    Pass port 0 to listen on a free port, available as ``port``.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+    # Workers connect all at once.  With a short listen backlog, some
+    # connections would be retried a second later.
+    request_queue_size = 128
+
+    def __init__(self, port=0, latency=0, throttle=0, seed=None):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port), Handler)
+        self.port = self.server_address[1]
+        self.latency = latency
+        self.throttle = throttle
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.buckets = {}
+        self.uploads = {}
+        self.upload_ids = itertools.count(1)
+        self.requests = {}
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def bucket(self, name):
+        # Buckets are created as they're used.
+        bucket = self.buckets.get(name)
+        if bucket is None:
+            bucket = self.buckets[name] = Bucket()
+        return bucket
+
+    def count(self, operation):
+        with self.lock:
+            self.requests[operation] = self.requests.get(operation, 0) + 1
+
+    def reset(self):
+        """Return the request counts, and start counting again
+        """
+        with self.lock:
+            requests = self.requests
+            self.requests = {}
+        return requests
+
+    def throttled(self):
+        with self.lock:
+            return self.throttle and self.random.random() < self.throttle
+
+def boto_config(port):
+    """Return boto configuration text for using a server on a port
+    """
+    return '\n'.join((
+        '[Credentials]',
+        'aws_access_key_id = benchmark',
+        'aws_secret_access_key = benchmark',
+        '[Boto]',
+        'is_secure = False',
+        'proxy = 127.0.0.1',
+        'proxy_port = %s' % port,
+        # We want to see how our code handles throttling.
+        'num_retries = 0',
+        '[s3]',
+        'calling_format = boto.s3.connection.OrdinaryCallingFormat',
+        '')) + '\n'
+
+TCP_QUICKACK = getattr(socket, 'TCP_QUICKACK', 12 if
+                       sys.platform.startswith('linux') else None)
+
+def quickack(connection):
+    # httplib sends request headers and bodies separately, so, with
+    # Nagle's algorithm, the body waits for the headers to be
+    # acknowledged.  Acknowledge them right away, rather than after the
+    # delayed-ACK timeout, which would dominate request times.
+    if TCP_QUICKACK is not None:
+        connection.setsockopt(socket.IPPROTO_TCP, TCP_QUICKACK, 1)
+
+VIRTUAL_HOST_SUFFIX = '.s3.amazonaws.com'
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1' # keep connections alive
+    # Send each response in as few packets as we can.
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def handle_request(self, method):
+        url = urlparse.urlsplit(self.path)
+        query = urlparse.parse_qs(url.query, keep_blank_values=True)
+        path = urllib.unquote(url.path).lstrip('/')
+        host = (url.netloc or self.headers.get('host', '')).split(':')[0]
+        if host.endswith(VIRTUAL_HOST_SUFFIX):
+            # Virtual-host style, boto's default
+            bucket_name, key = host[:-len(VIRTUAL_HOST_SUFFIX)], path
+        else:
+            bucket_name, _, key = path.partition('/')
+        length = int(self.headers.get('content-length') or 0)
+        if length:
+            quickack(self.connection)
+        body = self.rfile.read(length) if length else ''
+
+        operation = self.operation(method, key, query)
+        server = self.server
+        server.count(operation)
+        if server.latency:
+            time.sleep(server.latency)
+        if server.throttled():
+            return self.error(503, 'SlowDown',
+                              'Please reduce your request rate.')
+
+        with server.lock:
+            bucket = server.bucket(bucket_name)
+        getattr(self, operation)(bucket, bucket_name, key, query, body)
+
+    def operation(self, method, key, query):
+        if not key:
+            if method == 'POST' and 'delete' in query:
+                return 'delete_keys'
+            return dict(GET='list', HEAD='head_bucket').get(method, 'bad')
+        if method == 'PUT':
+            if 'uploadId' in query:
+                return 'upload_part'
+            if 'x-amz-copy-source' in self.headers:
+                return 'copy'
+            return 'put'
+        if method == 'POST':
+            if 'uploads' in query:
+                return 'initiate_multipart'
+            if 'uploadId' in query:
+                return 'complete_multipart'
+        if method == 'GET' and 'uploadId' in query:
+            return 'list_parts'
+        if method == 'DELETE':
+            if 'uploadId' in query:
+                return 'cancel_multipart'
+            return 'delete'
+        return dict(GET='get', HEAD='head').get(method, 'bad')
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_HEAD(self):
+        self.handle_request('HEAD')
+
+    def do_PUT(self):
+        self.handle_request('PUT')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def do_DELETE(self):
+        self.handle_request('DELETE')
+
+    def respond(self, status, body='', headers=(), content_length=None):
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        if body and not headers:
+            self.send_header('Content-Type', 'application/xml')
+        self.send_header('Content-Length', str(
+            len(body) if content_length is None else content_length))
+        self.end_headers()
+        if body:
+            self.wfile.write(body)
+
+    def xml(self, status, body):
+        self.respond(status, '<?xml version="1.0" encoding="UTF-8"?>\n'
+                     + body.replace('@NS@', NS))
+
+    def error(self, status, code, message):
+        if self.command == 'HEAD':
+            return self.respond(status)
+        self.xml(status, '<Error><Code>%s</Code><Message>%s</Message>'
+                 '<RequestId>0</RequestId></Error>' % (code, message))
+
+    def bad(self, bucket, bucket_name, key, query, body):
+        self.error(400, 'NotImplemented', 'Not implemented by the stand-in')
+
+    def head_bucket(self, bucket, bucket_name, key, query, body):
+        self.respond(200)
+
+    def list(self, bucket, bucket_name, key, query, body):
+        def arg(name, default=''):
+            return query.get(name, [default])[0]
+        prefix, marker = arg('prefix'), arg('marker')
+        delimiter = arg('delimiter')
+        max_keys = min(int(arg('max-keys', MAX_KEYS)), MAX_KEYS)
+        contents, prefixes, truncated = bucket.list(
+            prefix, marker, delimiter, max_keys)
+        result = [
+            '<ListBucketResult xmlns="@NS@">',
+            '<Name>%s</Name>' % escape(bucket_name),
+            '<Prefix>%s</Prefix>' % escape(prefix),
+            '<Marker>%s</Marker>' % escape(marker),
+            '<MaxKeys>%s</MaxKeys>' % max_keys,
+            '<IsTruncated>%s</IsTruncated>' % ('true' if truncated
+                                               else 'false'),
+            ]
+        if delimiter:
+            result.append('<Delimiter>%s</Delimiter>' % escape(delimiter))
+            if truncated:
+                result.append('<NextMarker>%s</NextMarker>' % escape(
+                    max(contents[-1:] + prefixes[-1:])))
+        for name in contents:
+            ob = bucket.objects.get(name)
+            if ob is None:
+                continue # deleted while we were listing
+            result.append(
+                '<Contents><Key>%s</Key><LastModified>%s</LastModified>'
+                '<ETag>%s</ETag><Size>%s</Size>'
+                '<StorageClass>STANDARD</StorageClass></Contents>'
+                % (escape(name), iso8601(ob.modified), escape(ob.etag),
+                   len(ob.data)))
+        for name in prefixes:
+            result.append('<CommonPrefixes><Prefix>%s</Prefix>'
+                          '</CommonPrefixes>' % escape(name))
+        result.append('</ListBucketResult>')
+        self.xml(200, ''.join(result))
+
+    def metadata(self):
+        return dict((name[11:], value)
+                    for name, value in self.headers.items()
+                    if name.lower().startswith('x-amz-meta-'))
+
+    def put(self, bucket, bucket_name, key, query, body):
+        ob = Object(body, self.metadata(), self.headers.get('content-type'))
+        bucket.put(key, ob)
+        self.respond(200, headers=[('ETag', ob.etag)])
+
+    def copy(self, bucket, bucket_name, key, query, body):
+        source = urllib.unquote(self.headers['x-amz-copy-source']).lstrip('/')
+        source_bucket, _, source_key = source.partition('/')
+        with self.server.lock:
+            source_bucket = self.server.bucket(source_bucket)
+        original = source_bucket.objects.get(source_key)
+        if original is None:
+            return self.error(404, 'NoSuchKey', 'No such key')
+        if self.headers.get('x-amz-metadata-directive') == 'REPLACE':
+            ob = Object(original.data, self.metadata(),
+                        self.headers.get('content-type'))
+        else:
+            ob = Object(original.data, original.metadata,
+                        original.content_type)
+        bucket.put(key, ob)
+        self.xml(200, '<CopyObjectResult><LastModified>%s</LastModified>'
+                 '<ETag>%s</ETag></CopyObjectResult>'
+                 % (iso8601(ob.modified), escape(ob.etag)))
+
+    def object_headers(self, ob):
+        headers = [('ETag', ob.etag),
+                   ('Last-Modified', email.utils.formatdate(
+                       ob.modified, usegmt=True)),
+                   ('Content-Type',
+                    ob.content_type or 'application/octet-stream'),
+                   ]
+        headers.extend(('x-amz-meta-' + name, value)
+                       for name, value in sorted(ob.metadata.items()))
+        return headers
+
+    def head(self, bucket, bucket_name, key, query, body):
+        ob = bucket.objects.get(key)
+        if ob is None:
+            return self.respond(404)
+        self.respond(200, headers=self.object_headers(ob),
+                     content_length=len(ob.data))
+
+    def get(self, bucket, bucket_name, key, query, body):
+        ob = bucket.objects.get(key)
+        if ob is None:
+            return self.error(404, 'NoSuchKey', 'No such key')
+        headers = self.object_headers(ob)
+        data = ob.data
+        match = re.match(r'bytes=(\d+)-(\d*)$', self.headers.get('range', ''))
+        if match:
+            start = int(match.group(1))
+            end = int(match.group(2) or len(data) - 1)
+            headers.append(('Content-Range', 'bytes %s-%s/%s'
+                            % (start, end, len(data))))
+            data = data[start:end+1]
+            return self.respond(206, data, headers)
+        self.respond(200, data, headers)
+
+    def delete(self, bucket, bucket_name, key, query, body):
+        bucket.delete(key)
+        self.respond(204)
+
+    def delete_keys(self, bucket, bucket_name, key, query, body):
+        request = xml.etree.ElementTree.fromstring(body)
+        quiet = request.findtext('Quiet') == 'true'
+        result = ['<DeleteResult xmlns="@NS@">']
+        for element in request.findall('Object'):
+            name = element.findtext('Key').encode('utf-8')
+            bucket.delete(name)
+            if not quiet:
+                result.append('<Deleted><Key>%s</Key></Deleted>'
+                              % escape(name))
+        result.append('</DeleteResult>')
+        self.xml(200, ''.join(result))
+
+    def initiate_multipart(self, bucket, bucket_name, key, query, body):
+        upload_id = str(next(self.server.upload_ids))
+        self.server.uploads[upload_id] = (
+            {}, self.metadata(), self.headers.get('content-type'))
+        self.xml(200, '<InitiateMultipartUploadResult xmlns="@NS@">'
+                 '<Bucket>%s</Bucket><Key>%s</Key><UploadId>%s</UploadId>'
+                 '</InitiateMultipartUploadResult>'
+                 % (escape(bucket_name), escape(key), upload_id))
+
+    def upload(self, query):
+        upload = self.server.uploads.get(query['uploadId'][0])
+        if upload is None:
+            self.error(404, 'NoSuchUpload', 'No such upload')
+        return upload
+
+    def upload_part(self, bucket, bucket_name, key, query, body):
+        upload = self.upload(query)
+        if upload is not None:
+            upload[0][int(query['partNumber'][0])] = body
+            self.respond(200, headers=[
+                ('ETag', '"%s"' % hashlib.md5(body).hexdigest())])
+
+    def list_parts(self, bucket, bucket_name, key, query, body):
+        upload = self.upload(query)
+        if upload is not None:
+            result = ['<ListPartsResult xmlns="@NS@">'
+                      '<Bucket>%s</Bucket><Key>%s</Key><UploadId>%s</UploadId>'
+                      '<IsTruncated>false</IsTruncated>'
+                      % (escape(bucket_name), escape(key),
+                         query['uploadId'][0])]
+            for number, data in sorted(upload[0].items()):
+                result.append(
+                    '<Part><PartNumber>%s</PartNumber><ETag>"%s"</ETag>'
+                    '<Size>%s</Size></Part>'
+                    % (number, hashlib.md5(data).hexdigest(), len(data)))
+            result.append('</ListPartsResult>')
+            self.xml(200, ''.join(result))
+
+    def complete_multipart(self, bucket, bucket_name, key, query, body):
+        upload = self.upload(query)
+        if upload is not None:
+            parts, metadata, content_type = upload
+            del self.server.uploads[query['uploadId'][0]]
+            ob = Object(''.join(data for _, data in sorted(parts.items())),
+                        metadata, content_type)
+            ob.etag = '"%s-%s"' % (
+                hashlib.md5(''.join(hashlib.md5(data).digest()
+                                    for _, data in sorted(parts.items()))
+                            ).hexdigest(),
+                len(parts))
+            bucket.put(key, ob)
+            self.xml(200, '<CompleteMultipartUploadResult xmlns="@NS@">'
+                     '<Location>/%s/%s</Location><Bucket>%s</Bucket>'
+                     '<Key>%s</Key><ETag>%s</ETag>'
+                     '</CompleteMultipartUploadResult>'
+                     % (escape(bucket_name), escape(key),
+                        escape(bucket_name), escape(key), escape(ob.etag)))
+
+    def cancel_multipart(self, bucket, bucket_name, key, query, body):
+        if self.upload(query) is not None:
+            del self.server.uploads[query['uploadId'][0]]
+            self.respond(204)
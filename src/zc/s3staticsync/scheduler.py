@@ -0,0 +1,192 @@
+"""Work scheduling
+
+Jobs are scheduled in lanes, so, for example, small web files that
+users are waiting to see aren't held up behind a directory of large
+archives.  Each lane is first-in, first-out.  Lanes share workers in
+proportion to their weights (stride scheduling), so lower-priority
+lanes are slowed, but not starved.
+
+The number of jobs held in memory can be limited.  Jobs beyond the
+limit are spooled to temporary files, rather than blocking whoever is
+putting them, so scanning isn't slowed by uploading.
+
+Deletes don't go through the scheduler.  They have their own queue
+and workers.
+"""
+
+import collections
+import marshal
+import Queue
+import tempfile
+import threading
+
+# (lane, weight), highest priority first
+LANES = (
+    ('hot', 8), # web files and configured paths
+    ('generated', 4), # generated index pages
+    ('normal', 2),
+    ('bulk', 1), # large files
+    )
+
+class Spool:
+    """A first-in, first-out queue of jobs in a temporary file
+
+    Jobs are marshaled, so encode and decode, if given, convert jobs
+    to and from marshalable values.  The file is emptied whenever the
+    spool is.
+    """
+
+    def __init__(self, directory=None, encode=None, decode=None):
+        self.file = tempfile.TemporaryFile(
+            prefix='s3staticsync-spool-', dir=directory)
+        self.encode = encode
+        self.decode = decode
+        self.read = self.written = self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def append(self, job):
+        if self.encode is not None:
+            job = self.encode(job)
+        self.file.seek(self.written)
+        marshal.dump(job, self.file)
+        self.written = self.file.tell()
+        self.count += 1
+
+    def popleft(self):
+        self.file.seek(self.read)
+        job = marshal.load(self.file)
+        self.read = self.file.tell()
+        self.count -= 1
+        if not self.count:
+            self.file.seek(0)
+            self.file.truncate()
+            self.read = self.written = 0
+        if self.decode is not None:
+            job = self.decode(job)
+        return job
+
+    def close(self):
+        self.file.close()
+
+class Scheduler(Queue.Queue):
+    """A Queue.Queue with weighted lanes
+
+    The classify function returns the lane for a job.  It's called
+    without holding the queue's lock, so it may do I/O.
+
+    If memory is non-zero, at most that many jobs are held in memory.
+    The rest are appended to their lanes' spools, created by calling
+    spool.
+    """
+
+    def __init__(self, classify, maxsize=0, lanes=LANES,
+                 memory=0, spool=Spool):
+        self.classify = classify
+        self.lanes = lanes
+        self.memory = memory
+        self.spool = spool
+        Queue.Queue.__init__(self, maxsize)
+
+    def put(self, item, block=True, timeout=None):
+        Queue.Queue.put(self, (self.classify(item), item), block, timeout)
+
+    # Queue.Queue calls these with its lock held.
+
+    def _init(self, maxsize):
+        self.queue = dict(
+            (lane, collections.deque()) for lane, _ in self.lanes)
+        self.strides = dict(
+            (lane, 1.0 / weight) for lane, weight in self.lanes)
+        self.passes = dict((lane, 0.0) for lane, _ in self.lanes)
+        self.counts = dict((lane, 0) for lane, _ in self.lanes)
+        self.current = 0.0
+        self.spools = {} # {lane: spool}, created as needed
+        self.in_memory = 0
+        self.spooled = 0 # jobs ever spooled
+
+    def _qsize(self):
+        return self.in_memory + sum(
+            len(spool) for spool in self.spools.itervalues())
+
+    def _put(self, item):
+        lane, job = item
+        jobs = self.queue[lane]
+        spool = self.spools.get(lane)
+        if not (jobs or spool):
+            # An idle lane doesn't get credit for the time it was idle.
+            self.passes[lane] = max(self.passes[lane], self.current)
+        if spool or (self.memory and self.in_memory >= self.memory):
+            # Jobs behind spooled jobs are spooled, to keep lanes in
+            # order.
+            if spool is None:
+                spool = self.spools[lane] = self.spool()
+            spool.append(job)
+            self.spooled += 1
+        else:
+            jobs.append(job)
+            self.in_memory += 1
+        self.counts[lane] += 1
+
+    def _get(self):
+        # The non-empty lane with the lowest pass goes next.  Ties go
+        # to higher-priority lanes.
+        lane = None
+        for name, _ in self.lanes:
+            jobs = self.queue[name]
+            if ((jobs or self.spools.get(name)) and
+                (lane is None or self.passes[name] < self.passes[lane])):
+                lane = name
+        self.current = self.passes[lane]
+        self.passes[lane] += self.strides[lane]
+        jobs = self.queue[lane]
+        spool = self.spools.get(lane)
+        if not jobs:
+            return spool.popleft() # Everything else was spooled.
+        job = jobs.popleft()
+        self.in_memory -= 1
+        if spool:
+            # Refill from the spool.
+            jobs.append(spool.popleft())
+            self.in_memory += 1
+        return job
+
+    def depths(self):
+        """Return the number of jobs waiting in each lane
+        """
+        with self.mutex:
+            return dict((lane, len(jobs) + len(self.spools.get(lane, ())))
+                        for lane, jobs in self.queue.iteritems())
+
+    def close(self):
+        """Remove the spools
+        """
+        with self.mutex:
+            for spool in self.spools.itervalues():
+                spool.close()
+            self.spools.clear()
+
+class Budget:
+    """A limit on the number of bytes uploaded in a run
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.spent = 0
+        self.lock = threading.Lock()
+
+    def take(self, size):
+        """Spend size bytes, if they're within the budget
+        """
+        with self.lock:
+            if self.spent + size > self.limit:
+                return False
+            self.spent += size
+            return True
+
+    def give(self, size):
+        """Give back size bytes taken for an upload that failed
+        """
+        with self.lock:
+            self.spent -= size
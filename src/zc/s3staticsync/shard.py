@@ -0,0 +1,245 @@
+"""Sharded synchronization
+
+In a single process, the GIL limits how fast we can scan, convert
+times and compute differences, no matter how many threads we use.
+With --shards, the top-level names in the source directory are split
+across processes (shards) by a hash of the names.  Each shard scans,
+diffs and uploads its part of the tree, using its own segment of the
+index (and hash cache), and records the paths it needs invalidated.
+
+The coordinator splits the index and hash cache into segments
+beforehand and, when the shards are done, merges the segments and
+the shards' metrics, and submits the invalidations.  The coordinator
+holds the lock file, if any, for the whole run.
+"""
+
+import boto
+import copy
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import zlib
+
+from zc.s3staticsync import index as indexfile
+from zc.s3staticsync import sync
+from zc.s3staticsync.hashcache import HashCache
+from zc.s3staticsync.invalidation import Planner, recorded
+from zc.s3staticsync.metrics import Metrics
+from zc.s3staticsync.retry import Limiter, Retries
+
+logger = logging.getLogger(__name__)
+
+def shard_of(name, count):
+    """Return the shard number for a top-level name
+    """
+    return (zlib.crc32(name.encode('utf-8')) & 0xffffffff) % count
+
+def top(key):
+    return key.split(u'/', 1)[0]
+
+class Shard:
+
+    def __init__(self, number, count, directory):
+        self.number = number
+        self.count = count
+        path = os.path.join(directory, str(number))
+        self.index = path + '.index'
+        self.hash_cache = path + '.hashes'
+        self.metrics = path + '.metrics.json'
+        self.invalidations = path + '.invalidations'
+
+    def selects(self, name):
+        """Is a top-level name in this shard?
+        """
+        return shard_of(name, self.count) == self.number
+
+def split_index(index, shards, compact):
+    count = len(shards)
+    if compact:
+        # Stream the sorted entries to the segments, so we don't copy
+        # a (memory-mapped) compact index into memory.
+        if isinstance(index, indexfile.Index):
+            items = index.iteritems()
+        else:
+            items = indexfile.sorted_items(index)
+        writers = [indexfile.Writer(shard.index) for shard in shards]
+        name = writer = None
+        for key, value in items:
+            if top(key) != name:
+                name = top(key)
+                writer = writers[shard_of(name, count)]
+            writer.add(key, value)
+        for writer in writers:
+            writer.close()
+    else:
+        segments = [{} for shard in shards]
+        for key, value in index.iteritems():
+            segments[shard_of(top(key), count)][key] = value
+        for shard, segment in zip(shards, segments):
+            with open(shard.index, 'wb') as f:
+                indexfile.dump(segment, f)
+
+def merge_index(shards, path, compact):
+    segments = [indexfile.load(shard.index) for shard in shards]
+    if compact:
+        with indexfile.replacing(path) as tmp:
+            indexfile.write(tmp, indexfile.merge(*[
+                segment.iteritems() if isinstance(segment, indexfile.Index)
+                else indexfile.sorted_items(segment)
+                for segment in segments]))
+        for segment in segments:
+            if isinstance(segment, indexfile.Index):
+                segment.close()
+    else:
+        index = {}
+        for segment in segments:
+            index.update(segment.iteritems())
+        indexfile.save(path, index)
+
+def split_directories(path, shards, encoding):
+    # Directory times (--prune-directories) are keyed by relative file
+    # paths.  Each shard gets those under its top-level names, and the
+    # top's, as every shard reads it.
+    data = indexfile.load_directories(path)
+    times = data.get('directories', {})
+    for shard in shards:
+        indexfile.save_directories(shard.index, dict(
+            data, directories=dict(
+                (base, value) for base, value in times.iteritems()
+                if not base or shard.selects(top(base.decode(encoding)))
+                )))
+
+def merge_directories(shards, path):
+    times = {}
+    pruned_scans = 0
+    for shard in shards:
+        data = indexfile.load_directories(shard.index)
+        times.update(data.get('directories', {}))
+        pruned_scans = max(pruned_scans, data.get('pruned_scans', 0))
+    indexfile.save_directories(path, dict(
+        pruned_scans=pruned_scans, directories=times))
+
+def run_shard(options, args, shard):
+    sync(options, args, shard=shard)
+
+def sync_shards(options, args):
+    """Synchronize a directory with S3, using options.shards processes
+    """
+    if options.lock_file:
+        import zc.lockfile
+        lock = zc.lockfile.LockFile(options.lock_file)
+    else:
+        lock = None
+
+    metrics = Metrics('s3staticsync')
+    directory = tempfile.mkdtemp(prefix='s3staticsync-')
+    try:
+        count = options.shards
+        shards = [Shard(i, count, directory) for i in range(count)]
+
+        if options.index:
+            indexfile.recover(options.index)
+        had_index = (options.index and not options.ignore_index and
+                     os.path.exists(options.index))
+        compact = options.compact_index or (
+            had_index and indexfile.is_compact(options.index))
+        if had_index:
+            with metrics.phase('split_index'):
+                index = indexfile.load(options.index)
+                split_index(index, shards, compact)
+                if isinstance(index, indexfile.Index):
+                    index.close()
+                del index
+                if options.prune_directories:
+                    split_directories(options.index, shards,
+                                      options.file_system_encoding)
+
+        if options.hash_cache:
+            hash_cache = HashCache(options.hash_cache)
+            for shard in shards:
+                segment = HashCache(shard.hash_cache)
+                segment.entries = dict(
+                    (key, entry)
+                    for key, entry in hash_cache.entries.iteritems()
+                    if shard.selects(top(key)))
+                segment.save()
+
+        with metrics.phase('shards'):
+            processes = []
+            for shard in shards:
+                shard_options = copy.copy(options)
+                shard_options.lock_file = None
+                shard_options.compact_index = compact
+                shard_options.metrics_json = shard.metrics
+                shard_options.metrics_prometheus = None
+                if options.index:
+                    shard_options.index = shard.index
+                if options.hash_cache:
+                    shard_options.hash_cache = shard.hash_cache
+                process = multiprocessing.Process(
+                    target=run_shard, args=(shard_options, args, shard))
+                process.start()
+                processes.append(process)
+            failed = []
+            for shard, process in zip(shards, processes):
+                process.join()
+                if process.exitcode:
+                    logger.error("shard %s failed" % shard.number)
+                    failed.append(shard)
+
+        for shard in shards:
+            if os.path.exists(shard.metrics):
+                with open(shard.metrics) as f:
+                    metrics.add(json.load(f))
+
+        if options.index:
+            # A failed shard leaves its segment as it was, with a
+            # journal of the changes it made.  If there wasn't a
+            # segment, we don't know what that shard has in S3.
+            for shard in shards:
+                indexfile.recover(shard.index)
+            if [shard for shard in shards
+                if not os.path.exists(shard.index)]:
+                logger.error("Not updating the index, as shards failed")
+            else:
+                with metrics.phase('merge_index'):
+                    merge_index(shards, options.index, compact)
+                    if options.prune_directories:
+                        merge_directories(shards, options.index)
+
+        if options.hash_cache:
+            hash_cache.entries = {}
+            for shard in shards:
+                hash_cache.entries.update(HashCache(shard.hash_cache).entries)
+            hash_cache.save()
+
+        if options.cloudfront:
+            with metrics.phase('cloudfront'):
+                retries = Retries(
+                    None, Limiter(threading.Condition(), 1), options.retries,
+                    options.retry_delay, options.retry_max_delay)
+                planner = Planner(
+                    boto.connect_cloudfront(), options.cloudfront,
+                    args[1].partition('/')[2], retries, metrics,
+                    options.invalidation_wildcard,
+                    options.invalidation_interval)
+                for shard in shards:
+                    if os.path.exists(shard.invalidations):
+                        for path in recorded(shard.invalidations):
+                            planner.add(path)
+                planner.close()
+
+        metrics.count('shards', count)
+        metrics.count('shards_failed', len(failed))
+        metrics.write(options.metrics_json, options.metrics_prometheus)
+    finally:
+        shutil.rmtree(directory)
+        if lock is not None:
+            lock.close()
+
+    if failed:
+        raise SystemExit("%s of %s shards failed" % (len(failed), count))
@@ -11,42 +11,166 @@
 # FOR A PARTICULAR PURPOSE.
 #
 ##############################################################################
+import base64
+import boto
+import boto.s3.connection
+import boto.s3.multidelete
+import ConfigParser
+import boto.s3.prefix
 import doctest
+import gevent.threadpool
+import hashlib
 import mock
 import os
 import time
 import traceback
+import unittest
 import random
+import StringIO
 import sys
+import zc.s3staticsync.retry
+import zc.s3staticsync.s3server
 import zope.testing.setupstack
 
+real_sleep = time.sleep
+
+# gevent's thread pool binds time.sleep when it's imported, so it's
+# imported above, before tests mock time.sleep.  Otherwise, pool
+# threads of later tests would sleep with an earlier test's mock.
+
 class Bucket:
 
-    puts = deletes = gets = 0
+    puts = deletes = gets = ranges = 0
     fail = debug = False
 
     def __init__(self, connection):
         self.connection = connection
         self.data = {}
 
+    failures = ()
+
+    def check_fail(self):
+        # Raise injected errors, first from failures, which is a
+        # list of exceptions, then if fail is set.
+        if self.failures:
+            raise self.failures.pop(0)
+        if self.fail:
+            raise ValueError("fail")
+
     listed = None
-    def list(self, prefix=''):
+    pages = listing = max_listing = 0
+    page_size = 1000
+    latency = 0
+
+    def list(self, prefix='', delimiter=''):
         self.listed = prefix
+        results = []
+        prefixes = set()
         for path in sorted(self.data):
             if path.startswith(prefix):
+                rest = path[len(prefix):]
+                if delimiter and delimiter in rest:
+                    name = prefix + rest.split(delimiter, 1)[0] + delimiter
+                    if name not in prefixes:
+                        prefixes.add(name)
+                        results.append(boto.s3.prefix.Prefix(self, name))
+                    continue
                 k = Key(self)
                 k.key = path
                 k.data, k.last_modified = self.data[path][:2]
+                k.etag = '"%s"' % hashlib.md5(k.data).hexdigest()
+                results.append(k)
+
+        # Simulate paging, with optional (real) latency per page
+        for start in range(0, max(len(results), 1), self.page_size):
+            self.pages += 1
+            self.listing += 1
+            self.max_listing = max(self.max_listing, self.listing)
+            if self.latency:
+                real_sleep(self.latency)
+            self.listing -= 1
+            for k in results[start:start+self.page_size]:
                 yield k
 
     __iter__ = list
 
+    multipart_uploads = parts = cancelled = 0
+
+    def initiate_multipart_upload(self, key_name, headers=None):
+        self.multipart_uploads += 1
+        return MultiPartUpload(self, key_name, headers)
+
+    multi_deletes = 0
+    delete_errors = ()
+
+    def delete_keys(self, keys, quiet=False):
+        self.multi_deletes += 1
+        self.deletes += len(keys)
+        self.check_fail()
+        result = boto.s3.multidelete.MultiDeleteResult(self)
+        for name in keys:
+            if name in self.delete_errors:
+                result.errors.append(boto.s3.multidelete.Error(
+                    name, code='AccessDenied', message='Access Denied'))
+            else:
+                del self.data[name]
+                if not quiet:
+                    result.deleted.append(boto.s3.multidelete.Deleted(name))
+        return result
+
+    copies = 0
+
+    def copy_key(self, new_key_name, src_bucket_name, src_key_name,
+                 metadata=None):
+        self.copies += 1
+        self.check_fail()
+        if self.debug:
+            print 'copy_key', src_key_name, new_key_name, metadata
+        k = Key(self)
+        k.key = new_key_name
+        k.data = self.data[src_key_name][0]
+        k.last_modified = (
+            "%4.4d-%2.2d-%2.2dT%2.2d:%2.2d:%2.2d.123"
+            % time.gmtime(time.time())[:6]
+            )
+        k.etag = '"%s"' % hashlib.md5(k.data).hexdigest()
+        self.data[new_key_name] = k.data, k.last_modified, {}
+        return k
+
     def get_key(self, path):
         k = Key(self)
         k.key = path
         k.data, k.last_modified, k.metadata = self.data[path]
         return k
 
+class MultiPartUpload:
+
+    def __init__(self, bucket, key_name, headers):
+        self.bucket = bucket
+        self.key_name = key_name
+        self.headers = headers
+        self.parts = {}
+
+    def upload_part_from_file(self, fp, part_num, md5, size):
+        self.bucket.parts += 1
+        self.bucket.check_fail()
+        self.parts[part_num] = fp.read(size)
+        if md5[0] != hashlib.md5(self.parts[part_num]).hexdigest():
+            raise AssertionError("bad md5", md5)
+
+    def complete_upload(self):
+        self.bucket.puts += 1
+        last_modified = (
+            "%4.4d-%2.2d-%2.2dT%2.2d:%2.2d:%2.2d.123"
+            % time.gmtime(time.time())[:6]
+            )
+        self.bucket.data[self.key_name] = (
+            ''.join(self.parts[i] for i in sorted(self.parts)),
+            last_modified, {})
+
+    def cancel_upload(self):
+        self.bucket.cancelled += 1
+
 class Key:
 
     def __init__(self, bucket):
@@ -59,13 +183,17 @@ class Key:
     def get_metadata(self, k):
         return self.metadata[k]
 
-    def set_contents_from_filename(self, filename):
+    def set_contents_from_filename(self, filename, md5=None):
         self.bucket.puts += 1
         if self.bucket.debug:
             print 'set_contents_from_filename', filename
 
-        if self.bucket.fail:
-            raise ValueError("fail")
+        self.bucket.check_fail()
+
+        if md5 is not None:
+            with open(filename) as f:
+                if md5[0] != hashlib.md5(f.read()).hexdigest():
+                    raise AssertionError("bad md5", md5)
 
         self.last_modified = (
             "%4.4d-%2.2d-%2.2dT%2.2d:%2.2d:%2.2d.123"
@@ -75,15 +203,18 @@ class Key:
             self.bucket.data[self.key] = (
                 f.read(), self.last_modified, self.metadata)
 
-    def set_contents_from_string(self, data, headers):
+    def set_contents_from_file(self, fp, headers, md5, size):
         self.bucket.puts += 1
         if headers.items() != [('Content-Type', 'text/html')]:
             raise AssertionError("bad headers", headers)
+        data = fp.read(size)
+        if (md5[0] != hashlib.md5(data).hexdigest() or
+            md5[1] != base64.b64encode(hashlib.md5(data).digest())):
+            raise AssertionError("bad md5", md5)
         if self.bucket.debug:
-            print 'set_contents_from_string', data, self.bucket.puts
+            print 'set_contents_from_file', data, self.bucket.puts
 
-        if self.bucket.fail:
-            raise ValueError("fail")
+        self.bucket.check_fail()
 
         self.last_modified = (
             "%4.4d-%2.2d-%2.2dT%2.2d:%2.2d:%2.2d.123"
@@ -91,11 +222,20 @@ class Key:
             )
         self.bucket.data[self.key] = data, self.last_modified, self.metadata
 
+    def get_contents_to_file(self, fp, headers=None):
+        self.bucket.gets += 1
+        self.bucket.check_fail()
+        data = self.bucket.data[self.key][0]
+        if headers and 'Range' in headers:
+            self.bucket.ranges += 1
+            start, end = headers['Range'][6:].split('-')
+            data = data[int(start):int(end)+1]
+        fp.write(data)
+
     def get_contents_to_filename(self, filename):
         self.bucket.gets += 1
 
-        if self.bucket.fail:
-            raise ValueError("fail")
+        self.bucket.check_fail()
 
         with open(filename, 'w') as f:
             f.write(self.bucket.data[self.key][0])
@@ -111,8 +251,7 @@ class Key:
 
     def delete(self):
         self.bucket.deletes += 1
-        if self.bucket.fail:
-            raise ValueError("fail")
+        self.bucket.check_fail()
         del self.bucket.data[self.key]
 
 class S3Connection:
@@ -120,13 +259,35 @@ class S3Connection:
     def __init__(self):
         self.buckets = dict(test=Bucket(self))
 
-    def get_bucket(self, name):
+    def get_bucket(self, name, validate=True):
         return self.buckets[name]
 
+class Invalidation:
+
+    def __init__(self, id, status):
+        self.id = id
+        self.status = status
+
 class Cloudfront:
 
+    # Number of status checks before an invalidation completes
+    checks = 0
+
+    def __init__(self):
+        self.requests = {}
+
     def create_invalidation_request(self, cfid, paths):
         print 'invalidated', cfid, paths
+        id = 'I%s' % (len(self.requests) + 1)
+        self.requests[id] = self.checks
+        return Invalidation(id, 'InProgress')
+
+    def invalidation_request_status(self, cfid, id):
+        print 'checked', cfid, id
+        if self.requests[id]:
+            self.requests[id] -= 1
+            return Invalidation(id, 'InProgress')
+        return Invalidation(id, 'Completed')
 
 def mkfile(path, data=None):
     if data is None:
@@ -146,6 +307,7 @@ def exception(s):
 
 def setup(test):
     random.seed(0)
+    zc.s3staticsync.retry.jitter.seed(0)
     zope.testing.setupstack.setUpDirectory(test)
     s3conn = S3Connection()
     zope.testing.setupstack.context_manager(
@@ -170,8 +332,43 @@ def setup(test):
     zope.testing.setupstack.context_manager(
         test, mock.patch("boto.connect_cloudfront", side_effect=Cloudfront))
 
+def benchmark_setup(test):
+    # Benchmarks use a real (local) S3, real time and subprocesses.
+    zope.testing.setupstack.setUpDirectory(test)
+    test.globs.update(os=os, time=time)
+
+def shard_setup(test):
+    # Shards run in separate processes, so they can't share the faux
+    # bucket.  They use a local S3 stand-in instead, with real time.
+    zope.testing.setupstack.setUpDirectory(test)
+    server = zc.s3staticsync.s3server.Server()
+    server.start()
+    zope.testing.setupstack.register(test, server.stop)
+
+    # Configure boto, as scripts would be, to use the stand-in.
+    config = ConfigParser.SafeConfigParser()
+    config.readfp(StringIO.StringIO(
+        zc.s3staticsync.s3server.boto_config(server.port)))
+    zope.testing.setupstack.context_manager(
+        test, mock.patch.object(boto.config, '_parser', config))
+    zope.testing.setupstack.context_manager(
+        test, mock.patch("boto.connect_cloudfront", side_effect=Cloudfront))
+    test.globs.update(
+        os=os, time=time, mkfile=mkfile, server=server,
+        bucket=boto.s3.connection.S3Connection().get_bucket('test'))
+    server.reset()
+
 def test_suite():
-    return doctest.DocFileSuite(
-        'main.test', 'restore.test',
-        setUp=setup, tearDown=zope.testing.setupstack.tearDown)
+    return unittest.TestSuite((
+        doctest.DocFileSuite(
+            'main.test', 'restore.test', 'index.test', 'invalidation.test',
+            'scheduler.test', 'timestamps.test',
+            setUp=setup, tearDown=zope.testing.setupstack.tearDown),
+        doctest.DocFileSuite(
+            'shard.test',
+            setUp=shard_setup, tearDown=zope.testing.setupstack.tearDown),
+        doctest.DocFileSuite(
+            'benchmark.test',
+            setUp=benchmark_setup, tearDown=zope.testing.setupstack.tearDown),
+        ))
 
@@ -0,0 +1,66 @@
+"""Time normalization
+
+Modification times are compared as whole seconds since the epoch.
+File times come straight from stat.  S3 times come from the ISO 8601
+timestamps in bucket listings, which we convert with arithmetic,
+rather than by building time tuples and calling time.mktime, which is
+slow and depends on the local time zone.  As S3 objects in a listing
+tend to have been written on a few days, seconds for dates are
+memoized.
+
+Indexes written before index version 2 have times computed the old
+way, by converting UTC time tuples with time.mktime, as if they were
+local standard time, which made them off by the time zone offset.
+from_legacy converts them when old indexes are loaded.
+"""
+
+import time
+
+def days_from_civil(year, month, day):
+    """Return the number of days from 1970-01-01 to a (Gregorian) date
+    """
+    # Count from March, so leap days come at the ends of years.
+    if month <= 2:
+        year -= 1
+        month += 9
+    else:
+        month -= 3
+    era = year // 400
+    year_of_era = year - era * 400
+    day_of_year = (153 * month + 2) // 5 + day - 1
+    day_of_era = (year_of_era * 365 + year_of_era // 4 - year_of_era // 100
+                  + day_of_year)
+    return era * 146097 + day_of_era - 719468
+
+MAX_DATES = 10000 # memoized dates
+_dates = {} # {'YYYY-MM-DD': seconds}
+
+def s3_time(s):
+    """Convert an S3 timestamp to seconds since the epoch
+
+    S3 timestamps look like '2013-09-23T18:57:12.000Z'.  Fractions of
+    seconds are dropped.
+    """
+    try:
+        seconds = _dates[s[:10]]
+    except KeyError:
+        if len(_dates) >= MAX_DATES:
+            _dates.clear()
+        if s[4] != '-' or s[7] != '-' or s[10] != 'T':
+            raise ValueError("Bad time", s)
+        seconds = _dates[s[:10]] = 86400 * days_from_civil(
+            int(s[:4]), int(s[5:7]), int(s[8:10]))
+    return seconds + int(s[11:13]) * 3600 + int(s[14:16]) * 60 + int(s[17:19])
+
+def legacy(t):
+    """Return a time the way indexes before version 2 stored it
+    """
+    return int(time.mktime(time.gmtime(t)[:6] + (0, 0, 0)))
+
+def from_legacy(value):
+    """Convert a time stored by indexes before version 2
+    """
+    # The legacy offset for a time is the same (unless the zone's
+    # standard offset changed in between) as for a time an offset
+    # away.
+    return value - (legacy(value) - value)
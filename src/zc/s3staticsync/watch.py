@@ -0,0 +1,237 @@
+"""Continuous synchronization
+
+Rather than scanning the whole tree on each run, the daemon watches
+the source directory with inotify and syncs just the paths that
+changed.  Bursts of changes (e.g. FTP uploads) are debounced: we wait
+until there have been no changes for a while (or until changes have
+waited too long) before syncing them.
+
+Because events can be lost (e.g. if the inotify queue overflows), we
+also do a full sync periodically, and whenever we know we've missed
+something.
+
+Linux only.  We use inotify through ctypes, so there are no extra
+dependencies.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+import time
+
+logger = logging.getLogger(__name__)
+
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x1000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0x80000
+
+# We don't watch IN_MODIFY, because we'll see IN_CLOSE_WRITE when a
+# writer is done. IN_ATTRIB catches modification-time changes.
+MASK = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+        IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_ONLYDIR)
+
+event_header = struct.Struct('iIII')
+
+class Inotify:
+    """Minimal inotify wrapper
+    """
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'),
+                                use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            self.error()
+
+    def error(self, path=None):
+        error = ctypes.get_errno()
+        raise OSError(error, os.strerror(error), path)
+
+    def add_watch(self, path, mask=MASK):
+        wd = self.libc.inotify_add_watch(self.fd, path, mask)
+        if wd < 0:
+            self.error(path)
+        return wd
+
+    def rm_watch(self, wd):
+        self.libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self, timeout):
+        """Read events, waiting at most timeout seconds for some
+
+        Returns a list of (wd, mask, name) tuples.
+        """
+        if not select.select([self.fd], (), (), timeout)[0]:
+            return []
+        try:
+            data = os.read(self.fd, 1 << 16)
+        except OSError as v:
+            if v.errno == errno.EAGAIN:
+                return []
+            raise
+
+        events = []
+        pos = 0
+        while pos < len(data):
+            wd, mask, cookie, size = event_header.unpack_from(data, pos)
+            pos += event_header.size
+            name = data[pos:pos+size].rstrip('\0')
+            pos += size
+            events.append((wd, mask, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+class Watcher:
+    """Watch a directory tree
+
+    Watches are added for new directories as they're created (or moved
+    into the tree).
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.inotify = Inotify()
+        self.paths = {} # wd -> relative directory path
+        self.add_tree('')
+
+    def add_tree(self, base):
+        # Watch a directory and its subdirectories.  Contents of new
+        # directories might have been written before we watched them,
+        # which is why their paths are reported as changed.
+        for dirpath, dirnames, _ in os.walk(os.path.join(self.root, base)):
+            try:
+                wd = self.inotify.add_watch(dirpath)
+            except OSError:
+                logger.exception("Couldn't watch %r" % dirpath)
+                continue
+            path = os.path.relpath(dirpath, self.root)
+            self.paths[wd] = '' if path == '.' else path
+
+    def remove_tree(self, base):
+        for wd, path in self.paths.items():
+            if path == base or path.startswith(base + '/'):
+                self.inotify.rm_watch(wd)
+                del self.paths[wd]
+
+    def changes(self, timeout):
+        """Return changed relative paths, waiting up to timeout seconds
+
+        Returns None if events were lost.
+        """
+        changed = set()
+        for wd, mask, name in self.inotify.read(timeout):
+            if mask & IN_Q_OVERFLOW:
+                return None
+            if mask & IN_IGNORED:
+                self.paths.pop(wd, None)
+                continue
+            base = self.paths.get(wd)
+            if base is None or not name:
+                continue
+            path = os.path.join(base, name)
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    self.add_tree(path)
+                elif mask & IN_MOVED_FROM:
+                    self.remove_tree(path)
+            changed.add(path)
+        return changed
+
+    def close(self):
+        self.inotify.close()
+
+class Daemon:
+    """Sync changed paths, as we see them, forever
+    """
+
+    def __init__(self, options, args):
+        self.options = options
+        self.args = args
+        self.pending = set()
+        self.first = self.last = None
+        self.full = True
+
+    def start(self):
+        # Start watching before the first full sync, so we don't miss
+        # changes made while it runs.
+        self.watcher = Watcher(self.args[0])
+        self.sync()
+
+    def collect(self, timeout):
+        """Collect changes, waiting up to timeout seconds for them
+        """
+        changed = self.watcher.changes(timeout)
+        if changed is None:
+            logger.warning("Lost inotify events, doing a full sync")
+            self.full = True
+        elif changed:
+            now = time.time()
+            if not self.pending:
+                self.first = now
+            self.last = now
+            self.pending.update(changed)
+
+    def due(self):
+        """Return whether pending changes (or a full sync) are due
+
+        Changes are due when there haven't been any new ones for
+        --debounce seconds, or when the oldest has waited 10 times
+        that long.
+        """
+        if self.full:
+            return True
+        if not self.pending:
+            return False
+        now = time.time()
+        debounce = self.options.debounce
+        return (now - self.last >= debounce or
+                now - self.first >= 10 * debounce)
+
+    reconciled = 0
+
+    def sync(self):
+        """Sync pending changes, or do a full sync if one is needed
+        """
+        from zc.s3staticsync import sync
+        if self.full:
+            paths = None
+            self.reconciled = time.time()
+        else:
+            paths = sorted(self.pending)
+        self.pending.clear()
+        self.full = False
+        sync(self.options, self.args, paths)
+
+    def run(self):
+        interval = self.options.reconcile_interval
+        self.start()
+        while 1:
+            if self.pending:
+                timeout = self.options.debounce
+            else:
+                timeout = max(self.reconciled + interval - time.time(), 0)
+            self.collect(timeout)
+            if time.time() >= self.reconciled + interval:
+                self.full = True
+            if self.due():
+                try:
+                    self.sync()
+                except Exception:
+                    logger.exception("sync failed, will do a full sync")
+                    self.full = True